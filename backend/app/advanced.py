@@ -3,28 +3,27 @@ AI伴侣 - 进阶功能模块
 增加更多智能化功能
 """
 import random
+from array import array
 from datetime import datetime
+from typing import List, Tuple
+
+from . import lexicon
 
 class EmotionEngine:
     """情感引擎"""
     
-    POSITIVE_WORDS = ["开心", "高兴", "快乐", "棒", "好", "喜欢", "谢谢", "爱你", "优秀", "赞", "哈哈", "太好了"]
-    NEGATIVE_WORDS = ["难过", "伤心", "哭", "累", "烦", "郁闷", "生气", "愤怒", "失望", "沮丧", "烦死了", "无语"]
+    POSITIVE_WORDS = list(lexicon.POSITIVE_WORDS)
+    NEGATIVE_WORDS = list(lexicon.NEGATIVE_WORDS)
     
     @classmethod
     def detect_emotion(cls, message: str) -> str:
         """检测情绪"""
-        message_lower = message.lower()
-        
-        for word in cls.POSITIVE_WORDS:
-            if word in message_lower:
-                return "positive"
-        
-        for word in cls.NEGATIVE_WORDS:
-            if word in message_lower:
-                return "negative"
-        
-        return "neutral"
+        return lexicon.emotion_lexicon.detect(message)
+    
+    @classmethod
+    def detect_many(cls, messages: List[str]) -> Tuple[array, array]:
+        """批量检测情绪，返回 (情绪编码数组, 分数数组)，编码含义见 lexicon.LABELS"""
+        return lexicon.emotion_lexicon.detect_many(messages)
     
     @classmethod
     def get_response(cls, emotion: str) -> str:
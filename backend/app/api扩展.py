@@ -2,11 +2,16 @@
 API扩展模块
 增加更多接口
 """
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import Optional, List
+from starlette.concurrency import run_in_threadpool
+from typing import AsyncIterator, Optional, List, Tuple, Union
 from datetime import datetime
+import anyio
+import json
 from .advanced import EmotionEngine, ReminderEngine, MemoryEngine, ToolEngine, PersonaEngine
+from .lexicon import LABELS, emotion_lexicon
 
 router = APIRouter()
 
@@ -26,6 +31,108 @@ async def detect_emotion(request: EmotionRequest):
         "response": response
     }
 
+# 批量检测一次最多的消息数，更多的消息用流式接口
+MAX_BATCH_SIZE = 10000
+# 流式接口每次检测的消息数
+STREAM_CHUNK_SIZE = 1000
+
+class BatchEmotionRequest(BaseModel):
+    messages: List[str]
+
+@router.post("/api/emotion/detect/batch")
+def detect_emotion_batch(request: BatchEmotionRequest):
+    """批量情绪检测接口"""
+    if len(request.messages) > MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=413,
+            detail=f"一次最多 {MAX_BATCH_SIZE} 条消息，更多请使用 /api/emotion/detect/batch/stream"
+        )
+    labels, scores = EmotionEngine.detect_many(request.messages)
+    return {
+        "emotions": [LABELS[label] for label in labels],
+        "scores": scores.tolist()
+    }
+
+@router.post("/api/emotion/detect/batch/stream")
+async def detect_emotion_stream(request: Request):
+    """
+    流式批量情绪检测接口
+    请求体是NDJSON，每行一个JSON字符串或 {"message": ...}；
+    响应也是NDJSON，每行 {"emotion": ..., "score": ...}，顺序和请求一致；
+    无法解析或缺少 message 的行输出 {"error": ..., "line": 行号}，不影响其他行。
+    边读请求体边按块检测、逐块返回，不会同时持有全部消息的解析结果和全部检测结果
+    """
+    body_read = anyio.Event()
+
+    async def results() -> AsyncIterator[str]:
+        chunk = []
+        try:
+            async for number, line in _aiter_lines(request.stream()):
+                chunk.append(_parse_line(number, line))
+                if len(chunk) >= STREAM_CHUNK_SIZE:
+                    yield await run_in_threadpool(_format_chunk, chunk)
+                    chunk = []
+        finally:
+            body_read.set()
+        if chunk:
+            yield await run_in_threadpool(_format_chunk, chunk)
+
+    return _DuplexStreamingResponse(results(), body_read, media_type="application/x-ndjson")
+
+class _DuplexStreamingResponse(StreamingResponse):
+    """
+    边读请求体边返回的流式响应
+    StreamingResponse 发送期间会并发地 receive() 监听客户端断开，这会吃掉还没读取的请求体，
+    所以等请求体读完（body_read）之后再开始监听；读取期间客户端断开时 request.stream() 自己会报错
+    """
+
+    def __init__(self, content: AsyncIterator[str], body_read: anyio.Event, **kwargs):
+        super().__init__(content, **kwargs)
+        self.body_read = body_read
+
+    async def listen_for_disconnect(self, receive):
+        await self.body_read.wait()
+        await super().listen_for_disconnect(receive)
+
+async def _aiter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, bytes]]:
+    """逐行遍历流式的请求体，产出 (行号, 内容)，跳过空行"""
+    buffer = b""
+    number = 0
+    async for data in chunks:
+        buffer += data
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            number += 1
+            line = line.strip()
+            if line:
+                yield number, line
+    line = buffer.strip()
+    if line:
+        yield number + 1, line
+
+def _parse_line(number: int, line: bytes) -> Union[str, dict]:
+    """解析一行，返回消息；解析失败时返回错误记录"""
+    try:
+        item = json.loads(line)
+    except ValueError as e:
+        return {"error": f"无法解析的JSON: {e}", "line": number}
+    message = item.get("message") if isinstance(item, dict) else item
+    if not isinstance(message, str):
+        return {"error": "需要JSON字符串或带 message 字段的对象", "line": number}
+    return message
+
+def _format_chunk(items: List[Union[str, dict]]) -> str:
+    """检测一块消息并输出为NDJSON，错误记录原样输出"""
+    labels, scores = emotion_lexicon.detect_many([item for item in items if isinstance(item, str)])
+    detected = iter(zip(labels, scores))
+    records = []
+    for item in items:
+        if isinstance(item, str):
+            label, score = next(detected)
+            item = {"emotion": LABELS[label], "score": score}
+        records.append(json.dumps(item, ensure_ascii=False) + "\n")
+    return "".join(records)
+
 # ==================== 提醒建议接口 ====================
 
 @router.get("/api/reminder/suggestions")
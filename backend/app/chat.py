@@ -4,8 +4,17 @@
 """
 import os
 import json
-from typing import List, Dict
-from .memory import get_user, get_memories, add_memory, update_emotion
+from typing import List, Dict, Iterator, Optional, Tuple
+from cache import ResponseCache
+from llm import LLMManager, MockProvider
+from .memory import get_user, get_version, load_candidates, retrieve_memories, add_memory, update_emotion
+from .prompt_cache import PromptCache
+from .conversation import conversation_store
+from .summarizer import ConversationSummarizer
+from .tokens import MESSAGE_OVERHEAD_TOKENS, count_tokens, pack, prompt_budget
+from .storage import unit_of_work
+from .lexicon import emotion_lexicon
+from .semantic import SemanticCache, embedding_encoder
 
 # 默认的Prompt模板
 SYSTEM_PROMPT = """你是一个温暖、友好的AI伙伴，名叫"小白"。
@@ -26,69 +35,226 @@ SYSTEM_PROMPT = """你是一个温暖、友好的AI伙伴，名叫"小白"。
 
 请根据以上信息，用最适合的方式回复用户。"""
 
+# 有对话摘要时追加在系统prompt之后
+SUMMARY_SECTION = """
+
+之前对话的摘要：
+{summary}"""
+
+# 发给LLM的历史消息最多占多少token
+HISTORY_MAX_TOKENS = int(os.getenv("HISTORY_MAX_TOKENS", "1000"))
+# 参与挑选的候选记忆数、最多放进prompt的记忆数，记忆最多占剩余预算的比例和token数
+MEMORY_CANDIDATES = 50
+MEMORY_LIMIT = 10
+MEMORY_BUDGET_SHARE = 0.5
+MEMORY_MAX_TOKENS = int(os.getenv("MEMORY_MAX_TOKENS", "300"))
+
+# 回复缓存：确定性的模板回复按 人设+消息+情绪 在用户之间共享；
+# LLM的回复可能提到用户的名字和记忆，只在同一用户内复用，且只缓存问候、问名字这类短消息
+RESPONSE_CACHE_MAX_CHARS = 16
+response_cache = ResponseCache(
+    max_entries=int(os.getenv("RESPONSE_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("RESPONSE_CACHE_TTL", "3600")),
+    enabled=os.getenv("RESPONSE_CACHE", "1") == "1"
+)
+
+# 语义回复缓存：LLM回复按规范化消息的向量近邻复用，"在吗"和"在不在呀"共用一条；
+# SEMANTIC_CACHE_DISABLED_PERSONAS 列出不使用语义缓存的人设（Provider类名:模型，逗号分隔）
+semantic_cache = SemanticCache(
+    encoder=embedding_encoder,
+    threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.9")),
+    max_entries=int(os.getenv("SEMANTIC_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("RESPONSE_CACHE_TTL", "3600")),
+    disabled_personas=[p for p in os.getenv("SEMANTIC_CACHE_DISABLED_PERSONAS", "").split(",") if p],
+    enabled=os.getenv("SEMANTIC_CACHE", "1") == "1"
+)
+
+# 按用户缓存prompt中和消息无关的部分，用户资料或记忆变化时失效
+prompt_cache = PromptCache(get_version, max_users=int(os.getenv("PROMPT_CACHE_USERS", "10000")))
+
 def detect_emotion(message: str) -> str:
-    """简单的情绪检测"""
-    message_lower = message.lower()
-    
-    positive_words = ["开心", "高兴", "快乐", "棒", "好", "喜欢", "谢谢", "爱你", "优秀", "赞"]
-    negative_words = ["难过", "伤心", "哭", "累", "烦", "郁闷", "生气", "愤怒", "失望", "沮丧"]
-    
-    for word in positive_words:
-        if word in message_lower:
-            return "positive"
-    
-    for word in negative_words:
-        if word in message_lower:
-            return "negative"
-    
-    return "neutral"
+    """情绪检测，词典和 EmotionEngine 共用"""
+    return emotion_lexicon.detect(message)
+
+# 记忆之前的部分只依赖用户资料，和候选记忆一起按用户缓存
+_PROMPT_HEAD, _PROMPT_TAIL = SYSTEM_PROMPT.split("{memories}")
 
-def build_prompt(user_id: str, message: str) -> str:
-    """构建完整的Prompt"""
+def _prompt_context(user_id: str) -> tuple:
+    """prompt中和消息无关的部分: (格式化好的开头, 候选记忆)"""
     # 获取用户信息
     user = get_user(user_id)
     if not user:
         user = {"name": "用户", "emotion_state": "neutral"}
     
-    # 获取记忆
-    memories = get_memories(user_id)
-    memory_text = "\n".join([f"- {m['content']}" for m in memories[:10]]) if memories else "暂无记忆"
-    
-    # 构建Prompt
-    prompt = SYSTEM_PROMPT.format(
+    head = _PROMPT_HEAD.format(
         user_name=user.get("name", "用户"),
-        emotion_state=user.get("emotion_state", "neutral"),
-        memories=memory_text
+        emotion_state=user.get("emotion_state", "neutral")
     )
+    return head, load_candidates(user_id)
+
+def _model() -> Optional[str]:
+    """当前LLM的模型名，模板回复等本地Provider没有"""
+    return getattr(llm_manager.provider, "model", None)
+
+def _memory_tokens(memory: dict) -> int:
+    """一条记忆在prompt中占的token数（含"- "前缀和换行）"""
+    return count_tokens(memory["content"]) + 1
+
+def _build_system(user_id: str, message: str, max_tokens: Optional[int], extra: str = "") -> Tuple[str, int]:
+    """
+    构建系统prompt，返回 (系统prompt, 剩余给历史消息的token数)
+
+    人设、extra（对话摘要）和当前消息必须放进去；记忆从相关度最高的 MEMORY_CANDIDATES 条中
+    按 得分/token 贪心装入剩余预算的 MEMORY_BUDGET_SHARE（不超过 MEMORY_MAX_TOKENS），
+    没用完的预算留给历史消息
+    """
+    head, candidates = prompt_cache.get(user_id, lambda: _prompt_context(user_id))
+    remaining = (prompt_budget(_model(), max_tokens) - count_tokens(head) - count_tokens(_PROMPT_TAIL)
+                 - count_tokens(extra) - count_tokens(message) - 2 * MESSAGE_OVERHEAD_TOKENS)
+    
+    # 获取和当前消息最相关的记忆，在预算内挑选
+    memories = retrieve_memories(user_id, message, limit=MEMORY_CANDIDATES, base=candidates, with_score=True)
+    memory_budget = max(0, min(MEMORY_MAX_TOKENS, int(remaining * MEMORY_BUDGET_SHARE)))
+    memories = pack(memories, memory_budget, cost=_memory_tokens, value=lambda m: m["score"], max_items=MEMORY_LIMIT)
+    remaining -= sum(_memory_tokens(m) for m in memories)
+    memory_text = "\n".join([f"- {m['content']}" for m in memories]) if memories else "暂无记忆"
     
-    return prompt
+    return head + memory_text + _PROMPT_TAIL + extra, remaining
 
-def chat(user_id: str, message: str) -> dict:
+def build_prompt(user_id: str, message: str, max_tokens: int = None) -> str:
+    """构建完整的Prompt，max_tokens 默认为当前模型的prompt预算"""
+    return _build_system(user_id, message, max_tokens)[0]
+
+def build_messages(user_id: str, message: str, max_tokens: int = None) -> List[Dict]:
     """
-    处理对话
-    返回: {"reply": str, "emotion": str}
+    构建发给LLM的消息列表：系统prompt（含对话摘要）、摘要之后的最近对话、当前消息
+    总token数不超过当前模型的prompt预算（人设和当前消息本身超出预算时除外）
+    """
+    summary = conversation_summarizer.get(user_id)
+    extra = SUMMARY_SECTION.format(summary=summary["summary"]) if summary else ""
+    system, remaining = _build_system(user_id, message, max_tokens, extra)
+    after = summary["last_message_id"] if summary else 0
+    history_budget = max(0, min(HISTORY_MAX_TOKENS, remaining))
+    return (
+        [{"role": "system", "content": system}]
+        + conversation_store.context(user_id, history_budget, after=after)
+        + [{"role": "user", "content": message}]
+    )
+
+def _cache_scope(user_id: str, message: str) -> Optional[Tuple[str, str]]:
+    """
+    回复缓存的分区 (人设, 分区)；不能使用缓存时（消息太长、用户关闭了缓存）返回None
+    人设是Provider和模型；分区为空表示在用户之间共享，LLM回复的分区是用户id
+    """
+    if not (response_cache.enabled or semantic_cache.enabled):
+        return None
+    provider = llm_manager.provider
+    persona = f"{type(provider).__name__}:{getattr(provider, 'model', None) or ''}"
+    partition = ""
+    if not getattr(provider, "deterministic", False):
+        if len(ResponseCache.normalize(message)) > RESPONSE_CACHE_MAX_CHARS:
+            return None
+        partition = user_id
+    user = get_user(user_id)
+    if user and user["preference"].get("response_cache") is False:
+        return None
+    return persona, partition
+
+def _cached_reply(scope: Optional[Tuple[str, str]], message: str, emotion: str) -> Optional[str]:
+    return response_cache.get("|".join(scope), message, emotion) if scope else None
+
+def _cache_reply(scope: Optional[Tuple[str, str]], message: str, emotion: str, reply: str):
+    # Provider调用失败时返回的是兜底回复，不缓存
+    if scope and reply and not llm_manager.is_fallback(reply):
+        response_cache.set("|".join(scope), message, emotion, reply)
+
+def _semantic_scope(scope: Optional[Tuple[str, str]]) -> Optional[Tuple[str, str]]:
+    """语义缓存只用于LLM回复，模板回复本身足够快"""
+    return scope if scope and not getattr(llm_manager.provider, "deterministic", False) else None
+
+def begin_turn(user_id: str, message: str) -> Dict:
+    """
+    一轮对话的第一段（阻塞，读写数据库）：检测情绪，查回复缓存，未命中时构建发给LLM的消息
+    返回 {"emotion", "scope", "cache_scope", "reply", "messages"}；reply 不为None时是缓存的回复，
+    否则用 messages 调用LLM，并把 cache_scope 传给 llm_manager 查语义缓存
     """
-    # 检测用户情绪
     user_emotion = detect_emotion(message)
     update_emotion(user_id, user_emotion)
     
-    # 构建Prompt
-    system_prompt = build_prompt(user_id, message)
-    
-    # 这里可以接入真实的LLM API
-    # 目前返回模拟回复
-    
-    # 简单模拟回复
-    reply = generate_reply(message, user_emotion)
+    scope = _cache_scope(user_id, message)
+    turn = {"emotion": user_emotion, "scope": scope, "cache_scope": _semantic_scope(scope),
+            "reply": _cached_reply(scope, message, user_emotion), "messages": None}
+    if turn["reply"] is None:
+        turn["messages"] = build_messages(user_id, message)
+    return turn
+
+def end_turn(user_id: str, message: str, turn: Dict, reply: str) -> List[Dict]:
+    """
+    一轮对话的最后一段（阻塞）：缓存回复，本轮的写入在一个事务中完成，只提交一次；返回保存的记忆
+    """
+    if turn["reply"] is None:
+        _cache_reply(turn["scope"], message, turn["emotion"], reply)
     
-    # 提取重要信息并存储为记忆
-    extract_and_save_memory(user_id, message)
+    # 保存本轮对话，提取重要信息并存储为记忆
+    with unit_of_work():
+        conversation_store.append_turn(user_id, message, reply)
+        memories = extract_and_save_memory(user_id, message)
+    conversation_summarizer.notify(user_id)
+    return memories
+
+def turn_events(turn: Dict, reply: str, memories: List[Dict]) -> List[Dict]:
+    """流式对话在回复之后产出的事件"""
+    return [
+        {"event": "emotion", "data": {"emotion": turn["emotion"]}},
+        {"event": "memory", "data": {"memories": memories}},
+        {"event": "done", "data": {"reply": reply, "emotion": turn["emotion"]}}
+    ]
+
+def chat(user_id: str, message: str) -> dict:
+    """
+    处理对话
+    返回: {"reply": str, "emotion": str}
+
+    LLM调用耗时不定，不放在事务中，避免长时间占用写锁；
+    回复生成后，本轮的写入在一个事务中完成，只提交一次
+    """
+    turn = begin_turn(user_id, message)
+    reply = turn["reply"]
+    if reply is None:
+        reply = llm_manager.chat(turn["messages"], cache_scope=turn["cache_scope"])
+    end_turn(user_id, message, turn, reply)
     
     return {
         "reply": reply,
-        "emotion": user_emotion
+        "emotion": turn["emotion"]
     }
 
+def chat_stream(user_id: str, message: str) -> Iterator[Dict]:
+    """
+    流式处理对话，依次产出事件:
+    - {"event": "token", "data": {"text": ...}}  回复片段，LLM每生成一段产出一次
+    - {"event": "emotion", "data": {"emotion": ...}}
+    - {"event": "memory", "data": {"memories": [...]}}  本轮保存的记忆
+    - {"event": "done", "data": {"reply": ..., "emotion": ...}}
+
+    和 chat() 一样，生成回复期间不持有事务；
+    每段数据库读写都在两次产出之间完成，生成器可以在不同线程中推进
+    """
+    turn = begin_turn(user_id, message)
+    reply = turn["reply"]
+    if reply is not None:
+        # 命中缓存时整段产出
+        yield {"event": "token", "data": {"text": reply}}
+    else:
+        parts = []
+        for text in llm_manager.stream(turn["messages"], cache_scope=turn["cache_scope"]):
+            parts.append(text)
+            yield {"event": "token", "data": {"text": text}}
+        reply = "".join(parts)
+    
+    memories = end_turn(user_id, message, turn, reply)
+    yield from turn_events(turn, reply, memories)
+
 def generate_reply(message: str, emotion: str) -> str:
     """生成回复（模拟版本）"""
     message_lower = message.lower()
@@ -130,15 +296,48 @@ def generate_reply(message: str, emotion: str) -> str:
     ]
     return responses[hash(message) % len(responses)]
 
-def extract_and_save_memory(user_id: str, message: str):
-    """提取并保存重要信息作为记忆"""
+def extract_and_save_memory(user_id: str, message: str) -> List[Dict]:
+    """提取并保存重要信息作为记忆，返回保存的记忆"""
+    memories = []
     # 简单的关键词提取
     if "我叫" in message or "我叫" in message:
         name = message.replace("我叫", "").strip()
-        add_memory(user_id, f"用户名叫{name}", "preference", 5)
+        memories.append(add_memory(user_id, f"用户名叫{name}", "preference", 5))
     
     if "喜欢" in message:
-        add_memory(user_id, f"用户提到喜欢{message}", "preference", 3)
+        memories.append(add_memory(user_id, f"用户提到喜欢{message}", "preference", 3))
     
     if "讨厌" in message or "不喜欢" in message:
-        add_memory(user_id, f"用户不喜欢{message}", "preference", 3)
+        memories.append(add_memory(user_id, f"用户不喜欢{message}", "preference", 3))
+    
+    return memories
+
+
+class TemplateProvider(MockProvider):
+    """内置的模板回复（generate_reply），没有配置 LLM_PROVIDER 时使用，支持流式输出"""
+    
+    # 同样的消息和情绪总是得到同样的回复，回复缓存可以在用户之间共享
+    deterministic = True
+    
+    def chat(self, messages: List[Dict], **kwargs) -> str:
+        message = messages[-1]["content"] if messages else ""
+        return generate_reply(message, detect_emotion(message))
+
+
+# 对话使用的LLM，LLM_PROVIDER 可选 openai/claude/deepseek/mock，
+# 逗号分隔多个时（如 deepseek,openai）按延迟路由、失败切换并对冲慢请求
+# 相同prompt的并发请求合并为一次调用，LLM_COALESCE=0 关闭；
+# LLM_BATCH_SIZE 大于1时攒批调用Provider，最多等待 LLM_BATCH_WAIT_MS 毫秒
+llm_manager = LLMManager(
+    os.getenv("LLM_PROVIDER") or TemplateProvider(),
+    semantic_cache=semantic_cache,
+    coalesce=os.getenv("LLM_COALESCE", "1") == "1",
+    batch_size=int(os.getenv("LLM_BATCH_SIZE", "0")),
+    batch_wait=float(os.getenv("LLM_BATCH_WAIT_MS", "10")) / 1000
+)
+
+# 后台滚动摘要，配置了 LLM_PROVIDER 时用LLM生成，否则按用户消息抽取
+conversation_summarizer = ConversationSummarizer(
+    llm_manager if os.getenv("LLM_PROVIDER") else None,
+    every_turns=int(os.getenv("SUMMARY_EVERY_TURNS", "6"))
+)
@@ -0,0 +1,215 @@
+"""
+记忆压缩任务
+定期衰减记忆的重要性，把低重要性的旧记忆合并成摘要，把冷记忆移到归档表
+
+- 增量执行：每批只处理少量行，每批一个短事务，批之间让出写锁
+- 可恢复：游标保存在 job_cursors 表，中断或重启后从上次的位置继续
+"""
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Callable, List, Optional
+
+from . import dedup, semantic
+from .memory import bump_version
+from .storage import get_pool
+
+# 多久没有被强化（重复提到）就把重要性降一级（天）
+DECAY_AFTER_DAYS = 30
+# 重要性降到1、且创建超过多少天的记忆参与合并（天）
+MERGE_AFTER_DAYS = 60
+# 没能合并的低重要性记忆，创建超过多少天后直接归档（天）
+ARCHIVE_AFTER_DAYS = 180
+# 一条摘要最多合并多少条记忆、摘要内容的最大长度
+MERGE_GROUP_SIZE = 20
+SUMMARY_MAX_CHARS = 500
+# 摘要记忆的重要性
+SUMMARY_IMPORTANCE = 2
+
+
+class MemoryCompactor:
+    """
+    记忆压缩
+
+    一次 run() 依次执行两个阶段，每个阶段最多处理 max_batches 批：
+    - decay: 按rowid区间扫描，超过 DECAY_AFTER_DAYS 没有强化的记忆重要性减1（最低1）
+    - merge: 按用户扫描，同一用户同类型的低重要性旧记忆合并成一条摘要，原记忆归档；
+      合并不了、超过 ARCHIVE_AFTER_DAYS 的低重要性记忆直接归档
+
+    每批的行数按写锁时长控制在几毫秒：衰减只改一列，合并要删除记忆并更新全文索引，
+    所以合并的批更小
+    """
+
+    def __init__(self, decay_batch_size: int = 100, merge_batch_size: int = 25,
+                 max_batches: int = 500, pause: float = 0.01):
+        self.decay_batch_size = decay_batch_size
+        self.merge_batch_size = merge_batch_size
+        self.max_batches = max_batches
+        self.pause = pause
+        self.runs = 0
+        self.batches = 0
+        self.decayed = 0
+        self.merged = 0
+        self.summaries = 0
+        self.archived = 0
+        self.max_batch_ms = 0.0
+
+    def run(self, now: datetime = None) -> dict:
+        """执行一次压缩，返回本次处理的行数"""
+        now = now or datetime.now()
+        before = (self.decayed, self.merged, self.archived)
+        self._run_phase("decay", self._decay_batch, now)
+        self._run_phase("merge", self._merge_batch, now)
+        self.runs += 1
+        return {
+            "decayed": self.decayed - before[0],
+            "merged": self.merged - before[1],
+            "archived": self.archived - before[2]
+        }
+
+    def _run_phase(self, job: str, batch: Callable, now: datetime):
+        """按批执行一个阶段，扫描完一轮后游标归零，下次run重新开始"""
+        for _ in range(self.max_batches):
+            cursor = get_cursor(job)
+            t0 = time.perf_counter()
+            with get_pool().transaction(immediate=True) as conn:
+                next_cursor = batch(conn, cursor, now)
+                _save_cursor(conn, job, next_cursor, now)
+            self._record_batch((time.perf_counter() - t0) * 1000)
+            if next_cursor is None:
+                return
+            # 批之间让出写锁，对话请求不会被压缩任务长时间阻塞
+            time.sleep(self.pause)
+
+    def _record_batch(self, elapsed_ms: float):
+        self.batches += 1
+        self.max_batch_ms = max(self.max_batch_ms, elapsed_ms)
+
+    def _decay_batch(self, conn, cursor: Optional[str], now: datetime) -> Optional[str]:
+        """衰减 rowid 在 (cursor, cursor + decay_batch_size] 内的记忆，扫描完返回None"""
+        start = int(cursor or 0)
+        end = start + self.decay_batch_size
+        cutoff = (now - timedelta(days=DECAY_AFTER_DAYS)).isoformat()
+        updated = conn.execute(
+            "UPDATE memories SET importance = importance - 1, decayed_at = ? "
+            "WHERE rowid > ? AND rowid <= ? AND importance > 1 "
+            "AND MAX(COALESCE(updated_at, created_at), COALESCE(decayed_at, '')) < ?",
+            (now.isoformat(), start, end, cutoff)
+        ).rowcount
+        self.decayed += updated
+        if updated:
+            # 一批可能涉及很多用户，直接递增全局版本
+            get_pool().after_commit(bump_version)
+        last = conn.execute("SELECT MAX(rowid) FROM memories").fetchone()[0] or 0
+        return str(end) if end < last else None
+
+    def _merge_batch(self, conn, cursor: Optional[str], now: datetime) -> Optional[str]:
+        """
+        处理下一个用户的一批低重要性旧记忆
+        返回值是下一批的游标：同一用户还有剩余时不前进，所有用户处理完返回None
+        """
+        row = conn.execute(
+            "SELECT user_id FROM memories WHERE user_id > ? ORDER BY user_id LIMIT 1",
+            (cursor or "",)
+        ).fetchone()
+        if row is None:
+            return None
+        user_id = row[0]
+
+        merge_cutoff = (now - timedelta(days=MERGE_AFTER_DAYS)).isoformat()
+        rows = conn.execute(
+            "SELECT memory_id, user_id, content, memory_type, importance, created_at, updated_at "
+            "FROM memories WHERE user_id = ? AND importance <= 1 AND created_at < ? "
+            "ORDER BY memory_type, created_at LIMIT ?",
+            (user_id, merge_cutoff, self.merge_batch_size)
+        ).fetchall()
+
+        groups = defaultdict(list)
+        for memory in rows:
+            groups[memory[3]].append(memory)
+
+        archive_cutoff = (now - timedelta(days=ARCHIVE_AFTER_DAYS)).isoformat()
+        changed = 0
+        for memory_type, memories in groups.items():
+            for i in range(0, len(memories), MERGE_GROUP_SIZE):
+                group = memories[i:i + MERGE_GROUP_SIZE]
+                if len(group) > 1:
+                    summary_id = _insert_summary(conn, user_id, memory_type, group, now)
+                    _archive(conn, group, now, summary_id)
+                    self.archived += len(group)
+                    self.merged += len(group)
+                    self.summaries += 1
+                    changed += len(group)
+                elif group[0][5] < archive_cutoff:
+                    _archive(conn, group, now)
+                    self.archived += 1
+                    changed += 1
+
+        if changed:
+            # 提交后再失效：提交前失效的话，并发的检索可能从未提交的旧数据重新加载，缓存已合并、已删除的向量
+            get_pool().after_commit(lambda: semantic.semantic_index.invalidate(user_id))
+            get_pool().after_commit(lambda: bump_version(user_id))
+        # 这一批取满且有进展时，同一用户可能还有剩余，下次继续处理这个用户
+        if len(rows) == self.merge_batch_size and changed:
+            return cursor or ""
+        return user_id
+
+    def get_stats(self) -> dict:
+        """压缩统计"""
+        return {
+            "runs": self.runs,
+            "batches": self.batches,
+            "decayed": self.decayed,
+            "merged": self.merged,
+            "summaries": self.summaries,
+            "archived": self.archived,
+            "max_batch_ms": round(self.max_batch_ms, 3)
+        }
+
+
+def _insert_summary(conn, user_id: str, memory_type: str, group: List[tuple], now: datetime) -> str:
+    """把一组记忆合并成一条摘要记忆，返回摘要的memory_id"""
+    content = "；".join(memory[2] for memory in group)
+    if len(content) > SUMMARY_MAX_CHARS:
+        content = content[:SUMMARY_MAX_CHARS - 1] + "…"
+    summary_id = str(uuid.uuid4())
+    # 摘要沿用被合并记忆中最新的时间，不会因为合并而显得更新
+    created_at = max(memory[5] for memory in group)
+    conn.execute(
+        "INSERT INTO memories (memory_id, user_id, content, memory_type, importance, created_at, updated_at, "
+        "content_hash, simhash, decayed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (summary_id, user_id, content, memory_type, SUMMARY_IMPORTANCE, created_at, created_at,
+         dedup.content_hash(content), dedup.simhash(content), now.isoformat())
+    )
+    return summary_id
+
+
+def _archive(conn, group: List[tuple], now: datetime, summary_id: str = None):
+    """把记忆移到归档表"""
+    archived_at = now.isoformat()
+    conn.executemany(
+        "INSERT OR REPLACE INTO memories_archive (memory_id, user_id, content, memory_type, importance, "
+        "created_at, updated_at, archived_at, summary_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        [tuple(memory) + (archived_at, summary_id) for memory in group]
+    )
+    conn.executemany("DELETE FROM memories WHERE memory_id = ?", [(memory[0],) for memory in group])
+
+
+def get_cursor(job: str) -> Optional[str]:
+    """读取任务游标"""
+    with get_pool().connection() as conn:
+        row = conn.execute("SELECT cursor FROM job_cursors WHERE job = ?", (job,)).fetchone()
+    return row[0] if row else None
+
+
+def _save_cursor(conn, job: str, cursor: Optional[str], now: datetime):
+    conn.execute(
+        "INSERT INTO job_cursors (job, cursor, updated_at) VALUES (?, ?, ?) "
+        "ON CONFLICT(job) DO UPDATE SET cursor = excluded.cursor, updated_at = excluded.updated_at",
+        (job, cursor, now.isoformat())
+    )
+
+
+# 全局压缩任务
+compactor = MemoryCompactor()
@@ -0,0 +1,192 @@
+"""
+对话历史
+消息只追加写入 messages 表；每个用户最近的若干条消息保存在内存环形缓冲中，
+构建LLM上下文时按token预算从最新往前截取，不需要扫描历史
+"""
+import os
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from .models import Conversation, Message
+from .storage import get_pool
+from .tokens import MESSAGE_OVERHEAD_TOKENS, count_tokens
+
+# 每个用户在内存中保留的最近消息数
+HISTORY_WINDOW = 20
+
+
+class _History:
+    """单个用户的环形缓冲；loaded 为False时表示还在从数据库加载"""
+
+    __slots__ = ("messages", "loaded")
+
+    def __init__(self, window: int):
+        self.messages = deque(maxlen=window)
+        self.loaded = False
+
+
+class ConversationStore:
+    """
+    对话历史存储
+
+    - append() 插入一行，提交后追加到用户的环形缓冲（deque，满了自动丢弃最旧的），均摊O(1)
+    - recent() 读缓冲；用户不在缓冲中时按 (user_id, message_id) 索引倒序取最近 window 条
+    - 缓冲最多保留 max_users 个用户，超出时淘汰最久未使用的
+    """
+
+    def __init__(self, window: int = HISTORY_WINDOW, max_users: int = 10000):
+        self.window = window
+        self.max_users = max_users
+        self._users = OrderedDict()  # user_id -> _History
+        self._lock = threading.Lock()
+        self.appends = 0
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def append(self, user_id: str, role: str, content: str) -> dict:
+        """追加一条消息；在事务中调用时，提交后才进入缓冲"""
+        now = datetime.now().isoformat()
+        with get_pool().transaction() as conn:
+            cursor = conn.execute(
+                "INSERT INTO messages (user_id, role, content, created_at) VALUES (?, ?, ?, ?)",
+                (user_id, role, content, now)
+            )
+            message = {"message_id": cursor.lastrowid, "role": role, "content": content, "created_at": now}
+            get_pool().after_commit(lambda: self._push(user_id, message))
+        self.appends += 1
+        return message
+
+    def append_turn(self, user_id: str, message: str, reply: str) -> List[dict]:
+        """追加一轮对话（用户消息和回复），两条消息在同一个事务中写入"""
+        with get_pool().transaction():
+            return [self.append(user_id, "user", message), self.append(user_id, "assistant", reply)]
+
+    def _push(self, user_id: str, message: dict):
+        with self._lock:
+            history = self._users.get(user_id)
+            if history is None:
+                # 不在缓冲中，下次读取时从数据库加载
+                return
+            messages = history.messages
+            messages.append(message)
+            # 并发事务的提交回调可能乱序，按消息id恢复顺序
+            if len(messages) > 1 and messages[-2]["message_id"] > message["message_id"]:
+                ordered = sorted(messages, key=lambda m: m["message_id"])
+                messages.clear()
+                messages.extend(ordered)
+
+    def recent(self, user_id: str, n: int = None) -> List[dict]:
+        """用户最近 n 条消息（默认 window 条），按时间正序"""
+        n = self.window if n is None else n
+        if n <= 0:
+            return []
+        if n > self.window:
+            return self.history(user_id, limit=n)
+
+        with self._lock:
+            history = self._users.get(user_id)
+            if history is not None and history.loaded:
+                self._users.move_to_end(user_id)
+                self.hits += 1
+                return list(history.messages)[-n:]
+            if history is None:
+                # 先占位，加载期间提交的消息由 _push 追加到占位的缓冲中
+                history = _History(self.window)
+                self._users[user_id] = history
+                self._evict()
+
+        rows = self.history(user_id, limit=self.window)
+        with self._lock:
+            if not history.loaded:
+                last_id = rows[-1]["message_id"] if rows else 0
+                pending = [m for m in history.messages if m["message_id"] > last_id]
+                history.messages.clear()
+                history.messages.extend(rows)
+                history.messages.extend(sorted(pending, key=lambda m: m["message_id"]))
+                history.loaded = True
+                self.loads += 1
+            return list(history.messages)[-n:]
+
+    def history(self, user_id: str, limit: int = 50, before: Optional[int] = None) -> List[dict]:
+        """
+        从数据库读取历史消息，按时间正序
+        before 为消息id，用于向前翻页：返回 message_id < before 的最近 limit 条
+        """
+        with get_pool().connection() as conn:
+            rows = conn.execute(
+                "SELECT message_id, role, content, created_at FROM messages "
+                "WHERE user_id = ? AND message_id < ? ORDER BY message_id DESC LIMIT ?",
+                (user_id, before if before is not None else 2 ** 63 - 1, limit)
+            ).fetchall()
+        return [
+            {"message_id": row[0], "role": row[1], "content": row[2], "created_at": row[3]}
+            for row in reversed(rows)
+        ]
+
+    def context(self, user_id: str, max_tokens: int, after: int = 0) -> List[Dict]:
+        """
+        构建LLM上下文用的历史消息 [{"role", "content"}]
+        从最新的消息往前取，总token数不超过 max_tokens；只取完整的消息
+        after 为已折叠进摘要的最后一条消息id，这条及之前的消息不再放进上下文
+        """
+        selected = []
+        used = 0
+        for message in reversed(self.recent(user_id)):
+            if message["message_id"] <= after:
+                break
+            cost = count_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+            if used + cost > max_tokens:
+                break
+            selected.append({"role": message["role"], "content": message["content"]})
+            used += cost
+        selected.reverse()
+        return selected
+
+    def get_conversation(self, user_id: str, limit: int = 50) -> Conversation:
+        """最近的对话，转换为 Conversation 模型"""
+        messages = self.recent(user_id, limit)
+        return Conversation(
+            conv_id=user_id,
+            user_id=user_id,
+            messages=[
+                Message(role=m["role"], content=m["content"], timestamp=m["created_at"])
+                for m in messages
+            ],
+            created_at=messages[0]["created_at"] if messages else None
+        )
+
+    def invalidate(self, user_id: str = None):
+        """丢弃用户（默认全部）的缓冲，下次读取时重新加载"""
+        with self._lock:
+            if user_id is None:
+                self._users.clear()
+            else:
+                self._users.pop(user_id, None)
+
+    def _evict(self):
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+            self.evictions += 1
+
+    def get_stats(self) -> dict:
+        """对话历史统计"""
+        reads = self.hits + self.loads
+        return {
+            "users_buffered": len(self._users),
+            "window": self.window,
+            "appends": self.appends,
+            "hits": self.hits,
+            "loads": self.loads,
+            "hit_ratio": round(self.hits / reads, 4) if reads else 0.0,
+            "evictions": self.evictions
+        }
+
+
+# 全局对话历史
+conversation_store = ConversationStore(
+    window=int(os.getenv("HISTORY_WINDOW", str(HISTORY_WINDOW))),
+    max_users=int(os.getenv("HISTORY_USERS", "10000"))
+)
@@ -0,0 +1,70 @@
+"""
+记忆去重
+规范化内容哈希用于精确去重，SimHash + 二元组Jaccard用于近似去重
+"""
+import hashlib
+import re
+import unicodedata
+from typing import Set
+
+SIMHASH_BITS = 64
+_MASK = (1 << SIMHASH_BITS) - 1
+
+
+def normalize(text: str) -> str:
+    """规范化：全角转半角、转小写、去掉标点和空白"""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    return "".join(re.findall(r"\w", text))
+
+
+def content_hash(text: str) -> str:
+    """规范化内容的哈希，内容只差标点、空白或大小写时相同"""
+    return hashlib.blake2b(normalize(text).encode("utf-8"), digest_size=8).hexdigest()
+
+
+def shingles(text: str) -> Set[str]:
+    """规范化内容的字符二元组"""
+    chars = normalize(text)
+    if len(chars) < 2:
+        return {chars} if chars else set()
+    return {chars[i:i + 2] for i in range(len(chars) - 1)}
+
+
+def simhash(text: str) -> int:
+    """
+    64位SimHash，相似内容的汉明距离小
+    返回有符号整数，便于存入SQLite的INTEGER列
+    """
+    weights = [0] * SIMHASH_BITS
+    for gram in shingles(text):
+        h = int.from_bytes(hashlib.blake2b(gram.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(SIMHASH_BITS):
+            weights[bit] += 1 if h >> bit & 1 else -1
+    value = sum(1 << bit for bit in range(SIMHASH_BITS) if weights[bit] > 0)
+    return value - (1 << SIMHASH_BITS) if value >> (SIMHASH_BITS - 1) else value
+
+
+def hamming(a: int, b: int) -> int:
+    """两个SimHash的汉明距离"""
+    return bin((a ^ b) & _MASK).count("1")
+
+
+def jaccard(a: Set[str], b: Set[str]) -> float:
+    """Jaccard相似度"""
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def backfill(conn, batch_size: int = 1000):
+    """为已有记忆补全 content_hash 和 simhash（schema迁移使用）"""
+    while True:
+        rows = conn.execute(
+            "SELECT rowid, content FROM memories WHERE content_hash IS NULL LIMIT ?", (batch_size,)
+        ).fetchall()
+        if not rows:
+            break
+        conn.executemany(
+            "UPDATE memories SET content_hash = ?, simhash = ? WHERE rowid = ?",
+            [(content_hash(content), simhash(content), rowid) for rowid, content in rows]
+        )
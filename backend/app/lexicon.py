@@ -0,0 +1,202 @@
+"""
+情绪词典匹配
+Aho-Corasick 自动机一次扫描找出消息中所有词典词，耗时只和消息长度有关，和词典大小无关
+chat.detect_emotion 和 EmotionEngine.detect_emotion 共用这里的词典
+"""
+import os
+import threading
+from array import array
+from collections import deque
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+# 情绪词及权重，正数为积极、负数为消极；"好"这类常作副词的词权重低一些
+POSITIVE_WORDS: Dict[str, float] = {
+    "开心": 1.0, "高兴": 1.0, "快乐": 1.0, "棒": 1.0, "好": 0.5, "喜欢": 1.0, "谢谢": 1.0,
+    "爱你": 2.0, "优秀": 1.0, "赞": 1.0, "哈哈": 1.0, "太好了": 2.0, "不错": 1.0,
+}
+NEGATIVE_WORDS: Dict[str, float] = {
+    "难过": -1.0, "伤心": -1.0, "哭": -1.0, "累": -1.0, "烦": -1.0, "郁闷": -1.0, "生气": -1.0,
+    "愤怒": -2.0, "失望": -1.0, "沮丧": -1.0, "烦死了": -2.0, "无语": -1.0,
+}
+# 否定词，作用于紧跟其后的情绪词，把它的分数反号
+NEGATIONS = ["不", "没", "没有", "别", "不是", "不太", "不怎么", "并不", "一点也不"]
+# 否定词结束到情绪词开始之间最多隔几个字
+NEGATION_WINDOW = 2
+
+# 批量检测返回的情绪编码
+LABELS = {1: "positive", -1: "negative", 0: "neutral"}
+
+
+class AhoCorasick:
+    """
+    多模式匹配自动机
+    add() 加入全部模式后调用 build()，之后 iter_matches() 只读，可多线程共用
+    """
+
+    def __init__(self):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[Tuple[str, object]]] = [[]]
+
+    def add(self, pattern: str, value: object = None):
+        """加入一个模式"""
+        state = 0
+        for char in pattern:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            state = next_state
+        self._output[state].append((pattern, value))
+
+    def build(self):
+        """按广度优先计算失败指针，并把失败链上的输出合并到每个状态"""
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+        return self
+
+    def iter_matches(self, text: str) -> Iterator[Tuple[int, int, str, object]]:
+        """扫描一遍文本，产出所有匹配 (start, end, pattern, value)"""
+        goto, fail, output = self._goto, self._fail, self._output
+        state = 0
+        for i, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for pattern, value in output[state]:
+                yield i + 1 - len(pattern), i + 1, pattern, value
+
+    @property
+    def states(self) -> int:
+        return len(self._goto)
+
+
+_NEGATION = object()
+
+
+class EmotionLexicon:
+    """
+    带权重和否定处理的情绪词典
+
+    - 重叠的匹配取最左最长，"烦死了"不会再算一次"烦"，"不错"不会被当成否定词"不"
+    - 否定词后 NEGATION_WINDOW 个字以内的情绪词分数反号，"不开心"算消极
+    - extend() 加入用户词典时先构建新自动机再整体替换，不影响正在进行的匹配
+    """
+
+    def __init__(self, terms: Dict[str, float] = None, negations: Iterable[str] = NEGATIONS,
+                 negation_window: int = NEGATION_WINDOW):
+        terms = terms if terms is not None else {**POSITIVE_WORDS, **NEGATIVE_WORDS}
+        self.terms: Dict[str, float] = {term.lower(): weight for term, weight in terms.items() if term}
+        self.negations = list(negations)
+        self.negation_window = negation_window
+        self._lock = threading.Lock()
+        self._automaton = self._build(self.terms)
+
+    def _build(self, terms: Dict[str, float]) -> AhoCorasick:
+        automaton = AhoCorasick()
+        for negation in self.negations:
+            if negation not in terms:
+                automaton.add(negation, _NEGATION)
+        for term, weight in terms.items():
+            automaton.add(term, weight)
+        return automaton.build()
+
+    def extend(self, terms: Dict[str, float]):
+        """加入或覆盖词条"""
+        with self._lock:
+            merged = {**self.terms, **{term.lower(): weight for term, weight in terms.items() if term}}
+            automaton = self._build(merged)
+            self.terms, self._automaton = merged, automaton
+
+    def matches(self, message: str) -> List[Tuple[int, int, str, object]]:
+        """消息中不重叠的词典匹配，取最左最长"""
+        found = sorted(self._automaton.iter_matches(message.lower()), key=lambda m: (m[0], -m[1]))
+        selected = []
+        end = 0
+        for match in found:
+            if match[0] >= end:
+                selected.append(match)
+                end = match[1]
+        return selected
+
+    def score(self, message: str) -> float:
+        """情绪分数，正数积极、负数消极"""
+        total = 0.0
+        negation_end: Optional[int] = None
+        for start, end, _term, value in self.matches(message):
+            if value is _NEGATION:
+                negation_end = end
+                continue
+            negated = negation_end is not None and start - negation_end <= self.negation_window
+            total += -value if negated else value
+            negation_end = None
+        return total
+
+    def detect(self, message: str) -> str:
+        """检测情绪: positive / negative / neutral"""
+        score = self.score(message)
+        if score > 0:
+            return "positive"
+        if score < 0:
+            return "negative"
+        return "neutral"
+
+    def detect_many(self, messages: Iterable[str]) -> Tuple[array, array]:
+        """
+        批量检测，返回 (情绪编码, 分数) 两个数组
+        编码是 array('b')，含义见 LABELS；分数是 array('f')。
+        两者都支持缓冲区协议，可以用 numpy.frombuffer 零拷贝转换
+        """
+        labels = array("b")
+        scores = array("f")
+        score = self.score
+        for message in messages:
+            value = score(message)
+            scores.append(value)
+            labels.append((value > 0) - (value < 0))
+        return labels, scores
+
+    def iter_detect(self, messages: Iterable[str], chunk_size: int = 1000) -> Iterator[Tuple[array, array]]:
+        """分块批量检测，逐块产出 detect_many 的结果，输入可以是任意长的迭代器"""
+        chunk = []
+        for message in messages:
+            chunk.append(message)
+            if len(chunk) >= chunk_size:
+                yield self.detect_many(chunk)
+                chunk = []
+        if chunk:
+            yield self.detect_many(chunk)
+
+    def get_stats(self) -> dict:
+        """词典统计"""
+        return {"terms": len(self.terms), "states": self._automaton.states}
+
+
+def load_terms(path: str) -> Dict[str, float]:
+    """读取用户词典，每行 "词<TAB>权重"，权重省略时为1；#开头的行是注释"""
+    terms = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            parts = line.split("\t")
+            terms[parts[0]] = float(parts[1]) if len(parts) > 1 else 1.0
+    return terms
+
+
+# 全局情绪词典，EMOTION_LEXICON_PATH 指定的用户词典会合并进来
+emotion_lexicon = EmotionLexicon()
+if os.getenv("EMOTION_LEXICON_PATH"):
+    emotion_lexicon.extend(load_terms(os.environ["EMOTION_LEXICON_PATH"]))
@@ -2,19 +2,31 @@
 随身AI伙伴后端服务
 FastAPI主入口
 """
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Optional
+from fastapi.responses import StreamingResponse
+from typing import AsyncIterator, Optional
+import json
+import os
+import sqlite3
 import uvicorn
 
+from scheduler import TaskScheduler
+
 from .models import ChatRequest, ChatResponse, Reminder
-from .chat import chat
-from .memory import get_user, create_user, get_memories, add_memory
+from .chat import (
+    begin_turn, conversation_summarizer, end_turn, llm_manager, prompt_cache, response_cache, semantic_cache, turn_events
+)
+from .memory import get_user, create_user, get_memories, add_memory, search_memories, update_preference, emotion_buffer
 from .reminder import add_reminder, get_reminders, delete_reminder, toggle_reminder
-from . import api扩展
-
-# 注册扩展API
-app.include_router(api扩展.router, prefix="", tags=["扩展功能"])
+from .storage import get_pool
+from .workers import BlockingExecutor, ServerBusy
+from .semantic import BatchingEncoder, embedding_encoder, semantic_index
+from .compaction import compactor
+from .conversation import conversation_store
+from .tokens import token_counter
+from .lexicon import emotion_lexicon
+from . import api扩展, metrics
 
 app = FastAPI(
     title="随身AI伙伴 API",
@@ -22,6 +34,9 @@ app = FastAPI(
     version="1.0.0"
 )
 
+# 注册扩展API
+app.include_router(api扩展.router, prefix="", tags=["扩展功能"])
+
 # CORS配置
 app.add_middleware(
     CORSMiddleware,
@@ -31,24 +46,147 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 对话中读写数据库的两段在独立线程池中执行，等待LLM回复时在事件循环中 await，不占用线程；
+# 线程数默认与数据库连接数一致，CHAT_WORKERS 可以单独设置
+chat_executor = BlockingExecutor(
+    max_workers=int(os.getenv("CHAT_WORKERS", str(get_pool().max_connections))), name="chat"
+)
+
+# 运行指标
+metrics.register("storage", lambda: get_pool().get_stats())
+metrics.register("chat_executor", chat_executor.get_stats)
+metrics.register("emotion_write_behind", emotion_buffer.get_stats)
+metrics.register("semantic_index", semantic_index.get_stats)
+metrics.register("compaction", compactor.get_stats)
+metrics.register("emotion_lexicon", emotion_lexicon.get_stats)
+metrics.register("prompt_cache", prompt_cache.get_stats)
+metrics.register("conversation", conversation_store.get_stats)
+metrics.register("conversation_summary", conversation_summarizer.get_stats)
+metrics.register("tokens", token_counter.get_stats)
+metrics.register("response_cache", response_cache.get_stats)
+metrics.register("semantic_cache", semantic_cache.get_stats)
+metrics.register("llm", llm_manager.get_stats)
+if isinstance(embedding_encoder, BatchingEncoder):
+    metrics.register("embedding_batching", embedding_encoder.get_stats)
+
+# 后台任务：记忆压缩，COMPACTION_INTERVAL=0 时关闭
+task_scheduler = TaskScheduler()
+
 # ==================== 对话接口 ====================
 
+def ensure_user(user_id: str):
+    """确保用户存在（同一新用户的并发请求可能同时创建）"""
+    user = get_user(user_id)
+    if not user:
+        try:
+            create_user(user_id)
+        except sqlite3.IntegrityError:
+            pass
+
+def begin_chat_turn(user_id: str, message: str) -> dict:
+    """一轮对话的第一段（阻塞），在 chat_executor 中执行"""
+    ensure_user(user_id)
+    return begin_turn(user_id, message)
+
+async def chat_turn(user_id: str, message: str) -> dict:
+    """
+    一轮完整对话
+    数据库读写在 chat_executor 中执行，排队已满时第一段抛出 ServerBusy；LLM调用在事件循环中等待
+    """
+    turn = await chat_executor.run(begin_chat_turn, user_id, message)
+    reply = turn["reply"]
+    if reply is None:
+        reply = await llm_manager.achat(turn["messages"], cache_scope=turn["cache_scope"])
+    await chat_executor.finish(end_turn, user_id, message, turn, reply)
+    return {"reply": reply, "emotion": turn["emotion"]}
+
+async def chat_events(user_id: str, message: str) -> AsyncIterator[dict]:
+    """
+    流式对话的事件，和 chat_stream() 相同
+    数据库读写在 chat_executor 中执行，线程池满时第一步就抛出 ServerBusy；回复片段在事件循环中逐段等待
+    """
+    turn = await chat_executor.run(begin_chat_turn, user_id, message)
+    reply = turn["reply"]
+    if reply is not None:
+        yield {"event": "token", "data": {"text": reply}}
+    else:
+        parts = []
+        async for text in llm_manager.astream(turn["messages"], cache_scope=turn["cache_scope"]):
+            parts.append(text)
+            yield {"event": "token", "data": {"text": text}}
+        reply = "".join(parts)
+    memories = await chat_executor.finish(end_turn, user_id, message, turn, reply)
+    for event in turn_events(turn, reply, memories):
+        yield event
+
 @app.post("/api/chat", response_model=ChatResponse)
 async def chat_endpoint(request: ChatRequest):
     """对话接口"""
-    # 确保用户存在
-    user = get_user(request.user_id)
-    if not user:
-        create_user(request.user_id)
-    
-    # 处理对话
-    result = chat(request.user_id, request.message)
+    try:
+        result = await chat_turn(request.user_id, request.message)
+    except ServerBusy:
+        raise HTTPException(status_code=503, detail="服务繁忙，请稍后再试")
     return ChatResponse(**result)
 
+@app.post("/api/chat/stream")
+async def chat_stream_endpoint(request: ChatRequest):
+    """流式对话接口（Server-Sent Events）"""
+    events = chat_events(request.user_id, request.message)
+    try:
+        first = await events.__anext__()
+    except ServerBusy:
+        raise HTTPException(status_code=503, detail="服务繁忙，请稍后再试")
+    
+    async def sse() -> AsyncIterator[str]:
+        event = first
+        while True:
+            yield f"event: {event['event']}\ndata: {json.dumps(event['data'], ensure_ascii=False)}\n\n"
+            try:
+                event = await events.__anext__()
+            except StopAsyncIteration:
+                return
+    
+    return StreamingResponse(sse(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.websocket("/ws/chat")
+async def chat_websocket(websocket: WebSocket):
+    """
+    流式对话接口（WebSocket）
+    客户端每次发送 {"user_id": ..., "message": ...}，服务端逐条发送和SSE相同的事件；
+    格式错误的请求回复一个 error 事件，连接保持打开
+    """
+    await websocket.accept()
+    try:
+        while True:
+            payload = await websocket.receive_text()
+            try:
+                # JSON解析失败和pydantic校验失败都是ValueError，不是对象时是TypeError
+                request = ChatRequest(**json.loads(payload))
+            except (ValueError, TypeError):
+                await websocket.send_json({"event": "error", "data": {"detail": "请求格式错误"}})
+                continue
+            try:
+                async for event in chat_events(request.user_id, request.message):
+                    await websocket.send_json(event)
+            except ServerBusy:
+                await websocket.send_json({"event": "error", "data": {"detail": "服务繁忙，请稍后再试"}})
+    except WebSocketDisconnect:
+        pass
+
+@app.get("/api/conversation/{user_id}")
+def get_conversation_history(user_id: str, limit: int = 50, before: Optional[int] = None):
+    """对话历史，按时间正序；before 为消息id，用于向前翻页"""
+    limit = max(1, min(limit, 200))
+    if before is None:
+        messages = conversation_store.recent(user_id, limit)
+    else:
+        messages = conversation_store.history(user_id, limit=limit, before=before)
+    return {"user_id": user_id, "messages": messages, "summary": conversation_summarizer.get(user_id)}
+
 # ==================== 用户接口 ====================
 
 @app.get("/api/user/{user_id}")
-async def get_user_info(user_id: str):
+def get_user_info(user_id: str):
     """获取用户信息"""
     user = get_user(user_id)
     if not user:
@@ -56,7 +194,7 @@ async def get_user_info(user_id: str):
     return user
 
 @app.post("/api/user/{user_id}")
-async def create_user_endpoint(user_id: str, name: str = "用户"):
+def create_user_endpoint(user_id: str, name: str = "用户"):
     """创建用户"""
     user = get_user(user_id)
     if user:
@@ -65,30 +203,44 @@ async def create_user_endpoint(user_id: str, name: str = "用户"):
     new_user = create_user(user_id, name)
     return {"message": "创建成功", "user": new_user}
 
+@app.patch("/api/user/{user_id}/preference")
+def update_user_preference(user_id: str, updates: dict):
+    """合并更新用户偏好，例如 {"response_cache": false} 关闭回复缓存"""
+    preference = update_preference(user_id, updates)
+    if preference is None:
+        raise HTTPException(status_code=404, detail="用户不存在")
+    return {"user_id": user_id, "preference": preference}
+
 # ==================== 记忆接口 ====================
 
 @app.get("/api/memory/{user_id}")
-async def get_user_memories(user_id: str, memory_type: Optional[str] = None):
+def get_user_memories(user_id: str, memory_type: Optional[str] = None):
     """获取用户记忆"""
     memories = get_memories(user_id, memory_type)
     return {"memories": memories}
 
 @app.post("/api/memory/{user_id}")
-async def add_user_memory(user_id: str, content: str, memory_type: str = "preference", importance: int = 3):
+def add_user_memory(user_id: str, content: str, memory_type: str = "preference", importance: int = 3):
     """添加记忆"""
     memory = add_memory(user_id, content, memory_type, importance)
     return {"message": "添加成功", "memory": memory}
 
+@app.get("/api/memory/{user_id}/search")
+def search_user_memories(user_id: str, q: str, limit: int = 10):
+    """全文搜索用户记忆"""
+    memories = search_memories(user_id, q, limit)
+    return {"memories": memories}
+
 # ==================== 提醒接口 ====================
 
 @app.get("/api/reminder/{user_id}")
-async def get_user_reminders(user_id: str):
+def get_user_reminders(user_id: str):
     """获取用户提醒"""
     reminders = get_reminders(user_id)
     return {"reminders": reminders}
 
 @app.post("/api/reminder/{user_id}")
-async def create_reminder(
+def create_reminder(
     user_id: str,
     title: str,
     content: str,
@@ -100,13 +252,13 @@ async def create_reminder(
     return {"message": "创建成功", "reminder": reminder}
 
 @app.delete("/api/reminder/{reminder_id}")
-async def remove_reminder(reminder_id: str):
+def remove_reminder(reminder_id: str):
     """删除提醒"""
     delete_reminder(reminder_id)
     return {"message": "删除成功"}
 
 @app.patch("/api/reminder/{reminder_id}")
-async def update_reminder_status(reminder_id: str, enabled: bool):
+def update_reminder_status(reminder_id: str, enabled: bool):
     """更新提醒状态"""
     toggle_reminder(reminder_id, enabled)
     return {"message": "更新成功"}
@@ -118,6 +270,29 @@ async def health_check():
     """健康检查"""
     return {"status": "ok", "message": "随身AI伙伴服务运行中"}
 
+@app.get("/api/metrics")
+async def get_metrics():
+    """运行指标"""
+    return metrics.collect()
+
+@app.on_event("startup")
+async def startup():
+    """启动后台任务"""
+    interval = int(os.getenv("COMPACTION_INTERVAL", "3600"))
+    if interval > 0:
+        task_scheduler.add_interval_task("memory_compaction", compactor.run, interval)
+        task_scheduler.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    """停止后台任务和对话线程池，完成排队的对话摘要，写入缓冲中的情绪状态，关闭LLM连接，再关闭数据库连接池"""
+    task_scheduler.stop()
+    chat_executor.shutdown()
+    conversation_summarizer.stop()
+    emotion_buffer.stop()
+    llm_manager.close()
+    get_pool().close()
+
 # ==================== 启动 ====================
 
 if __name__ == "__main__":
@@ -2,53 +2,64 @@
 记忆系统模块
 负责存储和检索用户记忆
 """
-import sqlite3
+import atexit
+import itertools
 import json
+import os
+import re
 import uuid
 from datetime import datetime
-from typing import List, Optional
+from typing import Dict, List, Optional, Set, Tuple
 
-DB_PATH = "memory.db"
+from . import dedup, semantic
+from .storage import DB_PATH, get_pool, migrate
+from .write_behind import EmotionWriteBehind
+
+# 记忆表的列，查询时显式列出，和 _memory_from_row 的顺序一致
+MEMORY_COLUMNS = "memory_id, user_id, content, memory_type, importance, created_at, updated_at"
+
+# 检索打分权重：重要性、新近程度、和当前消息的字面重合
+RETRIEVAL_WEIGHTS = {"importance": 0.4, "recency": 0.2, "lexical": 0.4}
+# 新近程度的半衰期（天）
+RECENCY_HALF_LIFE_DAYS = 30
+
+# 近似去重：和最近多少条记忆比较、SimHash粗筛的最大汉明距离、Jaccard相似度阈值
+DEDUP_WINDOW = 200
+SIMHASH_MAX_DISTANCE = 12
+DEDUP_SIMILARITY = 0.85
+
+# 情绪状态写缓冲，进程异常退出时最多丢失 EMOTION_FLUSH_INTERVAL 秒内的更新
+# 批次提交后递增这些用户的版本，让刷新期间用旧情绪构建的prompt缓存失效
+emotion_buffer = EmotionWriteBehind(flush_interval=float(os.getenv("EMOTION_FLUSH_INTERVAL", "2")),
+                                    on_flush=lambda user_id: bump_version(user_id))
+atexit.register(emotion_buffer.stop)
+
+# 用户资料/记忆的版本号，变化时取全局递增计数器的下一个值，prompt缓存据此判断是否过期；
+# user_id 为 None 的是全局版本，批量修改多个用户的记忆时递增
+_version_counter = itertools.count(1)
+_versions: Dict[Optional[str], int] = {}
+
+def bump_version(user_id: Optional[str] = None):
+    """用户资料或记忆变化后调用（必须在变化已提交之后）"""
+    _versions[user_id] = next(_version_counter)
+
+def get_version(user_id: str) -> Tuple[int, int]:
+    """用户资料和记忆的当前版本"""
+    return _versions.get(None, 0), _versions.get(user_id, 0)
 
 def init_db():
     """初始化数据库"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    # 用户表
-    c.execute('''CREATE TABLE IF NOT EXISTS users (
-        user_id TEXT PRIMARY KEY,
-        name TEXT DEFAULT '用户',
-        preference TEXT DEFAULT '{}',
-        emotion_state TEXT DEFAULT 'neutral',
-        created_at TEXT,
-        updated_at TEXT
-    )''')
-    
-    # 记忆表
-    c.execute('''CREATE TABLE IF NOT EXISTS memories (
-        memory_id TEXT PRIMARY KEY,
-        user_id TEXT,
-        content TEXT,
-        memory_type TEXT,
-        importance INTEGER DEFAULT 3,
-        created_at TEXT,
-        updated_at TEXT
-    )''')
-    
-    conn.commit()
-    conn.close()
+    migrate()
 
 def get_user(user_id: str) -> dict:
     """获取用户信息"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-    row = c.fetchone()
-    conn.close()
+    with get_pool().connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
+        row = c.fetchone()
     
     if row:
-        return {
+        user = {
             "user_id": row[0],
             "name": row[1],
             "preference": json.loads(row[2]),
@@ -56,34 +67,70 @@ def get_user(user_id: str) -> dict:
             "created_at": row[4],
             "updated_at": row[5]
         }
+        # 叠加还在写缓冲中的情绪状态
+        pending = emotion_buffer.get_pending(user_id)
+        if pending:
+            user["emotion_state"], user["updated_at"] = pending
+        else:
+            emotion_buffer.observe(user_id, row[3])
+        return user
     return None
 
 def create_user(user_id: str, name: str = "用户") -> dict:
     """创建用户"""
     now = datetime.now().isoformat()
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute(
-        "INSERT INTO users (user_id, name, preference, emotion_state, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
-        (user_id, name, "{}", "neutral", now, now)
-    )
-    conn.commit()
-    conn.close()
+    with get_pool().transaction() as conn:
+        c = conn.cursor()
+        c.execute(
+            "INSERT INTO users (user_id, name, preference, emotion_state, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (user_id, name, "{}", "neutral", now, now)
+        )
+        get_pool().after_commit(lambda: bump_version(user_id))
     return get_user(user_id)
 
-def add_memory(user_id: str, content: str, memory_type: str, importance: int = 3) -> dict:
-    """添加记忆"""
+def update_preference(user_id: str, updates: Dict) -> Optional[dict]:
+    """合并更新用户偏好，返回新的偏好；用户不存在时返回None"""
+    with get_pool().transaction(immediate=True) as conn:
+        row = conn.execute("SELECT preference FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None:
+            return None
+        preference = {**json.loads(row[0] or "{}"), **updates}
+        conn.execute(
+            "UPDATE users SET preference = ?, updated_at = ? WHERE user_id = ?",
+            (json.dumps(preference, ensure_ascii=False), datetime.now().isoformat(), user_id)
+        )
+        get_pool().after_commit(lambda: bump_version(user_id))
+    return preference
+
+def add_memory(user_id: str, content: str, memory_type: str, importance: int = 3,
+               dedupe: bool = True) -> dict:
+    """
+    添加记忆
+    和已有记忆重复或高度相似时，不新增行，而是提升已有记忆的重要性和更新时间
+    """
     memory_id = str(uuid.uuid4())
     now = datetime.now().isoformat()
+    digest = dedup.content_hash(content)
+    fingerprint = dedup.simhash(content)
     
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute(
-        "INSERT INTO memories (memory_id, user_id, content, memory_type, importance, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
-        (memory_id, user_id, content, memory_type, importance, now, now)
-    )
-    conn.commit()
-    conn.close()
+    with get_pool().transaction(immediate=True) as conn:
+        get_pool().after_commit(lambda: bump_version(user_id))
+        c = conn.cursor()
+        duplicate = _find_duplicate(c, user_id, content, memory_type, digest, fingerprint) if dedupe else None
+        if duplicate:
+            c.execute(
+                "UPDATE memories SET importance = MIN(5, MAX(importance, ?) + 1), updated_at = ? WHERE memory_id = ?",
+                (importance, now, duplicate)
+            )
+            c.execute(f"SELECT {MEMORY_COLUMNS} FROM memories WHERE memory_id = ?", (duplicate,))
+            return _memory_from_row(c.fetchone())
+        
+        c.execute(
+            "INSERT INTO memories (memory_id, user_id, content, memory_type, importance, created_at, updated_at, content_hash, simhash) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (memory_id, user_id, content, memory_type, importance, now, now, digest, fingerprint)
+        )
+        # 外层事务回滚时不会留下向量
+        get_pool().after_commit(lambda: semantic.semantic_index.add(user_id, memory_id, content))
     
     return {
         "memory_id": memory_id,
@@ -95,42 +142,203 @@ def add_memory(user_id: str, content: str, memory_type: str, importance: int = 3
         "updated_at": now
     }
 
+def _find_duplicate(c, user_id: str, content: str, memory_type: str, digest: str,
+                    fingerprint: int) -> Optional[str]:
+    """查找同一用户同类型的重复记忆，返回memory_id"""
+    # 规范化后完全相同，走索引查全部历史
+    c.execute(
+        "SELECT memory_id FROM memories WHERE user_id = ? AND content_hash = ? AND memory_type = ? LIMIT 1",
+        (user_id, digest, memory_type)
+    )
+    row = c.fetchone()
+    if row:
+        return row[0]
+    
+    # 近似重复只和最近的 DEDUP_WINDOW 条比较，SimHash先粗筛，再用Jaccard确认
+    c.execute(
+        "SELECT memory_id, content, memory_type, simhash FROM memories WHERE user_id = ? "
+        "ORDER BY created_at DESC LIMIT ?",
+        (user_id, DEDUP_WINDOW)
+    )
+    grams = dedup.shingles(content)
+    for memory_id, other, other_type, other_hash in c.fetchall():
+        if other_type != memory_type or other_hash is None:
+            continue
+        if dedup.hamming(fingerprint, other_hash) > SIMHASH_MAX_DISTANCE:
+            continue
+        if dedup.jaccard(grams, dedup.shingles(other)) >= DEDUP_SIMILARITY:
+            return memory_id
+    return None
+
 def get_memories(user_id: str, memory_type: str = None) -> List[dict]:
     """获取用户记忆"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+    with get_pool().connection() as conn:
+        c = conn.cursor()
+        
+        if memory_type:
+            c.execute(f"SELECT {MEMORY_COLUMNS} FROM memories WHERE user_id = ? AND memory_type = ? ORDER BY importance DESC", 
+                     (user_id, memory_type))
+        else:
+            c.execute(f"SELECT {MEMORY_COLUMNS} FROM memories WHERE user_id = ? ORDER BY importance DESC", (user_id,))
+        
+        rows = c.fetchall()
+    
+    return [_memory_from_row(row) for row in rows]
+
+def search_memories(user_id: str, query: str, limit: int = 10) -> List[dict]:
+    """
+    全文搜索用户记忆，按相关度排序
+    查询词按字符三元组匹配；不足三个字的查询退回到 LIKE 匹配
+    """
+    chunks = _query_chunks(query)
+    match = _fts_match(user_id, chunks)
+    
+    with get_pool().connection() as conn:
+        c = conn.cursor()
+        
+        if match:
+            c.execute("""
+                SELECT m.memory_id, m.user_id, m.content, m.memory_type, m.importance, m.created_at, m.updated_at
+                FROM memories_fts f JOIN memories m ON m.rowid = f.rowid
+                WHERE memories_fts MATCH ? AND m.user_id = ?
+                ORDER BY bm25(memories_fts), m.importance DESC
+                LIMIT ?
+            """, (match, user_id, limit))
+        elif chunks:
+            like = " OR ".join(["content LIKE ?"] * len(chunks))
+            c.execute(
+                f"SELECT {MEMORY_COLUMNS} FROM memories WHERE user_id = ? AND ({like}) "
+                "ORDER BY importance DESC LIMIT ?",
+                (user_id, *[f"%{w}%" for w in chunks], limit)
+            )
+        else:
+            return []
+        
+        rows = c.fetchall()
+    
+    return [_memory_from_row(row) for row in rows]
+
+def load_candidates(user_id: str, candidates: int = 50) -> List[tuple]:
+    """
+    和消息无关的候选记忆：重要性最高、最近更新的各 candidates 条
+    每条附带预先算好的二元组和时间 (row, bigrams, time)，可以按用户缓存
+    """
+    with get_pool().connection() as conn:
+        rows = conn.execute(f"""
+            SELECT * FROM (SELECT {MEMORY_COLUMNS} FROM memories WHERE user_id = ?
+                           ORDER BY importance DESC, created_at DESC LIMIT ?)
+            UNION
+            SELECT * FROM (SELECT {MEMORY_COLUMNS} FROM memories WHERE user_id = ?
+                           ORDER BY created_at DESC LIMIT ?)
+        """, (user_id, candidates, user_id, candidates)).fetchall()
+    return [_candidate(row) for row in rows]
+
+def retrieve_memories(user_id: str, message: str, limit: int = 10, candidates: int = 50,
+                      base: List[tuple] = None, with_score: bool = False) -> List[dict]:
+    """
+    为当前消息挑选最相关的记忆
+    
+    候选集只取三路各 candidates 条：重要性最高、最近更新、全文匹配，都走索引，
+    所以代价与用户记忆总数无关；开启语义索引时再加上语义最相近的 candidates 条。
+    候选按重要性、新近程度（指数衰减）和与消息的字面/语义相似度打分，
+    只把最终选中的 limit 条转成字典。
     
-    if memory_type:
-        c.execute("SELECT * FROM memories WHERE user_id = ? AND memory_type = ? ORDER BY importance DESC", 
-                 (user_id, memory_type))
-    else:
-        c.execute("SELECT * FROM memories WHERE user_id = ? ORDER BY importance DESC", (user_id,))
+    base 是缓存的 load_candidates 结果，传入时只查询和消息相关的两路；
+    with_score 为True时每条记忆附带相关度得分 score
+    """
+    pool = {c[0][0]: c for c in (base if base is not None else load_candidates(user_id, candidates))}
     
-    rows = c.fetchall()
-    conn.close()
+    match = _fts_match(user_id, _query_chunks(message))
+    similar = dict(semantic.semantic_index.search(user_id, message, candidates))
+    queries = []
+    if match:
+        queries.append(("""
+            SELECT m.memory_id, m.user_id, m.content, m.memory_type, m.importance, m.created_at, m.updated_at
+            FROM memories_fts f JOIN memories m ON m.rowid = f.rowid
+            WHERE memories_fts MATCH ? AND m.user_id = ?
+            ORDER BY bm25(memories_fts) LIMIT ?
+        """, (match, user_id, candidates)))
+    missing = [memory_id for memory_id in similar if memory_id not in pool]
+    if missing:
+        queries.append((
+            f"SELECT {MEMORY_COLUMNS} FROM memories WHERE memory_id IN ({', '.join('?' * len(missing))})",
+            tuple(missing)
+        ))
+    if queries:
+        with get_pool().connection() as conn:
+            for sql, params in queries:
+                for row in conn.execute(sql, params):
+                    if row[0] not in pool:
+                        pool[row[0]] = _candidate(row)
     
-    memories = []
-    for row in rows:
-        memories.append({
-            "memory_id": row[0],
-            "user_id": row[1],
-            "content": row[2],
-            "memory_type": row[3],
-            "importance": row[4],
-            "created_at": row[5],
-            "updated_at": row[6]
-        })
-    return memories
+    now = datetime.now()
+    message_grams = _bigrams(message)
+    scored = sorted(
+        ((_relevance(c, message_grams, now, similar.get(c[0][0], 0.0)), c) for c in pool.values()),
+        key=lambda item: item[0], reverse=True
+    )[:limit]
+    if with_score:
+        return [{**_memory_from_row(c[0]), "score": score} for score, c in scored]
+    return [_memory_from_row(c[0]) for _score, c in scored]
+
+def _candidate(row) -> tuple:
+    """候选记忆 (row, 二元组, 更新时间)"""
+    try:
+        when = datetime.fromisoformat(row[6] or row[5])
+    except (TypeError, ValueError):
+        when = None
+    return row, _bigrams(row[2] or ""), when
+
+def _relevance(candidate: tuple, message_grams: Set[str], now: datetime, similarity: float = 0.0) -> float:
+    """候选记忆的相关度得分"""
+    row, grams, when = candidate
+    importance = (row[4] or 0) / 5
+    age_days = max(0.0, (now - when).total_seconds() / 86400) if when else RECENCY_HALF_LIFE_DAYS
+    recency = 0.5 ** (age_days / RECENCY_HALF_LIFE_DAYS)
+    # 每多一个相同的二元组，得分向1逼近
+    lexical = max(1 - 0.5 ** len(message_grams & grams), similarity)
+    return (RETRIEVAL_WEIGHTS["importance"] * importance
+            + RETRIEVAL_WEIGHTS["recency"] * recency
+            + RETRIEVAL_WEIGHTS["lexical"] * lexical)
+
+def _query_chunks(text: str) -> List[str]:
+    """按标点和空白切分查询"""
+    return [w for w in re.split(r"[\W_]+", text.lower()) if w]
+
+def _bigrams(text: str) -> Set[str]:
+    """字符二元组，中文里大多数词是两个字"""
+    return {w[i:i + 2] for w in _query_chunks(text) for i in range(len(w) - 1)}
+
+def _fts_match(user_id: str, chunks: List[str]) -> Optional[str]:
+    """把查询转成FTS5的MATCH表达式，没有三个字以上的片段时返回None"""
+    trigrams = {w[i:i + 3] for w in chunks for i in range(len(w) - 2)}
+    if not trigrams:
+        return None
+    match = " OR ".join(_fts_phrase(t) for t in sorted(trigrams))
+    if len(user_id) >= 3:
+        return f"user_id : {_fts_phrase(user_id)} AND content : ({match})"
+    return f"content : ({match})"
+
+def _fts_phrase(text: str) -> str:
+    """转成FTS5短语，转义双引号"""
+    return '"' + text.replace('"', '""') + '"'
+
+def _memory_from_row(row) -> dict:
+    """把记忆表的一行转成字典"""
+    return {
+        "memory_id": row[0],
+        "user_id": row[1],
+        "content": row[2],
+        "memory_type": row[3],
+        "importance": row[4],
+        "created_at": row[5],
+        "updated_at": row[6]
+    }
 
 def update_emotion(user_id: str, emotion_state: str):
-    """更新用户情绪状态"""
-    now = datetime.now().isoformat()
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("UPDATE users SET emotion_state = ?, updated_at = ? WHERE user_id = ?", 
-              (emotion_state, now, user_id))
-    conn.commit()
-    conn.close()
+    """更新用户情绪状态（先写入缓冲，由 emotion_buffer 批量落库）"""
+    if emotion_buffer.update(user_id, emotion_state):
+        bump_version(user_id)
 
 # 初始化数据库
 init_db()
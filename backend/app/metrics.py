@@ -0,0 +1,17 @@
+"""
+运行指标
+各模块的统计信息统一在这里登记，由 /api/metrics 输出
+"""
+from typing import Callable, Dict
+
+_sources: Dict[str, Callable[[], dict]] = {}
+
+
+def register(name: str, source: Callable[[], dict]):
+    """登记一个指标来源"""
+    _sources[name] = source
+
+
+def collect() -> Dict[str, dict]:
+    """收集所有指标"""
+    return {name: source() for name, source in _sources.items()}
@@ -0,0 +1,70 @@
+"""
+Prompt缓存
+按用户缓存构建prompt时和消息无关的部分（用户资料、候选记忆），
+用户资料或记忆的版本变化时失效；每轮只重新计算和消息相关的部分
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+
+class PromptCache:
+    """
+    按用户的版本化缓存
+
+    - get() 先读版本号再构建，构建期间数据变化会让版本号前进，下次读取自然失效，不会缓存旧数据
+    - 最多缓存 max_users 个用户，超出时淘汰最久未使用的
+    - 命中时把这个条目构建所花的时间记为节省的时间
+    """
+
+    def __init__(self, version: Callable[[str], Hashable], max_users: int = 10000):
+        self.version = version
+        self.max_users = max_users
+        self._entries = OrderedDict()  # user_id -> (version, value, build_ms)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.saved_ms = 0.0
+
+    def get(self, user_id: str, build: Callable[[], Any]) -> Any:
+        """返回缓存的值，版本不一致时调用 build() 重新构建"""
+        version = self.version(user_id)
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                self.saved_ms += entry[2]
+                return entry[1]
+            self.misses += 1
+
+        t0 = time.perf_counter()
+        value = build()
+        build_ms = (time.perf_counter() - t0) * 1000
+
+        with self._lock:
+            self._entries[user_id] = (version, value, build_ms)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, user_id: str = None):
+        """丢弃用户（默认全部）的缓存"""
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+    def get_stats(self) -> dict:
+        """缓存统计"""
+        total = self.hits + self.misses
+        return {
+            "users": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+            "saved_ms": round(self.saved_ms, 3)
+        }
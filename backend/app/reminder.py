@@ -2,7 +2,6 @@
 提醒模块
 智能提醒功能
 """
-import sqlite3
 import uuid
 from datetime import datetime, timedelta
 from typing import List, Optional
@@ -10,39 +9,25 @@ from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
 from apscheduler.triggers.interval import IntervalTrigger
 
-DB_PATH = "memory.db"
+from .storage import DB_PATH, get_pool, migrate
+
 scheduler = BackgroundScheduler()
 
 def init_reminder_db():
     """初始化提醒表"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS reminders (
-        reminder_id TEXT PRIMARY KEY,
-        user_id TEXT,
-        title TEXT,
-        content TEXT,
-        reminder_type TEXT,
-        time TEXT,
-        enabled INTEGER DEFAULT 1,
-        created_at TEXT
-    )''')
-    conn.commit()
-    conn.close()
+    migrate()
 
 def add_reminder(user_id: str, title: str, content: str, reminder_type: str, time: str) -> dict:
     """添加提醒"""
     reminder_id = str(uuid.uuid4())
     now = datetime.now().isoformat()
     
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute(
-        "INSERT INTO reminders (reminder_id, user_id, title, content, reminder_type, time, enabled, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-        (reminder_id, user_id, title, content, reminder_type, time, 1, now)
-    )
-    conn.commit()
-    conn.close()
+    with get_pool().transaction() as conn:
+        c = conn.cursor()
+        c.execute(
+            "INSERT INTO reminders (reminder_id, user_id, title, content, reminder_type, time, enabled, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (reminder_id, user_id, title, content, reminder_type, time, 1, now)
+        )
     
     return {
         "reminder_id": reminder_id,
@@ -57,11 +42,10 @@ def add_reminder(user_id: str, title: str, content: str, reminder_type: str, tim
 
 def get_reminders(user_id: str) -> List[dict]:
     """获取用户的所有提醒"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT * FROM reminders WHERE user_id = ? ORDER BY created_at DESC", (user_id,))
-    rows = c.fetchall()
-    conn.close()
+    with get_pool().connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT * FROM reminders WHERE user_id = ? ORDER BY created_at DESC", (user_id,))
+        rows = c.fetchall()
     
     reminders = []
     for row in rows:
@@ -79,19 +63,15 @@ def get_reminders(user_id: str) -> List[dict]:
 
 def delete_reminder(reminder_id: str):
     """删除提醒"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("DELETE FROM reminders WHERE reminder_id = ?", (reminder_id,))
-    conn.commit()
-    conn.close()
+    with get_pool().transaction() as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM reminders WHERE reminder_id = ?", (reminder_id,))
 
 def toggle_reminder(reminder_id: str, enabled: bool):
     """切换提醒状态"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("UPDATE reminders SET enabled = ? WHERE reminder_id = ?", (int(enabled), reminder_id))
-    conn.commit()
-    conn.close()
+    with get_pool().transaction() as conn:
+        c = conn.cursor()
+        c.execute("UPDATE reminders SET enabled = ? WHERE reminder_id = ?", (int(enabled), reminder_id))
 
 # 初始化
 init_reminder_db()
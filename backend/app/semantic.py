@@ -0,0 +1,425 @@
+"""
+语义记忆索引（可选）
+用本地编码器把记忆转成向量，按余弦相似度检索，弥补字面匹配找不到的同义表达
+需要安装 numpy，未安装时索引自动关闭
+"""
+import os
+import re
+import threading
+import time
+import unicodedata
+import zlib
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from batcher import MicroBatcher
+from .storage import get_pool
+
+
+class Encoder:
+    """编码器基类，可替换为任意本地模型"""
+
+    dim = 0
+
+    def encode(self, texts: List[str]):
+        """把文本编码成 (len(texts), dim) 的float32矩阵，每行L2归一化"""
+        raise NotImplementedError
+
+
+class HashingEncoder(Encoder):
+    """
+    字符n-gram哈希编码器
+    纯CPU、无需模型文件，离线可用；"我爱打篮球"和"喜欢篮球运动"会因为共同的
+    "篮"、"球"、"篮球"得到正的相似度
+    """
+
+    def __init__(self, dim: int = 256, ngrams: Tuple[int, ...] = (1, 2, 3)):
+        self.dim = dim
+        self.ngrams = ngrams
+
+    def encode(self, texts: List[str]):
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            chars = "".join(re.findall(r"\w", text.lower()))
+            for n in self.ngrams:
+                for i in range(len(chars) - n + 1):
+                    h = zlib.crc32(chars[i:i + n].encode("utf-8"))
+                    # 用哈希的最高位决定符号，减少哈希冲突带来的偏差
+                    matrix[row, h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return matrix / norms
+
+
+class BatchingEncoder(Encoder):
+    """
+    微批编码：并发的少量文本编码请求攒成一批交给内部编码器，
+    适合每次调用有固定开销的模型（GPU推理、远程编码服务）；一次就够 max_batch 条的请求直接调用内部编码器
+    """
+
+    def __init__(self, encoder: Encoder, max_batch: int = 32, max_wait: float = 0.005):
+        self.encoder = encoder
+        self.dim = encoder.dim
+        self.max_batch = max_batch
+        self.batcher = MicroBatcher(lambda texts: list(encoder.encode(texts)), max_batch=max_batch,
+                                    max_wait=max_wait, concurrency=1, name="encoder-batcher")
+
+    def encode(self, texts: List[str]):
+        if len(texts) >= self.max_batch:
+            return self.encoder.encode(texts)
+        futures = [self.batcher.submit(text) for text in texts]
+        return np.stack([future.result() for future in futures]) if futures else self.encoder.encode(texts)
+
+    def get_stats(self) -> dict:
+        return self.batcher.get_stats()
+
+
+class _UserVectors:
+    """单个用户的向量，按容量翻倍扩展，追加是均摊O(1)"""
+
+    def __init__(self, dim: int, ids: List[str], vectors):
+        self.ids = list(ids)
+        self.size = len(ids)
+        self.matrix = np.zeros((max(16, self.size), dim), dtype=np.float32)
+        self.matrix[:self.size] = vectors
+
+    def append(self, memory_id: str, vector):
+        if self.size == len(self.matrix):
+            grown = np.zeros((len(self.matrix) * 2, self.matrix.shape[1]), dtype=np.float32)
+            grown[:self.size] = self.matrix
+            self.matrix = grown
+        self.matrix[self.size] = vector
+        self.ids.append(memory_id)
+        self.size += 1
+
+    @property
+    def nbytes(self) -> int:
+        return self.matrix.nbytes + self.size * 64
+
+
+class SemanticMemoryIndex:
+    """
+    语义记忆索引
+
+    - 每个用户的向量在第一次检索时从数据库加载，之后新增记忆直接追加；
+      add()/invalidate() 必须在记忆变化提交之后调用，加载期间有变化时这次加载的结果不缓存
+    - 所有用户的向量总大小超过 memory_budget 字节时，淘汰最久未使用的用户
+    """
+
+    def __init__(self, encoder: Encoder = None, memory_budget: int = 64 * 1024 * 1024,
+                 enabled: bool = True):
+        self.enabled = enabled and np is not None
+        self.encoder = encoder or (HashingEncoder() if np is not None else None)
+        self.memory_budget = memory_budget
+        self._users = OrderedDict()  # user_id -> _UserVectors
+        self._loading: Dict[str, list] = {}  # user_id -> [正在加载的线程数, 加载期间是否有变化]
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.evictions = 0
+
+    def search(self, user_id: str, text: str, k: int = 10) -> List[Tuple[str, float]]:
+        """返回最相似的 k 条记忆 [(memory_id, 相似度)]"""
+        if not self.enabled:
+            return []
+        vectors = self._get(user_id)
+        if vectors.size == 0:
+            return []
+
+        query = self.encoder.encode([text])[0]
+        scores = vectors.matrix[:vectors.size] @ query
+        k = min(k, vectors.size)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(vectors.ids[i], float(scores[i])) for i in top if scores[i] > 0]
+
+    def add(self, user_id: str, memory_id: str, content: str):
+        """新增记忆；用户向量还没加载时不做任何事，等检索时一起加载"""
+        if not self.enabled:
+            return
+        with self._lock:
+            vectors = self._users.get(user_id)
+            if vectors is None:
+                self._changed(user_id)
+                return
+            before = vectors.nbytes
+            vectors.append(memory_id, self.encoder.encode([content])[0])
+            self._bytes += vectors.nbytes - before
+            self._evict()
+
+    def invalidate(self, user_id: str = None):
+        """丢弃用户（默认全部）的向量，下次检索时重新加载"""
+        with self._lock:
+            if user_id is None:
+                self._users.clear()
+                self._bytes = 0
+                for loading in self._loading.values():
+                    loading[1] = True
+                return
+            self._changed(user_id)
+            if user_id in self._users:
+                self._bytes -= self._users.pop(user_id).nbytes
+
+    def _changed(self, user_id: str):
+        loading = self._loading.get(user_id)
+        if loading is not None:
+            loading[1] = True
+
+    def _get(self, user_id: str) -> _UserVectors:
+        with self._lock:
+            vectors = self._users.get(user_id)
+            if vectors is not None:
+                self._users.move_to_end(user_id)
+                return vectors
+            loading = self._loading.setdefault(user_id, [0, False])
+            loading[0] += 1
+
+        try:
+            with get_pool().connection() as conn:
+                rows = conn.execute(
+                    "SELECT memory_id, content FROM memories WHERE user_id = ?", (user_id,)
+                ).fetchall()
+            ids = [row[0] for row in rows]
+            matrix = self.encoder.encode([row[1] or "" for row in rows])
+            vectors = _UserVectors(self.encoder.dim, ids, matrix)
+        finally:
+            with self._lock:
+                loading[0] -= 1
+                if loading[0] == 0:
+                    self._loading.pop(user_id, None)
+                # 读取之后有新增或失效时，读到的可能已经过时，只用于这次检索
+                if vectors is not None and not loading[1] and user_id not in self._users:
+                    self._users[user_id] = vectors
+                    self._bytes += vectors.nbytes
+                    self.loads += 1
+                    self._evict()
+        return vectors
+
+    def _evict(self):
+        """超出内存预算时淘汰最久未使用的用户，至少保留最近使用的一个"""
+        while self._bytes > self.memory_budget and len(self._users) > 1:
+            _user_id, vectors = self._users.popitem(last=False)
+            self._bytes -= vectors.nbytes
+            self.evictions += 1
+
+    def get_stats(self) -> dict:
+        """索引统计"""
+        return {
+            "enabled": self.enabled,
+            "users_loaded": len(self._users),
+            "memory_bytes": self._bytes,
+            "memory_budget": self.memory_budget,
+            "loads": self.loads,
+            "evictions": self.evictions
+        }
+
+
+# 句末语气词，语义缓存比较前去掉
+_PARTICLES = re.compile(r"[吗呢呀啊吧啦哦嘛哈]+$")
+# 正反问句 "在不在"、"有没有" 归一为 "在"、"有"
+_A_NOT_A = re.compile(r"(\w)[不没]\1")
+_NEGATIONS = re.compile(r"[不没别]")
+
+
+def normalize_query(text: str) -> str:
+    """语义缓存的规范化：全角转半角、小写、去标点，正反问句和句末语气词归一"""
+    text = "".join(re.findall(r"\w", unicodedata.normalize("NFKC", text or "").lower()))
+    return _PARTICLES.sub("", _A_NOT_A.sub(r"\1", text)) or text
+
+
+class _ScopeEntries:
+    """一个缓存分区的条目，按需倍增到 capacity 行，之后环形覆盖最旧的条目"""
+
+    def __init__(self, dim: int, capacity: int):
+        self.capacity = capacity
+        rows = min(4, capacity)
+        self.matrix = np.zeros((rows, dim), dtype=np.float32)
+        self.texts: List[str] = []
+        self.replies: List[str] = []
+        self.expires = np.zeros(rows, dtype=np.float64)
+        self.size = 0
+        self.next = 0
+
+    @property
+    def nbytes(self) -> int:
+        return self.matrix.nbytes + self.expires.nbytes
+
+    def add(self, vector, text: str, reply: str, expires: float) -> bool:
+        """写入一条，返回是否覆盖了旧条目"""
+        if self.size < self.capacity:
+            if self.size == len(self.matrix):
+                rows = min(len(self.matrix) * 2, self.capacity)
+                grown = np.zeros((rows, self.matrix.shape[1]), dtype=np.float32)
+                grown[:self.size] = self.matrix
+                self.matrix = grown
+                self.expires = np.concatenate([self.expires, np.zeros(rows - self.size)])
+            i = self.size
+            self.matrix[i], self.expires[i] = vector, expires
+            self.texts.append(text)
+            self.replies.append(reply)
+            self.size += 1
+            self.next = self.size % self.capacity
+            return False
+        i = self.next
+        self.matrix[i] = vector
+        self.texts[i], self.replies[i], self.expires[i] = text, reply, expires
+        self.next = (i + 1) % self.capacity
+        return True
+
+
+class SemanticCache:
+    """
+    语义回复缓存
+
+    - 用编码器把规范化后的用户消息转成向量，同一分区内余弦相似度不低于 threshold 的
+      最相近条目直接返回它的回复；否定词不同（"喜欢"和"不喜欢"）的消息不算相近
+    - 分区是 (人设, partition)，partition 用来把可能含个人信息的回复限制在同一用户内；
+      disable(人设) 关闭某个人设的语义缓存
+    - 每个分区最多 max_per_scope 条，环形覆盖；总条目超过 max_entries 时淘汰最久未使用的分区；
+      条目 ttl 秒后过期
+    """
+
+    def __init__(self, encoder: Encoder = None, threshold: float = 0.9, max_entries: int = 10000,
+                 max_per_scope: int = 64, ttl: float = 3600, disabled_personas: Iterable[str] = (),
+                 enabled: bool = True):
+        self.enabled = enabled and np is not None and max_entries > 0
+        self.encoder = encoder or (HashingEncoder() if np is not None else None)
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.max_per_scope = max_per_scope
+        self.ttl = ttl
+        self.disabled_personas = set(disabled_personas)
+        self._scopes = OrderedDict()  # (persona, partition) -> _ScopeEntries
+        self._entries = 0
+        # 规范化消息 -> 向量；未命中时 lookup 和随后的 store 编码同一条消息，问候语也会反复出现
+        self._vectors = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def active(self, persona: str) -> bool:
+        """这个人设是否使用语义缓存"""
+        return self.enabled and persona not in self.disabled_personas
+
+    def disable(self, persona: str):
+        """关闭某个人设的语义缓存，并丢弃它已缓存的回复"""
+        with self._lock:
+            self.disabled_personas.add(persona)
+            for scope in [scope for scope in self._scopes if scope[0] == persona]:
+                self._entries -= self._scopes.pop(scope).size
+
+    def enable(self, persona: str):
+        """重新开启某个人设的语义缓存"""
+        with self._lock:
+            self.disabled_personas.discard(persona)
+
+    def lookup(self, persona: str, text: str, partition: str = "") -> Optional[str]:
+        """查找语义相近的消息的回复，没有时返回None"""
+        if not self.active(persona):
+            return None
+        query = normalize_query(text)
+        vector = self._encode(query)
+        negations = _NEGATIONS.findall(query)
+        now = time.monotonic()
+        with self._lock:
+            entries = self._scopes.get((persona, partition))
+            if entries is not None and entries.size:
+                self._scopes.move_to_end((persona, partition))
+                scores = entries.matrix[:entries.size] @ vector
+                scores[entries.expires[:entries.size] <= now] = -1.0
+                for i in np.argsort(-scores)[:3]:
+                    if scores[i] < self.threshold:
+                        break
+                    if _NEGATIONS.findall(entries.texts[i]) == negations:
+                        self.hits += 1
+                        return entries.replies[i]
+            self.misses += 1
+        return None
+
+    def store(self, persona: str, text: str, reply: str, partition: str = ""):
+        """缓存一条回复"""
+        if not self.active(persona) or not reply:
+            return
+        query = normalize_query(text)
+        if not query:
+            return
+        vector = self._encode(query)
+        with self._lock:
+            scope = (persona, partition)
+            entries = self._scopes.get(scope)
+            if entries is None:
+                entries = self._scopes[scope] = _ScopeEntries(self.encoder.dim, self.max_per_scope)
+            self._scopes.move_to_end(scope)
+            if not entries.add(vector, query, reply, time.monotonic() + self.ttl):
+                self._entries += 1
+            self.stores += 1
+            # 超出总条目数时淘汰最久未使用的分区，至少保留刚写入的分区
+            while self._entries > self.max_entries and len(self._scopes) > 1:
+                _scope, evicted = self._scopes.popitem(last=False)
+                self._entries -= evicted.size
+                self.evictions += evicted.size
+
+    def _encode(self, query: str):
+        with self._lock:
+            vector = self._vectors.get(query)
+            if vector is not None:
+                self._vectors.move_to_end(query)
+                return vector
+        vector = self.encoder.encode([query])[0]
+        with self._lock:
+            self._vectors[query] = vector
+            if len(self._vectors) > 1024:
+                self._vectors.popitem(last=False)
+        return vector
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._scopes.clear()
+            self._entries = 0
+
+    def get_stats(self) -> dict:
+        """缓存统计"""
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "threshold": self.threshold,
+            "scopes": len(self._scopes),
+            "entries": self._entries,
+            "allocated_bytes": sum(entries.nbytes for entries in list(self._scopes.values())),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "disabled_personas": sorted(self.disabled_personas)
+        }
+
+
+def _default_encoder() -> Optional[Encoder]:
+    """默认编码器；EMBEDDING_BATCH_SIZE 大于1时经微批处理，等待 EMBEDDING_BATCH_WAIT_MS 毫秒攒批"""
+    if np is None:
+        return None
+    encoder = HashingEncoder()
+    batch_size = int(os.getenv("EMBEDDING_BATCH_SIZE", "0"))
+    if batch_size > 1:
+        encoder = BatchingEncoder(encoder, batch_size, float(os.getenv("EMBEDDING_BATCH_WAIT_MS", "5")) / 1000)
+    return encoder
+
+
+# 全局编码器，语义索引和语义缓存共用
+embedding_encoder = _default_encoder()
+
+# 全局索引，通过 SEMANTIC_MEMORY_INDEX=1 开启
+semantic_index = SemanticMemoryIndex(
+    encoder=embedding_encoder,
+    memory_budget=int(os.getenv("SEMANTIC_MEMORY_BUDGET_MB", "64")) * 1024 * 1024,
+    enabled=os.getenv("SEMANTIC_MEMORY_INDEX", "0") == "1"
+)
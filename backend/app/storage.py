@@ -0,0 +1,378 @@
+"""
+存储层
+SQLite连接池和schema迁移，记忆和提醒模块的所有读写都经过这里
+"""
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Callable, List, Optional, Tuple, Union
+
+from . import dedup
+
+DB_PATH = "memory.db"
+
+# 维护 memories_fts 的触发器，memories 表重建后需要重新创建
+MEMORIES_FTS_TRIGGERS = [
+    '''CREATE TRIGGER IF NOT EXISTS memories_fts_insert AFTER INSERT ON memories BEGIN
+        INSERT INTO memories_fts(rowid, content, user_id) VALUES (new.rowid, new.content, new.user_id);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS memories_fts_delete AFTER DELETE ON memories BEGIN
+        INSERT INTO memories_fts(memories_fts, rowid, content, user_id)
+        VALUES ('delete', old.rowid, old.content, old.user_id);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS memories_fts_update AFTER UPDATE OF content, user_id ON memories BEGIN
+        INSERT INTO memories_fts(memories_fts, rowid, content, user_id)
+        VALUES ('delete', old.rowid, old.content, old.user_id);
+        INSERT INTO memories_fts(rowid, content, user_id) VALUES (new.rowid, new.content, new.user_id);
+    END''',
+]
+
+# 重建后的 memories 表结构，列与版本1、4、5累积的结构一致
+_MEMORY_COLUMNS = [
+    "memory_id", "user_id", "content", "memory_type", "importance",
+    "created_at", "updated_at", "content_hash", "simhash", "decayed_at"
+]
+
+
+def _rebuild_memories(conn: sqlite3.Connection):
+    """把 memories 重建为带 id INTEGER PRIMARY KEY 的表，再重建索引、触发器和全文索引"""
+    columns = ", ".join(_MEMORY_COLUMNS)
+    conn.execute('''CREATE TABLE memories_new (
+        id INTEGER PRIMARY KEY,
+        memory_id TEXT NOT NULL UNIQUE,
+        user_id TEXT,
+        content TEXT,
+        memory_type TEXT,
+        importance INTEGER DEFAULT 3,
+        created_at TEXT,
+        updated_at TEXT,
+        content_hash TEXT,
+        simhash INTEGER,
+        decayed_at TEXT
+    )''')
+    conn.execute(f"INSERT INTO memories_new (id, {columns}) SELECT rowid, {columns} FROM memories")
+    # 删除旧表时它的索引和触发器一起删除
+    conn.execute("DROP TABLE memories")
+    conn.execute("ALTER TABLE memories_new RENAME TO memories")
+    for version, _description, statements in MIGRATIONS:
+        if version >= 8:
+            break
+        for statement in statements:
+            if isinstance(statement, str) and statement.startswith("CREATE INDEX IF NOT EXISTS idx_memories_"):
+                conn.execute(statement)
+    for statement in MEMORIES_FTS_TRIGGERS:
+        conn.execute(statement)
+    conn.execute("INSERT INTO memories_fts(memories_fts) VALUES ('rebuild')")
+
+
+# schema迁移: (版本号, 说明, 步骤列表)，步骤是SQL语句或接收连接的函数
+# 已发布的版本不要修改，新的变更追加新版本
+MIGRATIONS: List[Tuple[int, str, List[Union[str, Callable]]]] = [
+    (1, "基础表", [
+        '''CREATE TABLE IF NOT EXISTS users (
+            user_id TEXT PRIMARY KEY,
+            name TEXT DEFAULT '用户',
+            preference TEXT DEFAULT '{}',
+            emotion_state TEXT DEFAULT 'neutral',
+            created_at TEXT,
+            updated_at TEXT
+        )''',
+        '''CREATE TABLE IF NOT EXISTS memories (
+            memory_id TEXT PRIMARY KEY,
+            user_id TEXT,
+            content TEXT,
+            memory_type TEXT,
+            importance INTEGER DEFAULT 3,
+            created_at TEXT,
+            updated_at TEXT
+        )''',
+        '''CREATE TABLE IF NOT EXISTS reminders (
+            reminder_id TEXT PRIMARY KEY,
+            user_id TEXT,
+            title TEXT,
+            content TEXT,
+            reminder_type TEXT,
+            time TEXT,
+            enabled INTEGER DEFAULT 1,
+            created_at TEXT
+        )''',
+    ]),
+    (2, "记忆和提醒的查询索引", [
+        # get_memories / LogAnalyzer.get_top_memories
+        "CREATE INDEX IF NOT EXISTS idx_memories_user_importance ON memories(user_id, importance DESC, created_at DESC)",
+        # get_memories(memory_type=...)
+        "CREATE INDEX IF NOT EXISTS idx_memories_user_type_importance ON memories(user_id, memory_type, importance DESC)",
+        # LogAnalyzer.analyze_user 按时间范围查询
+        "CREATE INDEX IF NOT EXISTS idx_memories_user_created ON memories(user_id, created_at)",
+        # LogAnalyzer.get_memory_timeline 按天分组，覆盖索引无需回表
+        "CREATE INDEX IF NOT EXISTS idx_memories_user_day ON memories(user_id, date(created_at), created_at)",
+        # get_reminders
+        "CREATE INDEX IF NOT EXISTS idx_reminders_user_created ON reminders(user_id, created_at DESC)",
+    ]),
+    (3, "记忆全文索引", [
+        # trigram分词不依赖空格，适合中文；user_id也建索引，用于缩小单个用户的匹配范围
+        '''CREATE VIRTUAL TABLE IF NOT EXISTS memories_fts USING fts5(
+            content, user_id,
+            content='memories', content_rowid='rowid', tokenize='trigram'
+        )''',
+        *MEMORIES_FTS_TRIGGERS,
+        "INSERT INTO memories_fts(memories_fts) VALUES ('rebuild')",
+    ]),
+    (4, "记忆去重", [
+        "ALTER TABLE memories ADD COLUMN content_hash TEXT",
+        "ALTER TABLE memories ADD COLUMN simhash INTEGER",
+        "CREATE INDEX IF NOT EXISTS idx_memories_user_hash ON memories(user_id, content_hash)",
+        dedup.backfill,
+    ]),
+    (5, "记忆老化和归档", [
+        # 重要性最后一次衰减的时间，和 updated_at 一起决定下次衰减
+        "ALTER TABLE memories ADD COLUMN decayed_at TEXT",
+        # 归档的记忆；summary_id 是合并进的摘要记忆，直接归档的为空
+        '''CREATE TABLE IF NOT EXISTS memories_archive (
+            memory_id TEXT PRIMARY KEY,
+            user_id TEXT,
+            content TEXT,
+            memory_type TEXT,
+            importance INTEGER,
+            created_at TEXT,
+            updated_at TEXT,
+            archived_at TEXT,
+            summary_id TEXT
+        )''',
+        "CREATE INDEX IF NOT EXISTS idx_memories_archive_user ON memories_archive(user_id, archived_at)",
+        # 后台任务的游标，中断后从上次的位置继续
+        '''CREATE TABLE IF NOT EXISTS job_cursors (
+            job TEXT PRIMARY KEY,
+            cursor TEXT,
+            updated_at TEXT
+        )''',
+    ]),
+    (6, "对话历史", [
+        # 只追加不修改，自增主键即消息顺序
+        '''CREATE TABLE IF NOT EXISTS messages (
+            message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT,
+            role TEXT,
+            content TEXT,
+            created_at TEXT
+        )''',
+        # 读取用户最近N条消息：按索引倒序取N条，不扫描历史
+        "CREATE INDEX IF NOT EXISTS idx_messages_user ON messages(user_id, message_id)",
+    ]),
+    (7, "对话摘要", [
+        # 每个用户一条滚动摘要；last_message_id 及之前的消息已折叠进摘要
+        '''CREATE TABLE IF NOT EXISTS conversation_summaries (
+            user_id TEXT PRIMARY KEY,
+            summary TEXT,
+            last_message_id INTEGER,
+            folded_messages INTEGER DEFAULT 0,
+            folded_tokens INTEGER DEFAULT 0,
+            updated_at TEXT
+        )''',
+    ]),
+    (8, "记忆表显式整数主键", [
+        # memories 原来以 memory_id TEXT 为主键，rowid 是隐式的，VACUUM 可能重新编号，
+        # 以 rowid 关联的 memories_fts 就会指向错误的行；重建表，id 作为 rowid 的别名，保留原有的 rowid
+        _rebuild_memories,
+    ]),
+]
+
+
+class ConnectionPool:
+    """
+    SQLite连接池
+
+    - 连接长期存活，避免每次调用都重新打开文件、读取schema
+    - 一个线程在使用期间独占一条连接，同一线程内的嵌套调用复用这条连接
+    - 连接总数有上限，超出时等待其他线程归还
+    - 每条连接开启WAL，并通过 cached_statements 复用预编译语句
+    """
+
+    def __init__(self, db_path: str = DB_PATH, max_connections: int = 8,
+                 timeout: float = 30.0, cached_statements: int = 256):
+        self.db_path = db_path
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.cached_statements = cached_statements
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def _create(self) -> sqlite3.Connection:
+        """创建新连接"""
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.timeout,
+            check_same_thread=False,
+            cached_statements=self.cached_statements
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    def _acquire(self) -> sqlite3.Connection:
+        """从池中取出一条连接"""
+        if not self._slots.acquire(timeout=self.timeout):
+            raise sqlite3.OperationalError("连接池已耗尽")
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self._create()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _release(self, conn: sqlite3.Connection):
+        """归还连接"""
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """获取当前线程的连接，同一线程内可嵌套"""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            yield conn
+            return
+
+        conn = self._acquire()
+        self._local.conn = conn
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            self._release(conn)
+
+    @contextmanager
+    def transaction(self, immediate: bool = False):
+        """
+        写事务
+        最外层退出时提交，出错时回滚；嵌套在外层事务中时不单独提交
+
+        immediate=True 时立即开启事务并拿到写锁，事务内的读取看到同一个快照
+        """
+        outermost = not getattr(self._local, "in_transaction", False)
+        with self.connection() as conn:
+            if not outermost:
+                yield conn
+                return
+
+            if immediate:
+                conn.execute("BEGIN IMMEDIATE")
+            self._local.in_transaction = True
+            self._local.after_commit = []
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                self._local.in_transaction = False
+                callbacks, self._local.after_commit = self._local.after_commit, []
+            for callback in callbacks:
+                callback()
+
+    def after_commit(self, callback: Callable[[], None]):
+        """
+        当前线程的事务提交后执行回调，不在事务中时立即执行；事务回滚时丢弃
+        用于让缓存失效：必须在新数据对其他线程可见之后再失效，否则可能缓存旧数据
+        """
+        if getattr(self._local, "in_transaction", False):
+            self._local.after_commit.append(callback)
+        else:
+            callback()
+
+    def close(self):
+        """关闭所有连接"""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._idle = queue.LifoQueue()
+
+    def get_stats(self) -> dict:
+        """连接池统计"""
+        return {
+            "db_path": self.db_path,
+            "max_connections": self.max_connections,
+            "open_connections": len(self._connections),
+            "idle_connections": self._idle.qsize()
+        }
+
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    """读取当前schema版本"""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(pool: ConnectionPool = None, target: int = None) -> int:
+    """
+    执行schema迁移到目标版本（默认最新），返回迁移后的版本号
+    每个版本在独立事务中执行，多个进程同时启动也只会执行一次
+    """
+    pool = pool or get_pool()
+    target = target if target is not None else MIGRATIONS[-1][0]
+
+    with pool.connection() as conn:
+        if get_schema_version(conn) >= target:
+            return get_schema_version(conn)
+
+        for version, _description, statements in MIGRATIONS:
+            if version > target:
+                break
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if get_schema_version(conn) >= version:
+                    conn.rollback()
+                    continue
+                for statement in statements:
+                    if callable(statement):
+                        statement(conn)
+                    else:
+                        conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {version}")
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+        return get_schema_version(conn)
+
+
+_pool: Optional[ConnectionPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """获取全局连接池"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DB_PATH)
+    return _pool
+
+
+def unit_of_work():
+    """
+    工作单元：把一轮对话的所有读写放进同一个事务
+    期间调用的记忆/提醒函数复用这个事务，只在最后提交一次
+    """
+    return get_pool().transaction(immediate=True)
+
+
+def set_pool(pool: ConnectionPool) -> Optional[ConnectionPool]:
+    """替换全局连接池（测试和压测使用），返回旧的连接池"""
+    global _pool
+    with _pool_lock:
+        old, _pool = _pool, pool
+    return old
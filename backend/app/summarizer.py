@@ -0,0 +1,220 @@
+"""
+对话滚动摘要
+每积累 every_turns 轮对话，后台把较早的消息和已有摘要合并成新的摘要；
+构建prompt时使用 摘要 + 摘要之后的最近对话，prompt长度不随对话轮数增长
+"""
+import queue
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from .storage import get_pool
+from .tokens import count_tokens
+
+# 每多少轮对话（一问一答为一轮）摘要一次
+SUMMARY_EVERY_TURNS = 6
+# 摘要时保留最近多少条消息不折叠，原样放进prompt
+SUMMARY_KEEP_MESSAGES = 6
+# 摘要的最大长度
+SUMMARY_MAX_CHARS = 300
+
+SUMMARY_PROMPT = """你负责整理对话摘要。把已有摘要和新的对话合并成一段新的摘要，
+保留用户的近况、偏好、情绪和提到的重要事件，省略寒暄，不超过{max_chars}字，只输出摘要。"""
+
+ROLE_NAMES = {"user": "用户", "assistant": "小白"}
+
+
+class ConversationSummarizer:
+    """
+    滚动摘要
+
+    - notify() 在每轮对话保存后调用，只做计数，达到 every_turns 轮时把用户放进后台队列
+    - 后台线程逐个处理：读取上次摘要之后、最近 keep_messages 条之前的消息，
+      和已有摘要一起交给LLM生成新摘要；没有LLM时按用户消息抽取
+    - 摘要连同折叠到的消息id保存在 conversation_summaries 表，读取有内存缓存
+    """
+
+    def __init__(self, llm=None, every_turns: int = SUMMARY_EVERY_TURNS,
+                 keep_messages: int = SUMMARY_KEEP_MESSAGES, max_chars: int = SUMMARY_MAX_CHARS,
+                 max_users: int = 10000):
+        self.llm = llm
+        self.every_turns = every_turns
+        self.keep_messages = keep_messages
+        self.max_chars = max_chars
+        self.max_users = max_users
+        self._turns: Dict[str, int] = {}
+        self._cache = OrderedDict()  # user_id -> 摘要dict，没有摘要时为None
+        self._queue = queue.Queue()
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.runs = 0
+        self.failures = 0
+        self.folded_messages = 0
+        self.tokens_saved = 0
+
+    def notify(self, user_id: str, turns: int = 1):
+        """记录新的对话轮数，攒够 every_turns 轮时安排一次后台摘要"""
+        with self._lock:
+            count = self._turns.get(user_id, 0) + turns
+            if count < self.every_turns:
+                self._turns[user_id] = count
+                return
+            self._turns.pop(user_id, None)
+            if user_id in self._queued:
+                return
+            self._queued.add(user_id)
+        self._ensure_started()
+        self._queue.put(user_id)
+
+    def get(self, user_id: str) -> Optional[dict]:
+        """用户当前的摘要，没有时返回None"""
+        with self._lock:
+            if user_id in self._cache:
+                self._cache.move_to_end(user_id)
+                return self._cache[user_id]
+
+        with get_pool().connection() as conn:
+            row = conn.execute(
+                "SELECT summary, last_message_id, folded_messages, folded_tokens, updated_at "
+                "FROM conversation_summaries WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        summary = _summary_from_row(row) if row else None
+        self._remember(user_id, summary)
+        return summary
+
+    def _remember(self, user_id: str, summary: Optional[dict]):
+        with self._lock:
+            self._cache[user_id] = summary
+            self._cache.move_to_end(user_id)
+            while len(self._cache) > self.max_users:
+                self._cache.popitem(last=False)
+
+    def summarize(self, user_id: str) -> Optional[dict]:
+        """把较早的消息折叠进摘要，返回新的摘要；没有需要折叠的消息时返回None"""
+        current = self.get(user_id)
+        after = current["last_message_id"] if current else 0
+        with get_pool().connection() as conn:
+            rows = conn.execute(
+                "SELECT message_id, role, content FROM messages "
+                "WHERE user_id = ? AND message_id > ? ORDER BY message_id",
+                (user_id, after)
+            ).fetchall()
+        folded = rows[:max(0, len(rows) - self.keep_messages)]
+        if not folded:
+            return None
+
+        previous = current["summary"] if current else ""
+        text = self._generate(previous, folded)
+        folded_tokens = sum(count_tokens(row[2]) for row in folded)
+        summary = {
+            "summary": text,
+            "last_message_id": folded[-1][0],
+            "folded_messages": (current["folded_messages"] if current else 0) + len(folded),
+            "folded_tokens": (current["folded_tokens"] if current else 0) + folded_tokens,
+            "updated_at": datetime.now().isoformat()
+        }
+        with get_pool().transaction() as conn:
+            conn.execute(
+                "INSERT INTO conversation_summaries (user_id, summary, last_message_id, folded_messages, "
+                "folded_tokens, updated_at) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET summary = excluded.summary, "
+                "last_message_id = excluded.last_message_id, folded_messages = excluded.folded_messages, "
+                "folded_tokens = excluded.folded_tokens, updated_at = excluded.updated_at",
+                (user_id, summary["summary"], summary["last_message_id"], summary["folded_messages"],
+                 summary["folded_tokens"], summary["updated_at"])
+            )
+            get_pool().after_commit(lambda: self._remember(user_id, _with_savings(summary)))
+
+        self.runs += 1
+        self.folded_messages += len(folded)
+        self.tokens_saved += folded_tokens - (count_tokens(text) - count_tokens(previous))
+        return _with_savings(summary)
+
+    def _generate(self, previous: str, folded: List[tuple]) -> str:
+        """生成新摘要"""
+        if self.llm is None:
+            return self._extract(previous, folded)
+        dialogue = "\n".join(f"{ROLE_NAMES.get(role, role)}：{content}" for _id, role, content in folded)
+        # complete() 在Provider调用失败时抛出异常，错误信息和兜底回复不会被当作摘要保存
+        text = self.llm.complete([
+            {"role": "system", "content": SUMMARY_PROMPT.format(max_chars=self.max_chars)},
+            {"role": "user", "content": f"已有摘要：{previous or '无'}\n\n新的对话：\n{dialogue}"}
+        ]).strip()
+        if not text:
+            raise RuntimeError("摘要为空")
+        return _truncate(text, self.max_chars)
+
+    def _extract(self, previous: str, folded: List[tuple]) -> str:
+        """没有LLM时的抽取式摘要：已有摘要加上用户说过的话，超长时保留最新的部分"""
+        parts = [previous] if previous else []
+        parts.extend(content for _id, role, content in folded if role == "user")
+        return _truncate("；".join(parts), self.max_chars, keep_tail=True)
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="conversation-summarizer", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            user_id = self._queue.get()
+            try:
+                if user_id is None:
+                    return
+                with self._lock:
+                    self._queued.discard(user_id)
+                self.summarize(user_id)
+            except Exception as e:
+                self.failures += 1
+                print(f"对话摘要失败: {e}")
+            finally:
+                self._queue.task_done()
+
+    def join(self):
+        """等待队列中的摘要全部完成（测试使用）"""
+        self._queue.join()
+
+    def stop(self):
+        """处理完队列中的摘要后停止后台线程"""
+        if self._thread:
+            self._queue.put(None)
+            self._thread.join(timeout=30)
+            self._thread = None
+
+    def get_stats(self) -> dict:
+        """摘要统计"""
+        return {
+            "every_turns": self.every_turns,
+            "queued": self._queue.qsize(),
+            "runs": self.runs,
+            "failures": self.failures,
+            "folded_messages": self.folded_messages,
+            "tokens_saved": self.tokens_saved
+        }
+
+
+def _summary_from_row(row) -> dict:
+    return _with_savings({
+        "summary": row[0],
+        "last_message_id": row[1],
+        "folded_messages": row[2],
+        "folded_tokens": row[3],
+        "updated_at": row[4]
+    })
+
+
+def _with_savings(summary: dict) -> dict:
+    """每轮prompt因为摘要少发的token数：折叠的消息减去摘要本身"""
+    return {**summary, "tokens_saved": summary["folded_tokens"] - count_tokens(summary["summary"])}
+
+
+def _truncate(text: str, max_chars: int, keep_tail: bool = False) -> str:
+    if len(text) <= max_chars:
+        return text
+    if keep_tail:
+        return "…" + text[-(max_chars - 1):]
+    return text[:max_chars - 1] + "…"
@@ -0,0 +1,170 @@
+"""
+token计数和上下文预算
+默认按字符估算（中文每字1个token），安装了 tiktoken 且 TOKENIZER=tiktoken 时使用精确计数；
+计数结果按文本缓存，同一条记忆、同一段人设在每轮对话中只计算一次
+"""
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Sequence
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# 每条消息的固定开销（角色、分隔符等）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# 各模型的上下文长度，未知模型按 DEFAULT_CONTEXT_TOKENS
+MODEL_CONTEXT_TOKENS: Dict[str, int] = {
+    "gpt-3.5-turbo": 16385,
+    "gpt-4": 8192,
+    "gpt-4-turbo": 128000,
+    "gpt-4o": 128000,
+    "claude-3-opus": 200000,
+    "claude-3-sonnet": 200000,
+    "claude-3-haiku": 200000,
+    "deepseek-chat": 32768,
+}
+DEFAULT_CONTEXT_TOKENS = 8192
+# 给回复预留的token数
+REPLY_RESERVE_TOKENS = 1024
+# prompt的上限，即使模型上下文更长也不超过它，控制延迟和费用
+PROMPT_MAX_TOKENS = int(os.getenv("PROMPT_MAX_TOKENS", "4000"))
+
+_CJK = re.compile(r"[　-〿㐀-䶿一-鿿＀-￯]")
+
+
+class Tokenizer:
+    """分词器基类，可替换为模型对应的精确分词器"""
+
+    name = "base"
+
+    def count(self, text: str) -> int:
+        raise NotImplementedError
+
+
+class CharTokenizer(Tokenizer):
+    """按字符估算：中日文字符和全角标点每个算1个，其余字符每4个算1个"""
+
+    name = "char"
+
+    def count(self, text: str) -> int:
+        cjk = len(_CJK.findall(text))
+        return cjk + (len(text) - cjk + 3) // 4
+
+
+class TiktokenTokenizer(Tokenizer):
+    """tiktoken 精确计数，需要安装 tiktoken"""
+
+    name = "tiktoken"
+
+    def __init__(self, encoding: str = "cl100k_base"):
+        self._encoding = tiktoken.get_encoding(encoding)
+
+    def count(self, text: str) -> int:
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+
+class TokenCounter:
+    """带LRU缓存的token计数"""
+
+    def __init__(self, tokenizer: Tokenizer = None, max_entries: int = 100000):
+        self.tokenizer = tokenizer or CharTokenizer()
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def count(self, text: str) -> int:
+        """文本的token数"""
+        if not text:
+            return 0
+        with self._lock:
+            tokens = self._cache.get(text)
+            if tokens is not None:
+                self._cache.move_to_end(text)
+                self.hits += 1
+                return tokens
+        tokens = self.tokenizer.count(text)
+        with self._lock:
+            self.misses += 1
+            self._cache[text] = tokens
+            if len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return tokens
+
+    def count_messages(self, messages: Sequence[Dict]) -> int:
+        """消息列表的token数，包含每条消息的固定开销"""
+        return sum(self.count(m["content"]) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+
+    def set_tokenizer(self, tokenizer: Tokenizer):
+        """更换分词器并清空缓存"""
+        with self._lock:
+            self.tokenizer = tokenizer
+            self._cache.clear()
+
+    def get_stats(self) -> dict:
+        """计数统计"""
+        lookups = self.hits + self.misses
+        return {
+            "tokenizer": self.tokenizer.name,
+            "cached": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+
+def prompt_budget(model: Optional[str] = None, max_tokens: int = None) -> int:
+    """模型可用的prompt token预算：上下文长度减去回复预留，且不超过 PROMPT_MAX_TOKENS"""
+    return max(0, min(context_tokens(model) - REPLY_RESERVE_TOKENS, max_tokens or PROMPT_MAX_TOKENS))
+
+
+def context_tokens(model: Optional[str]) -> int:
+    """模型的上下文长度，带日期等后缀的模型名按最长的前缀匹配"""
+    if not model:
+        return DEFAULT_CONTEXT_TOKENS
+    if model in MODEL_CONTEXT_TOKENS:
+        return MODEL_CONTEXT_TOKENS[model]
+    prefixes = [name for name in MODEL_CONTEXT_TOKENS if model.startswith(name)]
+    return MODEL_CONTEXT_TOKENS[max(prefixes, key=len)] if prefixes else DEFAULT_CONTEXT_TOKENS
+
+
+def pack(items: List, budget: int, cost: Callable, value: Callable, max_items: int = None) -> List:
+    """
+    贪心背包：按 价值/token 从高到低放入，放不下的跳过，继续尝试更小的；最多选 max_items 条
+    返回选中的条目，保持输入中的顺序
+    """
+    costs = [cost(item) for item in items]
+    order = sorted(range(len(items)), key=lambda i: value(items[i]) / max(costs[i], 1), reverse=True)
+    chosen = set()
+    used = 0
+    for i in order:
+        if max_items is not None and len(chosen) >= max_items:
+            break
+        if used + costs[i] <= budget:
+            chosen.add(i)
+            used += costs[i]
+    return [item for i, item in enumerate(items) if i in chosen]
+
+
+def _default_tokenizer() -> Tokenizer:
+    if os.getenv("TOKENIZER") == "tiktoken" and tiktoken is not None:
+        try:
+            return TiktokenTokenizer(os.getenv("TIKTOKEN_ENCODING", "cl100k_base"))
+        except Exception as e:
+            print(f"tiktoken加载失败，改用字符估算: {e}")
+    return CharTokenizer()
+
+
+# 全局计数器
+token_counter = TokenCounter(_default_tokenizer())
+
+
+def count_tokens(text: str) -> int:
+    """文本的token数（全局计数器）"""
+    return token_counter.count(text)
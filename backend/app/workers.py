@@ -0,0 +1,72 @@
+"""
+后台工作线程
+把阻塞的对话流程（SQLite读写等）放到独立线程池执行，不占用事件循环
+"""
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+
+class ServerBusy(Exception):
+    """排队任务过多，拒绝新请求"""
+
+
+class BlockingExecutor:
+    """
+    有界线程池
+
+    - max_workers: 同时执行的任务数，应不大于数据库连接池的连接数
+    - max_pending: 执行中加排队的任务上限，超出时直接抛出 ServerBusy，
+      让调用方尽快返回503，而不是无限堆积请求
+    """
+
+    def __init__(self, max_workers: int = 8, max_pending: int = 256, name: str = "worker"):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self.completed = 0
+        self.rejected = 0
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        """在线程池中执行函数并等待结果"""
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.rejected += 1
+                raise ServerBusy(f"排队任务已达上限 {self.max_pending}")
+            self._pending += 1
+        return await self._execute(func, *args, **kwargs)
+
+    async def finish(self, func: Callable, *args, **kwargs) -> Any:
+        """已经接受的请求的后续步骤（如LLM回复之后的保存），不受 max_pending 限制，不会被拒绝"""
+        with self._lock:
+            self._pending += 1
+        return await self._execute(func, *args, **kwargs)
+
+    async def _execute(self, func: Callable, *args, **kwargs) -> Any:
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self._executor, functools.partial(func, *args, **kwargs)
+            )
+        finally:
+            with self._lock:
+                self._pending -= 1
+                self.completed += 1
+
+    def shutdown(self, wait: bool = True):
+        """关闭线程池"""
+        self._executor.shutdown(wait=wait)
+
+    def get_stats(self) -> dict:
+        """线程池统计"""
+        return {
+            "max_workers": self.max_workers,
+            "max_pending": self.max_pending,
+            "pending": self._pending,
+            "completed": self.completed,
+            "rejected": self.rejected
+        }
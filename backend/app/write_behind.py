@@ -0,0 +1,161 @@
+"""
+情绪状态写缓冲
+users.emotion_state 每条消息都会更新，这里先在内存中合并，再定期批量落库
+"""
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Callable, Dict, Optional, Tuple
+
+from .storage import get_pool
+
+
+class EmotionWriteBehind:
+    """
+    情绪状态写缓冲
+
+    - 情绪没有变化的更新直接跳过
+    - 同一用户在一个刷新周期内的多次更新只保留最后一次
+    - 每 flush_interval 秒批量写入一次，关闭时再写一次；
+      进程意外退出时最多丢失 flush_interval 秒内的情绪更新
+    - 待写入的用户数达到 max_pending 时立即刷新，限制内存占用
+    - on_flush(user_id) 在批次提交之后对其中每个用户调用，用于让依赖情绪的缓存失效
+    """
+
+    def __init__(self, flush_interval: float = 2.0, max_pending: int = 10000,
+                 max_known: int = 100000, on_flush: Callable[[str], None] = None):
+        self.flush_interval = flush_interval
+        self.on_flush = on_flush
+        self.max_pending = max_pending
+        self.max_known = max_known
+        self._pending: Dict[str, Tuple[str, str]] = {}  # user_id -> (emotion_state, updated_at)
+        self._inflight: Dict[str, Tuple[str, str]] = {}  # 正在写入、还没提交的批次
+        self._known = OrderedDict()  # user_id -> 已落库的emotion_state
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.received = 0
+        self.skipped = 0
+        self.coalesced = 0
+        self.flushed = 0
+        self.flushes = 0
+
+    def update(self, user_id: str, emotion_state: str) -> bool:
+        """记录一次情绪更新，情绪没有变化时返回False"""
+        self._ensure_started()
+        with self._lock:
+            self.received += 1
+            pending = self._pending.get(user_id) or self._inflight.get(user_id)
+            current = pending[0] if pending else self._known.get(user_id)
+            if current == emotion_state:
+                self.skipped += 1
+                return False
+            if user_id in self._pending:
+                self.coalesced += 1
+            self._pending[user_id] = (emotion_state, datetime.now().isoformat())
+            full = len(self._pending) >= self.max_pending
+
+        if full:
+            self.flush()
+        return True
+
+    def get_pending(self, user_id: str) -> Optional[Tuple[str, str]]:
+        """还没落库的情绪状态 (emotion_state, updated_at)，包括正在写入、还没提交的"""
+        with self._lock:
+            return self._pending.get(user_id) or self._inflight.get(user_id)
+
+    def observe(self, user_id: str, emotion_state: str):
+        """记录从数据库读到的情绪状态，用于跳过无变化的更新"""
+        with self._lock:
+            if user_id not in self._pending and user_id not in self._inflight:
+                self._remember(user_id, emotion_state)
+
+    def _remember(self, user_id: str, emotion_state: str):
+        self._known[user_id] = emotion_state
+        self._known.move_to_end(user_id)
+        while len(self._known) > self.max_known:
+            self._known.popitem(last=False)
+
+    def flush(self) -> int:
+        """把缓冲中的更新写入数据库，返回写入条数"""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+                # 提交之前 get_pending 仍能从 _inflight 读到这批更新
+                self._inflight = batch
+            if not batch:
+                return 0
+
+            try:
+                pool = get_pool()
+                with pool.transaction() as conn:
+                    if self.on_flush is not None:
+                        # 刷新期间读到旧情绪并缓存的结果，在提交后随版本变化失效
+                        pool.after_commit(lambda: self._notify(batch))
+                    conn.executemany(
+                        "UPDATE users SET emotion_state = ?, updated_at = ? "
+                        "WHERE user_id = ? AND emotion_state IS NOT ?",
+                        [(emotion, now, user_id, emotion) for user_id, (emotion, now) in batch.items()]
+                    )
+            except Exception:
+                # 写入失败时放回缓冲，更新的数据优先
+                with self._lock:
+                    for user_id, value in batch.items():
+                        self._pending.setdefault(user_id, value)
+                    self._inflight = {}
+                raise
+
+            with self._lock:
+                for user_id, (emotion, _now) in batch.items():
+                    self._remember(user_id, emotion)
+                # 刷新期间的新更新在 _pending 中，不受影响
+                self._inflight = {}
+                self.flushed += len(batch)
+                self.flushes += 1
+            return len(batch)
+
+    def _notify(self, batch: Dict[str, Tuple[str, str]]):
+        for user_id in batch:
+            self.on_flush(user_id)
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._stop.clear()
+                    self._thread = threading.Thread(
+                        target=self._run, name="emotion-write-behind", daemon=True
+                    )
+                    self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"情绪状态写入失败: {e}")
+
+    def stop(self):
+        """停止后台刷新线程并写入剩余更新"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+            self._thread = None
+        self.flush()
+
+    def get_stats(self) -> dict:
+        """写缓冲统计"""
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            "flush_interval": self.flush_interval,
+            "received": self.received,
+            "skipped": self.skipped,
+            "coalesced": self.coalesced,
+            "pending": pending,
+            "flushed": self.flushed,
+            "flushes": self.flushes,
+            # 每次实际写入对应多少次更新请求
+            "coalescing_ratio": self.received / self.flushed if self.flushed else 0.0
+        }
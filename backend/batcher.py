@@ -0,0 +1,143 @@
+"""
+微批处理
+把短时间内到达的单条请求攒成一批交给支持批量的后端（LLM Provider、向量编码器），
+每批只付一次固定开销，再把结果按顺序分发回各个调用方
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent import futures
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, List, Sequence
+
+
+class MicroBatcher:
+    """
+    微批处理器
+
+    - submit(item) 返回 concurrent.futures.Future；攒够 max_batch 条，或队首的请求已等待 max_wait 秒时出批
+    - handler(items) 一次处理整批，返回等长的结果列表；某一项是异常实例时只有该项的 Future 以异常结束，
+      handler 本身抛出异常时整批失败
+    - 最多 concurrency 批同时执行，出批线程不等待上一批完成
+    - 出批前已取消的 Future（future.cancel()，或 acall() 的调用方被取消）直接丢弃，不会发往后端；
+      已经出批的请求不能再取消
+    """
+
+    def __init__(self, handler: Callable[[List[Any]], Sequence[Any]], max_batch: int = 16,
+                 max_wait: float = 0.01, concurrency: int = 4, name: str = "micro-batcher"):
+        if max_batch < 1:
+            raise ValueError("max_batch 至少为1")
+        self.handler = handler
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.name = name
+        self._queue = deque()  # (提交时间, item, Future)
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=name)
+        self._thread = None
+        self._stopping = False
+        self.submitted = 0
+        self.cancelled = 0
+        self.batches = 0
+        self.dispatched = 0
+        self.failures = 0
+
+    def submit(self, item: Any) -> Future:
+        """提交一条请求，返回结果的 Future"""
+        future = Future()
+        with self._cond:
+            if self._stopping:
+                raise RuntimeError(f"{self.name} 已关闭")
+            self._queue.append((time.monotonic(), item, future))
+            self.submitted += 1
+            self._cond.notify()
+        self._ensure_started()
+        return future
+
+    def call(self, item: Any, timeout: float = None) -> Any:
+        """提交并等待结果；超时后取消请求（尚未出批时不再发往后端）并抛出 TimeoutError"""
+        future = self.submit(item)
+        try:
+            return future.result(timeout)
+        except futures.TimeoutError:
+            future.cancel()
+            raise
+
+    async def acall(self, item: Any) -> Any:
+        """在当前事件循环中等待结果；调用方被取消时请求一起取消"""
+        return await asyncio.wrap_future(self.submit(item))
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._cond:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                    self._thread.start()
+
+    def _next_batch(self) -> List[tuple]:
+        """等到可以出批时取出一批；关闭且队列为空时返回空列表"""
+        with self._cond:
+            while not self._queue and not self._stopping:
+                self._cond.wait()
+            if self._queue:
+                deadline = self._queue[0][0] + self.max_wait
+                while len(self._queue) < self.max_batch and not self._stopping:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            size = min(self.max_batch, len(self._queue))
+            return [self._queue.popleft() for _ in range(size)]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return
+            # set_running_or_notify_cancel 之后请求不能再被取消
+            live = [(item, future) for _t, item, future in batch if future.set_running_or_notify_cancel()]
+            self.cancelled += len(batch) - len(live)
+            if live:
+                self.batches += 1
+                self.dispatched += len(live)
+                self._executor.submit(self._dispatch, live)
+
+    def _dispatch(self, live: List[tuple]):
+        try:
+            results = self.handler([item for item, _future in live])
+            if len(results) != len(live):
+                raise RuntimeError(f"批量结果数 {len(results)} 与请求数 {len(live)} 不一致")
+        except BaseException as e:
+            self.failures += 1
+            for _item, future in live:
+                future.set_exception(e)
+            return
+        for (_item, future), result in zip(live, results):
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def close(self):
+        """处理完队列中的请求后停止"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join(timeout=30)
+            self._thread = None
+        self._executor.shutdown(wait=True)
+
+    def get_stats(self) -> dict:
+        """批处理统计"""
+        return {
+            "max_batch": self.max_batch,
+            "max_wait_ms": round(self.max_wait * 1000, 1),
+            "queued": len(self._queue),
+            "submitted": self.submitted,
+            "cancelled": self.cancelled,
+            "batches": self.batches,
+            "avg_batch": round(self.dispatched / self.batches, 2) if self.batches else 0.0,
+            "failures": self.failures
+        }
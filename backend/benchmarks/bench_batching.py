@@ -0,0 +1,96 @@
+"""
+微批处理吞吐/延迟压测
+Provider每次调用有固定开销 --overhead 毫秒，每条消息再加 --per-item 毫秒，最多 --concurrency 个并发调用。
+--clients 个客户端线程各自连续发送 --requests 条不同的消息，
+对比 不攒批 和不同 批大小/等待时间 下的吞吐量与延迟分位数
+
+运行方式: python benchmarks/bench_batching.py --clients 64 --requests 20
+"""
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm import LLMManager, MockProvider
+
+
+class OverheadProvider(MockProvider):
+    """每次调用固定开销 + 每条消息的处理时间；单条和批量调用共用并发上限"""
+
+    def __init__(self, overhead: float, per_item: float, concurrency: int):
+        super().__init__()
+        self.overhead = overhead
+        self.per_item = per_item
+        self._slots = threading.Semaphore(concurrency)
+        self.calls = 0
+
+    def _run(self, batch):
+        with self._slots:
+            self.calls += 1
+            time.sleep(self.overhead + self.per_item * len(batch))
+        return [f"回复:{messages[-1]['content']}" for messages in batch]
+
+    def complete(self, messages, **kwargs):
+        return self._run([messages])[0]
+
+    def complete_batch(self, batch, **kwargs):
+        return self._run(batch)
+
+
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run(args, batch_size: int, batch_wait: float) -> dict:
+    provider = OverheadProvider(args.overhead / 1000, args.per_item / 1000, args.concurrency)
+    manager = LLMManager(provider, coalesce=False, batch_size=batch_size, batch_wait=batch_wait)
+    timings = []
+    lock = threading.Lock()
+
+    def client(c):
+        for i in range(args.requests):
+            t0 = time.perf_counter()
+            manager.chat([{"role": "user", "content": f"客户端{c}的第{i}条消息"}])
+            with lock:
+                timings.append((time.perf_counter() - t0) * 1000)
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as pool:
+        list(pool.map(client, range(args.clients)))
+    elapsed = time.perf_counter() - t0
+    manager.close()
+    return {
+        "throughput": len(timings) / elapsed,
+        "p50": statistics.median(timings),
+        "p99": percentile(timings, 0.99),
+        "calls": provider.calls
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="微批处理吞吐/延迟压测")
+    parser.add_argument("--clients", type=int, default=64)
+    parser.add_argument("--requests", type=int, default=20, help="每个客户端发送的消息数")
+    parser.add_argument("--overhead", type=float, default=20.0, help="每次调用的固定开销（毫秒）")
+    parser.add_argument("--per-item", type=float, default=1.0, help="每条消息的处理时间（毫秒）")
+    parser.add_argument("--concurrency", type=int, default=8, help="Provider的并发上限")
+    args = parser.parse_args()
+
+    print(f"{args.clients} 个客户端 × {args.requests} 条消息，"
+          f"每次调用开销 {args.overhead}ms + 每条 {args.per_item}ms，并发上限 {args.concurrency}")
+    print(f"{'批大小':>6}{'等待(ms)':>10}{'吞吐(条/s)':>12}{'p50 (ms)':>10}{'p99 (ms)':>10}{'调用次数':>10}")
+    configs = [(0, 0.0), (4, 2.0), (4, 10.0), (16, 2.0), (16, 10.0), (32, 10.0)]
+    for batch_size, wait_ms in configs:
+        result = run(args, batch_size, wait_ms / 1000)
+        print(f"{batch_size or '-':>6}{wait_ms:>10.0f}{result['throughput']:>12.0f}"
+              f"{result['p50']:>10.1f}{result['p99']:>10.1f}{result['calls']:>10}")
+
+
+if __name__ == "__main__":
+    main()
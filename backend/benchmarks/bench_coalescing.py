@@ -0,0 +1,89 @@
+"""
+相同请求合并压测
+模拟广播事件（如早安问候）：--users 个线程同时发起对话，其中 --identical 比例的请求prompt完全相同。
+Provider每次调用耗时 --latency 秒、最多 --concurrency 个并发，超出的排队，
+分别在 关闭合并 / 开启合并 下统计Provider调用次数和请求延迟分位数
+
+运行方式: python benchmarks/bench_coalescing.py --users 200 --identical 0.8
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm import LLMManager, MockProvider
+
+GREETING = [{"role": "system", "content": "你是小白"}, {"role": "user", "content": "早上好"}]
+
+
+class BurstProvider(MockProvider):
+    """固定耗时、并发受限的Provider"""
+
+    def __init__(self, latency: float, concurrency: int):
+        super().__init__()
+        self.latency = latency
+        self._slots = threading.Semaphore(concurrency)
+        self.calls = 0
+
+    def chat(self, messages, **kwargs):
+        with self._slots:
+            self.calls += 1
+            time.sleep(self.latency)
+        return f"回复:{messages[-1]['content']}"
+
+
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def burst(users: int, identical: float, latency: float, concurrency: int, coalesce: bool) -> dict:
+    provider = BurstProvider(latency, concurrency)
+    manager = LLMManager(provider, coalesce=coalesce)
+    rng = random.Random(1)
+    requests = [
+        GREETING if rng.random() < identical else [GREETING[0], {"role": "user", "content": f"早上好，我是{i}号"}]
+        for i in range(users)
+    ]
+    barrier = threading.Barrier(users)
+
+    def call(messages):
+        barrier.wait()
+        t0 = time.perf_counter()
+        manager.chat(messages)
+        return (time.perf_counter() - t0) * 1000
+
+    with ThreadPoolExecutor(max_workers=users) as pool:
+        timings = list(pool.map(call, requests))
+    return {
+        "calls": provider.calls,
+        "p50": statistics.median(timings),
+        "p99": percentile(timings, 0.99),
+        "coalesced": manager.get_stats()["coalescing"]["coalesced"]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="相同请求合并压测")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--identical", type=float, default=0.8, help="prompt相同的请求比例")
+    parser.add_argument("--latency", type=float, default=0.05, help="每次Provider调用的耗时（秒）")
+    parser.add_argument("--concurrency", type=int, default=16, help="Provider的并发上限")
+    args = parser.parse_args()
+
+    print(f"{args.users} 个并发请求，{args.identical:.0%} 的prompt相同")
+    print(f"{'配置':<10}{'Provider调用':>14}{'合并':>8}{'p50 (ms)':>12}{'p99 (ms)':>12}")
+    for label, coalesce in (("不合并", False), ("合并", True)):
+        result = burst(args.users, args.identical, args.latency, args.concurrency, coalesce)
+        print(f"{label:<10}{result['calls']:>14}{result['coalesced']:>8}"
+              f"{result['p50']:>12.1f}{result['p99']:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+记忆压缩压测
+写入大量旧记忆后执行一轮压缩，同时另一个线程持续写入新记忆，
+统计压缩前后的记忆条数、压缩单批最长耗时和并发写入的延迟
+
+运行方式: python benchmarks/bench_compaction.py --memories 100000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import storage
+
+_tmpdir = tempfile.mkdtemp(prefix="bench-compaction-")
+storage.set_pool(storage.ConnectionPool(os.path.join(_tmpdir, "bench.db")))
+
+from app.compaction import MemoryCompactor
+from app.memory import add_memory, init_db
+
+TYPES = ["preference", "habit", "event", "plan"]
+
+
+def seed(count: int, users: int):
+    """写入过去一年内的随机记忆"""
+    start = datetime.now() - timedelta(days=365)
+    rows = []
+    for i in range(count):
+        created = (start + timedelta(seconds=random.randint(0, 365 * 86400))).isoformat()
+        rows.append((
+            str(uuid.uuid4()), f"bench_user_{i % users}", f"用户提到的第{i}件事",
+            random.choice(TYPES), random.randint(1, 5), created, created
+        ))
+    with storage.get_pool().transaction() as conn:
+        conn.executemany(
+            "INSERT INTO memories (memory_id, user_id, content, memory_type, importance, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            rows
+        )
+
+
+def count_memories() -> int:
+    with storage.get_pool().connection() as conn:
+        return conn.execute("SELECT COUNT(*) FROM memories").fetchone()[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="记忆压缩压测")
+    parser.add_argument("--memories", type=int, default=100000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--decay-batch-size", type=int, default=100)
+    parser.add_argument("--merge-batch-size", type=int, default=25)
+    args = parser.parse_args()
+
+    init_db()
+    seed(args.memories, args.users)
+    before = count_memories()
+
+    latencies = []
+    stop = threading.Event()
+
+    def writer():
+        i = 0
+        while not stop.is_set():
+            t0 = time.perf_counter()
+            add_memory("bench_writer", f"压缩期间写入的记忆{i}", "event", 3, dedupe=False)
+            latencies.append((time.perf_counter() - t0) * 1000)
+            i += 1
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    compactor = MemoryCompactor(
+        decay_batch_size=args.decay_batch_size, merge_batch_size=args.merge_batch_size, max_batches=1000000
+    )
+    t0 = time.perf_counter()
+    result = compactor.run()
+    elapsed = time.perf_counter() - t0
+    stop.set()
+    thread.join()
+
+    stats = compactor.get_stats()
+    latencies.sort()
+    print(f"压缩前记忆数: {before}")
+    print(f"压缩后记忆数: {count_memories() - len(latencies)}")
+    print(f"衰减: {result['decayed']}  合并: {result['merged']}  归档: {result['archived']}  摘要: {stats['summaries']}")
+    print(f"压缩耗时: {elapsed:.2f}s  批数: {stats['batches']}  单批最长: {stats['max_batch_ms']:.2f}ms")
+    print(f"并发写入 {len(latencies)} 次  p50: {statistics.median(latencies):.2f}ms  "
+          f"p99: {latencies[int(len(latencies) * 0.99)]:.2f}ms  最长: {latencies[-1]:.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
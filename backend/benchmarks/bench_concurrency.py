@@ -0,0 +1,87 @@
+"""
+并发压测
+对比在事件循环里直接执行对话（旧实现）与放到线程池执行时 /api/chat 的吞吐
+
+--io-ms 给每轮对话的数据库读写加上一段阻塞等待，模拟真实部署中的磁盘同步；
+设为0时只剩纯CPU的SQLite操作，受GIL限制线程池不会带来吞吐提升
+
+运行方式: python benchmarks/bench_concurrency.py --requests 2000 --io-ms 5
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import storage
+
+_tmpdir = tempfile.mkdtemp(prefix="bench-concurrency-")
+storage.set_pool(storage.ConnectionPool(os.path.join(_tmpdir, "bench.db")))
+
+from app import main
+
+MESSAGES = ["你好", "我喜欢打篮球", "今天好累", "你叫什么名字？", "明天天气怎么样？"]
+
+
+class InlineExecutor:
+    """模拟旧实现：直接在事件循环中执行阻塞函数"""
+
+    async def run(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+    finish = run
+
+
+async def run(clients: int, total: int) -> float:
+    """返回每秒请求数"""
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as http:
+        per_client = max(1, total // clients)
+
+        async def client(index: int):
+            for i in range(per_client):
+                await http.post("/api/chat", json={
+                    "user_id": f"bench_{index % 32}",
+                    "message": MESSAGES[i % len(MESSAGES)]
+                })
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client(i) for i in range(clients)))
+        elapsed = time.perf_counter() - start
+
+    return per_client * clients / elapsed
+
+
+def main_():
+    parser = argparse.ArgumentParser(description="并发压测")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--io-ms", type=float, default=5.0)
+    args = parser.parse_args()
+
+    begin_chat_turn = main.begin_chat_turn
+
+    def begin_chat_turn_with_io(user_id: str, message: str) -> dict:
+        time.sleep(args.io_ms / 1000)
+        return begin_chat_turn(user_id, message)
+
+    main.begin_chat_turn = begin_chat_turn_with_io
+
+    executor = main.chat_executor
+    print(f"模拟阻塞IO: {args.io_ms}ms/轮")
+    print(f"{'并发客户端':<10}{'模式':<10}{'请求/秒':>10}")
+    for clients in (1, 16, 128):
+        for mode, impl in (("事件循环", InlineExecutor()), ("线程池", executor)):
+            main.chat_executor = impl
+            rps = asyncio.run(run(clients, args.requests))
+            print(f"{clients:<14}{mode:<8}{rps:>12.1f}")
+    main.chat_executor = executor
+    executor.shutdown()
+
+
+if __name__ == "__main__":
+    main_()
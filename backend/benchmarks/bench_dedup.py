@@ -0,0 +1,89 @@
+"""
+记忆去重压测
+回放一段合成聊天记录（用户反复提到同样的喜好），对比开启/关闭去重时的记忆条数和检索延迟
+
+运行方式: python benchmarks/bench_dedup.py --turns 5000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import storage
+
+_tmpdir = tempfile.mkdtemp(prefix="bench-dedup-")
+storage.set_pool(storage.ConnectionPool(os.path.join(_tmpdir, "bench.db")))
+
+from app import chat, memory
+from app.memory import get_memories, retrieve_memories, init_db
+
+TOPICS = ["打篮球", "看电影", "喝咖啡", "跑步", "弹吉他", "养猫", "旅行", "做饭", "读书", "游泳"]
+TEMPLATES = ["我喜欢{}", "我喜欢{}！", "我真的喜欢{}", "我 喜欢{}。", "我喜欢{}啊", "我不喜欢{}"]
+SMALL_TALK = ["今天天气不错", "你在干嘛", "晚安", "早上好", "有点累了"]
+
+
+def chat_log(turns: int, seed: int = 42) -> list:
+    """生成合成聊天记录，约一半消息会提取成记忆"""
+    rng = random.Random(seed)
+    log = []
+    for _ in range(turns):
+        if rng.random() < 0.5:
+            log.append(rng.choice(TEMPLATES).format(rng.choice(TOPICS)))
+        else:
+            log.append(rng.choice(SMALL_TALK))
+    return log
+
+
+def replay(user_id: str, log: list, dedupe: bool) -> float:
+    """通过 extract_and_save_memory 回放聊天记录，返回耗时（秒）"""
+    original = memory.add_memory
+
+    def add_memory(*args, **kwargs):
+        kwargs["dedupe"] = dedupe
+        return original(*args, **kwargs)
+
+    chat.add_memory = add_memory
+    try:
+        t0 = time.perf_counter()
+        for message in log:
+            chat.extract_and_save_memory(user_id, message)
+        return time.perf_counter() - t0
+    finally:
+        chat.add_memory = original
+
+
+def measure(func, samples: int) -> float:
+    """p50延迟（毫秒）"""
+    timings = []
+    for _ in range(samples):
+        t0 = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - t0) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="记忆去重压测")
+    parser.add_argument("--turns", type=int, default=5000)
+    parser.add_argument("--samples", type=int, default=30)
+    args = parser.parse_args()
+
+    init_db()
+    log = chat_log(args.turns)
+    print(f"{'去重':>6}{'记忆数':>10}{'回放耗时 (s)':>16}{'get_memories p50 (ms)':>26}{'retrieve p50 (ms)':>22}")
+    for dedupe in (False, True):
+        user_id = f"bench_dedup_{dedupe}"
+        elapsed = replay(user_id, log, dedupe)
+        count = len(get_memories(user_id))
+        full = measure(lambda: get_memories(user_id), args.samples)
+        top = measure(lambda: retrieve_memories(user_id, "周末想去打篮球", limit=10), args.samples)
+        print(f"{'开' if dedupe else '关':>6}{count:>10}{elapsed:>16.2f}{full:>26.3f}{top:>22.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+批量情绪检测压测
+对比逐条调用 /api/emotion/detect、一次调用 /api/emotion/detect/batch 和流式接口的吞吐
+
+运行方式: python benchmarks/bench_emotion_batch.py --messages 10000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import storage
+
+_tmpdir = tempfile.mkdtemp(prefix="bench-emotion-")
+storage.set_pool(storage.ConnectionPool(os.path.join(_tmpdir, "bench.db")))
+
+from fastapi.testclient import TestClient
+
+from app.main import app
+
+MESSAGES = [
+    "我今天好开心啊！", "我很难过，想哭", "明天天气怎么样？", "今天上班好累，老板又让加班，烦死了",
+    "周末和朋友去爬山，风景不错，就是有点累", "这部电影一点也不好看，有点失望",
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批量情绪检测压测")
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--single", type=int, default=1000, help="逐条调用的消息数，结果按比例折算")
+    args = parser.parse_args()
+
+    client = TestClient(app)
+    messages = [random.choice(MESSAGES) for _ in range(args.messages)]
+
+    t0 = time.perf_counter()
+    for message in messages[:args.single]:
+        client.post("/api/emotion/detect", json={"user_id": "bench", "message": message})
+    single = args.single / (time.perf_counter() - t0)
+
+    batch_size = 10000
+    t0 = time.perf_counter()
+    for i in range(0, len(messages), batch_size):
+        client.post("/api/emotion/detect/batch", json={"messages": messages[i:i + batch_size]})
+    batch = len(messages) / (time.perf_counter() - t0)
+
+    body = "\n".join(json.dumps(message, ensure_ascii=False) for message in messages).encode("utf-8")
+    t0 = time.perf_counter()
+    response = client.post("/api/emotion/detect/batch/stream", content=body,
+                           headers={"Content-Type": "application/x-ndjson"})
+    assert len(response.text.splitlines()) == len(messages)
+    stream = len(messages) / (time.perf_counter() - t0)
+
+    print(f"{'接口':<36}{'条/秒':>12}")
+    print(f"{'/api/emotion/detect (逐条)':<36}{single:>12.0f}")
+    print(f"{'/api/emotion/detect/batch':<36}{batch:>12.0f}")
+    print(f"{'/api/emotion/detect/batch/stream':<36}{stream:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
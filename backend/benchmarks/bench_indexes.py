@@ -0,0 +1,110 @@
+"""
+索引压测
+写入大量记忆后，对比迁移前（只有主键）和迁移后的查询延迟
+
+运行方式: python benchmarks/bench_indexes.py --rows 1000000 --users 10000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.storage import ConnectionPool, migrate
+
+QUERIES = {
+    "get_memories": ("SELECT * FROM memories WHERE user_id = ? ORDER BY importance DESC", 1),
+    "get_memories(type)": (
+        "SELECT * FROM memories WHERE user_id = ? AND memory_type = ? ORDER BY importance DESC", 2
+    ),
+    "get_memory_timeline": ("""
+        SELECT date(created_at) as date, COUNT(*) as count
+        FROM memories
+        WHERE user_id = ?
+        GROUP BY date(created_at)
+        ORDER BY date DESC
+        LIMIT 30
+    """, 1),
+    "get_reminders": ("SELECT * FROM reminders WHERE user_id = ? ORDER BY created_at DESC", 1),
+}
+
+MEMORY_TYPES = ["preference", "habit", "emotion", "event"]
+
+
+def seed(pool: ConnectionPool, rows: int, users: int):
+    """写入测试数据"""
+    start = datetime.now() - timedelta(days=365)
+    batch = []
+    with pool.transaction() as conn:
+        for i in range(rows):
+            created = (start + timedelta(seconds=random.randint(0, 365 * 86400))).isoformat()
+            batch.append((
+                str(uuid.uuid4()), f"user_{i % users}", f"记忆内容{i}",
+                random.choice(MEMORY_TYPES), random.randint(1, 5), created, created
+            ))
+            if len(batch) >= 10000:
+                conn.executemany("INSERT INTO memories VALUES (?, ?, ?, ?, ?, ?, ?)", batch)
+                batch = []
+        if batch:
+            conn.executemany("INSERT INTO memories VALUES (?, ?, ?, ?, ?, ?, ?)", batch)
+
+        reminders = [
+            (str(uuid.uuid4()), f"user_{i % users}", "提醒", "内容", "fixed", "09:00", 1,
+             start.isoformat())
+            for i in range(users * 5)
+        ]
+        conn.executemany("INSERT INTO reminders VALUES (?, ?, ?, ?, ?, ?, ?, ?)", reminders)
+
+
+def measure(pool: ConnectionPool, users: int, samples: int) -> dict:
+    """每个查询的p50/p99延迟（毫秒）"""
+    results = {}
+    with pool.connection() as conn:
+        for name, (sql, arity) in QUERIES.items():
+            timings = []
+            for _ in range(samples):
+                params = (f"user_{random.randrange(users)}", "preference")[:arity]
+                t0 = time.perf_counter()
+                conn.execute(sql, params).fetchall()
+                timings.append((time.perf_counter() - t0) * 1000)
+            timings.sort()
+            results[name] = (statistics.median(timings), timings[int(len(timings) * 0.99) - 1])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="索引压测")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--samples", type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pool = ConnectionPool(os.path.join(tmp, "bench.db"))
+        migrate(pool, target=1)
+
+        t0 = time.perf_counter()
+        seed(pool, args.rows, args.users)
+        print(f"写入 {args.rows} 条记忆 / {args.users} 个用户, 耗时 {time.perf_counter() - t0:.1f}秒")
+
+        before = measure(pool, args.users, args.samples)
+        t0 = time.perf_counter()
+        migrate(pool)
+        print(f"迁移到最新版本(建索引)耗时 {time.perf_counter() - t0:.1f}秒\n")
+        after = measure(pool, args.users, args.samples)
+        pool.close()
+
+    print(f"{'查询':<22}{'迁移前 p50/p99 (ms)':>24}{'迁移后 p50/p99 (ms)':>24}")
+    for name in QUERIES:
+        b, a = before[name], after[name]
+        print(f"{name:<22}{b[0]:>12.2f}/{b[1]:<11.2f}{a[0]:>12.3f}/{a[1]:<11.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+情绪词典匹配压测
+对比逐词 in 查找与 Aho-Corasick 自动机在不同词典规模下的单条消息耗时
+
+运行方式: python benchmarks/bench_lexicon.py --sizes 24 1000 10000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.lexicon import EmotionLexicon, NEGATIVE_WORDS, POSITIVE_WORDS
+
+MESSAGES = [
+    "我今天好开心啊！", "我很难过，想哭", "明天天气怎么样？", "今天上班好累，老板又让加班，烦死了",
+    "周末和朋友去爬山，风景不错，就是有点累", "这部电影一点也不好看，有点失望",
+]
+CHARS = "的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所民得经十三之进着等部度家电力里如水化高自二理起小物现实加量都两体制机当使点从业本去把性好应开它合还因由其些然前外天政四日那社义事平形相全表间样与关各重新线内数正心反你明看原又么利比或但质气第向道命此变条只没结解问意建月公无系军很情者最立代想已通并提直题党程展五果料象员革位入常文总次品式活设及管特件长求老头基资边流路级少图山统接知较将组见计别她手角期根论运农指几九区强放决西被干做必战先回则任取据处队南给色光门即保治北造百规热领七海口东导器压志世金增争济阶油思术极交受联什认六共权收证改清己美再采转更单风切打白教速花带安场身车例真务具万每目至达走积示议声报斗完类八离华名确才科张信马节话米整空元况今集温传土许步群广石记需段研界拉林律叫且究观越织装影算低持音众书布复容儿须际商非验连断深难近矿千周委素技备半办青省列习响约支般史感劳便团往酸历市克何除消构府称太准精值号率族维划选标写存候毛亲快效斯院查江型眼王按格养易置派层片始却专状育厂京识适属圆包火住调满县局照参红细引听该铁价严龙飞"
+
+
+def old_detect(message: str, positive: list, negative: list) -> str:
+    """原来的实现：逐个词 in 查找"""
+    message_lower = message.lower()
+    for word in positive:
+        if word in message_lower:
+            return "positive"
+    for word in negative:
+        if word in message_lower:
+            return "negative"
+    return "neutral"
+
+
+def make_terms(size: int) -> dict:
+    """内置词典加上随机生成的用户词条"""
+    rng = random.Random(size)
+    terms = {**POSITIVE_WORDS, **NEGATIVE_WORDS}
+    while len(terms) < size:
+        terms["".join(rng.choice(CHARS) for _ in range(rng.randint(2, 4)))] = rng.choice([1.0, -1.0])
+    return terms
+
+
+def measure(func, rounds: int) -> float:
+    """每条消息平均耗时（微秒）"""
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        for message in MESSAGES:
+            func(message)
+    return (time.perf_counter() - t0) / (rounds * len(MESSAGES)) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="情绪词典匹配压测")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[24, 1000, 10000])
+    parser.add_argument("--rounds", type=int, default=500)
+    args = parser.parse_args()
+
+    print(f"{'词条数':>8}{'逐词in (us/条)':>20}{'Aho-Corasick (us/条)':>26}{'构建 (ms)':>14}")
+    for size in args.sizes:
+        terms = make_terms(size)
+        positive = [term for term, weight in terms.items() if weight > 0]
+        negative = [term for term, weight in terms.items() if weight < 0]
+        t0 = time.perf_counter()
+        lexicon = EmotionLexicon(terms)
+        build_ms = (time.perf_counter() - t0) * 1000
+        old = measure(lambda message: old_detect(message, positive, negative), args.rounds)
+        new = measure(lexicon.detect, args.rounds)
+        print(f"{size:>8}{old:>20.2f}{new:>26.2f}{build_ms:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
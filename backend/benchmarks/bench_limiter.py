@@ -0,0 +1,132 @@
+"""
+自适应并发限制压测
+本地起一个模拟的LLM接口：每个请求耗时 --delay 毫秒，在途请求每多一个再慢 --load-delay 毫秒（过载时越来越慢）。
+负载从 4 个并发客户端逐级增加到 --max-clients，对比 固定并发上限 和 自适应并发上限 下
+Provider端的最大在途请求数、客户端延迟分位数和最终的并发上限
+
+运行方式: python benchmarks/bench_limiter.py --max-clients 64
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm import DeepSeekProvider
+
+REPLY = json.dumps({"choices": [{"message": {"content": "你好"}}]}).encode("utf-8")
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    """在途请求越多越慢的OpenAI兼容接口"""
+
+    protocol_version = "HTTP/1.1"
+    # 响应头和响应体分两次写出，关闭Nagle避免长连接上每个请求多等一个延迟ACK
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        server = self.server
+        self.rfile.read(int(self.headers["Content-Length"]))
+        with server.lock:
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            delay = server.delay + server.load_delay * server.in_flight
+        try:
+            time.sleep(delay)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(REPLY)))
+            self.end_headers()
+            self.wfile.write(REPLY)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(delay: float, load_delay: float) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowHandler)
+    server.daemon_threads = True
+    server.request_queue_size = 256
+    server.lock = threading.Lock()
+    server.in_flight = server.max_in_flight = 0
+    server.delay, server.load_delay = delay, load_delay
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def load(provider, server, clients: int, requests: int) -> dict:
+    messages = [{"role": "user", "content": "你好"}]
+    timings, failures = [], []
+    lock = threading.Lock()
+    server.max_in_flight = 0
+
+    def client():
+        for _ in range(requests):
+            t0 = time.perf_counter()
+            try:
+                provider.complete(messages)
+            except Exception:
+                with lock:
+                    failures.append(1)
+                continue
+            with lock:
+                timings.append((time.perf_counter() - t0) * 1000)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t0
+    return {
+        "throughput": len(timings) / elapsed,
+        "p50": statistics.median(timings) if timings else 0.0,
+        "p99": percentile(timings, 0.99) if timings else 0.0,
+        "failures": len(failures),
+        "server_in_flight": server.max_in_flight,
+        "limit": provider.limiter.get_stats()["limit"]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="自适应并发限制压测")
+    parser.add_argument("--max-clients", type=int, default=64)
+    parser.add_argument("--requests", type=int, default=5, help="每个客户端的请求数")
+    parser.add_argument("--delay", type=float, default=20.0, help="空载时每个请求的耗时（毫秒）")
+    parser.add_argument("--load-delay", type=float, default=10.0, help="每多一个在途请求增加的耗时（毫秒）")
+    args = parser.parse_args()
+
+    server = start_server(args.delay / 1000, args.load_delay / 1000)
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    print(f"空载 {args.delay}ms，每个在途请求 +{args.load_delay}ms")
+    print(f"{'配置':<8}{'客户端':>8}{'吞吐(条/s)':>12}{'p50 (ms)':>10}{'p99 (ms)':>10}"
+          f"{'失败':>6}{'Provider在途':>14}{'并发上限':>10}")
+    for label, min_concurrency in (("固定", args.max_clients), ("自适应", 1)):
+        provider = DeepSeekProvider(api_key="bench", base_url=url, max_concurrency=args.max_clients,
+                                    min_concurrency=min_concurrency, timeout=30)
+        clients = 4
+        while clients <= args.max_clients:
+            r = load(provider, server, clients, args.requests)
+            print(f"{label:<8}{clients:>8}{r['throughput']:>12.1f}{r['p50']:>10.1f}{r['p99']:>10.1f}"
+                  f"{r['failures']:>6}{r['server_in_flight']:>14}{r['limit']:>10}")
+            clients *= 2
+        provider.close()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+LLM调用压测
+本地HTTP服务模拟厂商接口（每次请求固定延迟），对比每次调用新建连接与长连接池的吞吐和延迟
+
+运行方式: python benchmarks/bench_llm.py --calls 200 --threads 8 --latency-ms 20
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm import DeepSeekProvider
+
+MESSAGES = [{"role": "system", "content": "你是小白"}, {"role": "user", "content": "你好"}]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latency = 0.02
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        time.sleep(self.latency)
+        payload = json.dumps({"choices": [{"message": {"content": "你好呀"}}]}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+def new_client_call(url: str):
+    """旧实现：每次调用新建客户端和连接"""
+    with httpx.Client(timeout=30) as client:
+        response = client.post(f"{url}/v1/chat/completions", json={"model": "deepseek-chat", "messages": MESSAGES})
+        return response.json()["choices"][0]["message"]["content"]
+
+
+def run(func, calls: int, threads: int):
+    """返回 (每秒调用数, p50延迟ms)"""
+    latencies = []
+
+    def timed(_):
+        t0 = time.perf_counter()
+        func()
+        latencies.append((time.perf_counter() - t0) * 1000)
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(timed, range(calls)))
+    return calls / (time.perf_counter() - t0), statistics.median(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LLM调用压测")
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    args = parser.parse_args()
+
+    Handler.latency = args.latency_ms / 1000
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    provider = DeepSeekProvider(api_key="bench", base_url=url, max_concurrency=args.threads)
+    print(f"{'实现':<16}{'调用/秒':>12}{'p50 (ms)':>12}")
+    throughput, p50 = run(lambda: new_client_call(url), args.calls, args.threads)
+    print(f"{'每次新建连接':<16}{throughput:>12.1f}{p50:>12.2f}")
+    throughput, p50 = run(lambda: provider.chat(MESSAGES), args.calls, args.threads)
+    print(f"{'长连接池':<16}{throughput:>12.1f}{p50:>12.2f}")
+    provider.close()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
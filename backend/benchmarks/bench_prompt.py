@@ -0,0 +1,87 @@
+"""
+Prompt缓存压测
+每个用户有 --memories 条记忆，模拟多轮对话（--write-ratio 比例的消息会新增记忆），
+对比开启/关闭prompt缓存时 build_prompt 的延迟
+
+运行方式: python benchmarks/bench_prompt.py --memories 1000 --turns 2000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import storage
+
+_tmpdir = tempfile.mkdtemp(prefix="bench-prompt-")
+storage.set_pool(storage.ConnectionPool(os.path.join(_tmpdir, "bench.db")))
+
+from app import chat
+from app.memory import add_memory, create_user, get_version
+from app.prompt_cache import PromptCache
+
+TOPICS = ["打篮球", "看电影", "喝咖啡", "跑步", "弹吉他", "养猫", "旅行", "做饭", "读书", "游泳"]
+MESSAGES = ["周末想去打篮球", "最近在看什么电影", "今天喝了三杯咖啡", "晚上一起去跑步吧", "你好"]
+
+
+def seed(user_id: str, count: int):
+    """写入测试记忆"""
+    create_user(user_id)
+    start = datetime.now() - timedelta(days=365)
+    rows = []
+    for i in range(count):
+        created = (start + timedelta(seconds=random.randint(0, 365 * 86400))).isoformat()
+        rows.append((
+            str(uuid.uuid4()), user_id, f"用户提到喜欢{random.choice(TOPICS)}{i}",
+            "preference", random.randint(1, 5), created, created
+        ))
+    with storage.get_pool().transaction() as conn:
+        conn.executemany(
+            "INSERT INTO memories (memory_id, user_id, content, memory_type, importance, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            rows
+        )
+
+
+def run(users: list, turns: int, write_ratio: float, seed_value: int = 1) -> float:
+    """模拟对话，返回 build_prompt 的p50延迟（毫秒）"""
+    rng = random.Random(seed_value)
+    timings = []
+    for i in range(turns):
+        user_id = rng.choice(users)
+        if rng.random() < write_ratio:
+            add_memory(user_id, f"用户提到喜欢{rng.choice(TOPICS)}{uuid.uuid4()}", "preference", 3, dedupe=False)
+        t0 = time.perf_counter()
+        chat.build_prompt(user_id, rng.choice(MESSAGES))
+        timings.append((time.perf_counter() - t0) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prompt缓存压测")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--memories", type=int, default=1000)
+    parser.add_argument("--turns", type=int, default=2000)
+    parser.add_argument("--write-ratio", type=float, default=0.1)
+    args = parser.parse_args()
+
+    users = [f"bench_user_{i}" for i in range(args.users)]
+    for user_id in users:
+        seed(user_id, args.memories)
+
+    print(f"{'缓存':>6}{'build_prompt p50 (ms)':>24}{'命中率':>10}{'节省 (ms)':>12}")
+    for enabled in (False, True):
+        chat.prompt_cache = PromptCache(get_version, max_users=args.users if enabled else 0)
+        p50 = run(users, args.turns, args.write_ratio)
+        stats = chat.prompt_cache.get_stats()
+        print(f"{'开' if enabled else '关':>6}{p50:>24.3f}{stats['hit_ratio']:>10.2%}{stats['saved_ms']:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
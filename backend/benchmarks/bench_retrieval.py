@@ -0,0 +1,74 @@
+"""
+记忆检索压测
+对比旧的 get_memories + 截取前10条 与 retrieve_memories 在不同记忆规模下的延迟
+
+运行方式: python benchmarks/bench_retrieval.py --sizes 10 1000 100000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import storage
+
+_tmpdir = tempfile.mkdtemp(prefix="bench-retrieval-")
+storage.set_pool(storage.ConnectionPool(os.path.join(_tmpdir, "bench.db")))
+
+from app.memory import get_memories, retrieve_memories
+
+TOPICS = ["打篮球", "看电影", "喝咖啡", "跑步", "弹吉他", "养猫", "旅行", "做饭", "读书", "游泳"]
+MESSAGES = ["周末想去打篮球", "最近在看什么电影", "今天喝了三杯咖啡", "晚上一起去跑步吧"]
+
+
+def seed(user_id: str, count: int):
+    """写入测试记忆"""
+    start = datetime.now() - timedelta(days=365)
+    rows = []
+    for i in range(count):
+        created = (start + timedelta(seconds=random.randint(0, 365 * 86400))).isoformat()
+        rows.append((
+            str(uuid.uuid4()), user_id, f"用户提到喜欢{random.choice(TOPICS)}{i}",
+            "preference", random.randint(1, 5), created, created
+        ))
+    with storage.get_pool().transaction() as conn:
+        conn.executemany(
+            "INSERT INTO memories (memory_id, user_id, content, memory_type, importance, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            rows
+        )
+
+
+def measure(func, samples: int) -> float:
+    """p50延迟（毫秒）"""
+    timings = []
+    for i in range(samples):
+        t0 = time.perf_counter()
+        func(MESSAGES[i % len(MESSAGES)])
+        timings.append((time.perf_counter() - t0) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="记忆检索压测")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 100000])
+    parser.add_argument("--samples", type=int, default=30)
+    args = parser.parse_args()
+
+    print(f"{'记忆数':>8}{'get_memories[:10] p50 (ms)':>30}{'retrieve_memories p50 (ms)':>30}")
+    for size in args.sizes:
+        user_id = f"bench_user_{size}"
+        seed(user_id, size)
+        old = measure(lambda message: get_memories(user_id)[:10], args.samples)
+        new = measure(lambda message: retrieve_memories(user_id, message, limit=10), args.samples)
+        print(f"{size:>8}{old:>30.3f}{new:>30.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+语义回复缓存回放压测
+按 --users 个用户、每人 --turns 条消息回放一份语料：大部分是问候、问在不在、问天气这类
+短消息的各种说法，其余是各不相同的长消息。分别在 无缓存 / 只有精确缓存 / 精确+语义缓存
+三种配置下统计Provider调用次数，并检查命中的回复是否属于同一意图（误命中）
+
+运行方式: python benchmarks/bench_semantic_cache.py --users 50 --turns 40
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import storage
+
+_tmpdir = tempfile.mkdtemp(prefix="bench-semantic-cache-")
+storage.set_pool(storage.ConnectionPool(os.path.join(_tmpdir, "bench.db")))
+os.environ.setdefault("COMPACTION_INTERVAL", "0")
+
+from cache import ResponseCache
+from llm import MockProvider
+from app import chat
+from app.memory import create_user
+from app.semantic import SemanticCache
+
+# 每个意图的多种说法
+INTENTS = {
+    "在": ["在吗", "在吗？", "在不在", "在不在呀", "在吗在吗", "在嘛"],
+    "早": ["早上好", "早上好！", "早上好呀", "早呀", "早"],
+    "晚安": ["晚安", "晚安啦", "晚安～", "晚安哦"],
+    "天气": ["今天天气怎么样", "今天天气怎么样？", "今天天气怎么样呢", "明天天气怎么样"],
+    "名字": ["你叫什么名字", "你叫什么名字呀", "你叫什么名字？"],
+    "干嘛": ["在干嘛", "在干嘛呢", "你在干嘛", "你在干嘛呢？"],
+    "吃饭": ["吃饭了吗", "吃饭了没", "吃饭没", "吃了吗"],
+    "喜欢猫": ["我喜欢猫", "我不喜欢猫"],
+}
+
+
+class ReplayProvider(MockProvider):
+    """回复中带上意图，便于检查误命中；每次调用固定耗时 --latency 毫秒"""
+
+    def __init__(self, latency: float):
+        super().__init__()
+        self.latency = latency
+        self.calls = 0
+
+    def chat(self, messages, **kwargs):
+        self.calls += 1
+        time.sleep(self.latency)
+        return f"回复:{messages[-1]['content']}"
+
+
+def corpus(users: int, turns: int, short_ratio: float, seed: int = 1):
+    """生成回放语料 [(user_id, 消息)]"""
+    rng = random.Random(seed)
+    items = []
+    for turn in range(turns):
+        for u in range(users):
+            if rng.random() < short_ratio:
+                message = rng.choice(rng.choice(list(INTENTS.values())))
+            else:
+                message = f"今天遇到了一件事情，第{turn}次想和你聊聊，编号{u}-{rng.random():.6f}"
+            items.append((f"replay_user_{u}", message))
+    return items
+
+
+def intent_of(message: str) -> str:
+    for intent, variants in INTENTS.items():
+        if message in variants:
+            # "明天天气"和"我不喜欢猫"虽然在同一组，但意思不同，单独算
+            return intent + ("" if message not in ("明天天气怎么样", "我不喜欢猫") else "*")
+    return message
+
+
+def replay(items, latency: float, exact: bool, semantic: bool) -> dict:
+    provider = ReplayProvider(latency)
+    chat.llm_manager.provider = provider
+    chat.response_cache = ResponseCache(enabled=exact)
+    chat.semantic_cache = SemanticCache(enabled=semantic)
+    chat.llm_manager.semantic_cache = chat.semantic_cache
+    wrong = 0
+    t0 = time.perf_counter()
+    for user_id, message in items:
+        reply = chat.chat(user_id, message)["reply"]
+        if intent_of(reply[len("回复:"):]) != intent_of(message):
+            wrong += 1
+    return {"calls": provider.calls, "wrong": wrong, "seconds": time.perf_counter() - t0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="语义回复缓存回放")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--turns", type=int, default=40)
+    parser.add_argument("--short-ratio", type=float, default=0.6)
+    parser.add_argument("--latency", type=float, default=0.0, help="每次Provider调用的耗时（秒）")
+    args = parser.parse_args()
+
+    items = corpus(args.users, args.turns, args.short_ratio)
+    for u in range(args.users):
+        create_user(f"replay_user_{u}")
+
+    print(f"回放 {len(items)} 条消息，短消息比例 {args.short_ratio:.0%}")
+    print(f"{'配置':<12}{'Provider调用':>14}{'减少':>10}{'误命中':>8}{'耗时(s)':>10}")
+    baseline = None
+    for label, exact, semantic in (("无缓存", False, False), ("精确", True, False), ("精确+语义", True, True)):
+        result = replay(items, args.latency, exact, semantic)
+        baseline = baseline or result["calls"]
+        saved = 1 - result["calls"] / baseline
+        print(f"{label:<12}{result['calls']:>14}{saved:>10.1%}{result['wrong']:>8}{result['seconds']:>10.2f}")
+    print(f"语义缓存: {chat.semantic_cache.get_stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+存储层压测
+对比每次调用新建连接（旧实现）与连接池下的对话吞吐
+
+运行方式: python benchmarks/bench_storage.py --turns 2000 --threads 8
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import memory, storage
+from app.storage import ConnectionPool
+from app.write_behind import EmotionWriteBehind
+
+
+class UnpooledConnectionPool(ConnectionPool):
+    """模拟旧实现：每次调用打开新连接，用完立即关闭"""
+
+    def _acquire(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=self.timeout, check_same_thread=False)
+
+    def _release(self, conn: sqlite3.Connection):
+        if conn.in_transaction:
+            conn.rollback()
+        conn.close()
+
+
+MESSAGES = ["你好", "我喜欢打篮球", "今天好累", "你叫什么名字？", "明天天气怎么样？"]
+
+
+def run(pool: ConnectionPool, turns: int, threads: int) -> float:
+    """跑一轮对话压测，返回每秒对话数"""
+    storage.set_pool(pool)
+    # 情绪写缓冲记着上一个库里的情绪，每个连接池换一个新的
+    old = memory.emotion_buffer
+    memory.emotion_buffer = EmotionWriteBehind(flush_interval=old.flush_interval, on_flush=old.on_flush)
+    from app.memory import init_db, get_user, create_user
+    from app.reminder import init_reminder_db
+    from app.chat import chat
+
+    init_db()
+    init_reminder_db()
+    per_thread = turns // threads
+
+    def worker(index: int):
+        user_id = f"bench_user_{index}"
+        if not get_user(user_id):
+            create_user(user_id)
+        for i in range(per_thread):
+            chat(user_id, MESSAGES[i % len(MESSAGES)])
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+    # 临时目录删除之前把缓冲中的情绪写进这个库
+    memory.emotion_buffer.stop()
+    pool.close()
+    return per_thread * threads / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="存储层压测")
+    parser.add_argument("--turns", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=8)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        before = run(UnpooledConnectionPool(os.path.join(tmp, "before.db")), args.turns, args.threads)
+        after = run(ConnectionPool(os.path.join(tmp, "after.db"), max_connections=args.threads),
+                    args.turns, args.threads)
+
+    print(f"对话轮数: {args.turns}, 线程数: {args.threads}")
+    print(f"每次新建连接: {before:.1f} 次/秒")
+    print(f"连接池:       {after:.1f} 次/秒")
+    print(f"提升:         {after / before:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+流式对话压测
+模拟逐字生成的LLM（每个片段间隔 --token-ms 毫秒），对比 /api/chat 与 /api/chat/stream 的首字延迟和总耗时
+
+运行方式: python benchmarks/bench_streaming.py --requests 20 --token-ms 30
+"""
+import argparse
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+import uvicorn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import storage
+
+os.environ.setdefault("COMPACTION_INTERVAL", "0")
+
+_tmpdir = tempfile.mkdtemp(prefix="bench-streaming-")
+storage.set_pool(storage.ConnectionPool(os.path.join(_tmpdir, "bench.db")))
+
+from app import chat, main
+from app.memory import init_db
+
+MESSAGES = ["你好", "我喜欢打篮球", "今天好累", "你叫什么名字？", "明天天气怎么样？"]
+
+
+def start_server() -> str:
+    """在后台线程启动服务，返回地址"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{port}"
+
+
+def measure(http: httpx.Client, path: str, requests: int):
+    """返回 (首字延迟p50, 总耗时p50)，单位毫秒"""
+    first, total = [], []
+    for i in range(requests):
+        t0 = time.perf_counter()
+        ttft = None
+        with http.stream("POST", path, json={"user_id": "bench", "message": MESSAGES[i % len(MESSAGES)]}) as response:
+            for line in response.iter_lines():
+                if ttft is None and line:
+                    ttft = time.perf_counter() - t0
+        first.append(ttft * 1000)
+        total.append((time.perf_counter() - t0) * 1000)
+    return statistics.median(first), statistics.median(total)
+
+
+def main_():
+    parser = argparse.ArgumentParser(description="流式对话压测")
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--token-ms", type=float, default=30)
+    args = parser.parse_args()
+
+    init_db()
+    chat.llm_manager.change_provider(chat.TemplateProvider(stream_delay=args.token_ms / 1000))
+    # 非流式接口也模拟同样的生成耗时
+    provider = chat.llm_manager.provider
+    original_chat = provider.chat
+
+    def slow_chat(messages, **kwargs):
+        reply = original_chat(messages, **kwargs)
+        time.sleep(args.token_ms / 1000 * max(0, (len(reply) + provider.chunk_size - 1) // provider.chunk_size - 1))
+        return reply
+
+    base_url = start_server()
+    with httpx.Client(base_url=base_url, timeout=60) as http:
+        print(f"{'接口':<20}{'首字延迟p50 (ms)':>20}{'总耗时p50 (ms)':>18}")
+        provider.chat = slow_chat
+        ttft, total = measure(http, "/api/chat", args.requests)
+        print(f"{'/api/chat':<20}{ttft:>20.1f}{total:>18.1f}")
+        provider.chat = original_chat
+        ttft, total = measure(http, "/api/chat/stream", args.requests)
+        print(f"{'/api/chat/stream':<20}{ttft:>20.1f}{total:>18.1f}")
+
+
+if __name__ == "__main__":
+    main_()
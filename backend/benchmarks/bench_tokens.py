@@ -0,0 +1,99 @@
+"""
+token预算压测
+一个用户有 --memories 条长短不一的记忆和 --history 轮对话，
+从 --candidates 条候选记忆中按预算挑选，测 build_messages 的延迟和生成的prompt大小
+
+运行方式: python benchmarks/bench_tokens.py --memories 1000 --candidates 1000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import storage
+
+_tmpdir = tempfile.mkdtemp(prefix="bench-tokens-")
+storage.set_pool(storage.ConnectionPool(os.path.join(_tmpdir, "bench.db")))
+
+from app import chat
+from app.conversation import conversation_store
+from app.memory import create_user, retrieve_memories
+from app.tokens import CharTokenizer, TokenCounter, pack, token_counter
+
+TOPICS = ["打篮球", "看电影", "喝咖啡", "跑步", "弹吉他", "养猫", "旅行", "做饭", "读书", "游泳"]
+MESSAGES = ["周末想去打篮球", "最近在看什么电影", "今天喝了三杯咖啡", "晚上一起去跑步吧", "你好"]
+
+
+def seed(user_id: str, memories: int, history: int):
+    """写入测试记忆和对话"""
+    create_user(user_id)
+    start = datetime.now() - timedelta(days=365)
+    rows = []
+    for i in range(memories):
+        created = (start + timedelta(seconds=random.randint(0, 365 * 86400))).isoformat()
+        content = f"用户提到喜欢{random.choice(TOPICS)}{i}" + "，还说了一些细节" * random.randint(0, 8)
+        rows.append((str(uuid.uuid4()), user_id, content, "preference", random.randint(1, 5), created, created))
+    with storage.get_pool().transaction() as conn:
+        conn.executemany(
+            "INSERT INTO memories (memory_id, user_id, content, memory_type, importance, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            rows
+        )
+    for i in range(history):
+        conversation_store.append_turn(user_id, f"{random.choice(MESSAGES)}，第{i}轮", "好的呀，我记住了～")
+
+
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="token预算压测")
+    parser.add_argument("--memories", type=int, default=1000)
+    parser.add_argument("--candidates", type=int, default=1000)
+    parser.add_argument("--history", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=500)
+    args = parser.parse_args()
+
+    user_id = "bench_tokens_user"
+    seed(user_id, args.memories, args.history)
+    chat.MEMORY_CANDIDATES = args.candidates
+
+    # 单独测挑选：对 candidates 条候选记忆计数并做贪心背包，冷缓存和热缓存各一次
+    memories = retrieve_memories(user_id, "周末想去打篮球", limit=args.candidates,
+                                 candidates=args.candidates, with_score=True)
+    print(f"候选记忆 {len(memories)} 条")
+    for label, counter in (("冷缓存", TokenCounter(CharTokenizer())), ("热缓存", token_counter)):
+        if counter is token_counter:
+            for m in memories:
+                counter.count(m["content"])
+        t0 = time.perf_counter()
+        chosen = pack(memories, 300, cost=lambda m: counter.count(m["content"]) + 1,
+                      value=lambda m: m["score"], max_items=10)
+        print(f"  pack ({label}): {(time.perf_counter() - t0) * 1000:.3f}ms, 选中 {len(chosen)} 条")
+
+    print(f"{'预算':>8}{'p50 (ms)':>12}{'p99 (ms)':>12}{'prompt tokens':>16}{'消息数':>8}")
+    rng = random.Random(1)
+    for budget in (500, 1000, 4000):
+        timings = []
+        sizes = []
+        for _ in range(args.turns):
+            t0 = time.perf_counter()
+            messages = chat.build_messages(user_id, rng.choice(MESSAGES), max_tokens=budget)
+            timings.append((time.perf_counter() - t0) * 1000)
+            sizes.append(token_counter.count_messages(messages))
+        print(f"{budget:>8}{statistics.median(timings):>12.3f}{percentile(timings, 0.99):>12.3f}"
+              f"{max(sizes):>16}{len(messages):>8}")
+    print(f"token计数缓存命中率: {token_counter.get_stats()['hit_ratio']:.2%}")
+
+
+if __name__ == "__main__":
+    main()
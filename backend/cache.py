@@ -4,7 +4,11 @@
 """
 import time
 import json
-from typing import Any, Optional, Dict
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Callable, Optional, Dict, Tuple
 from functools import wraps
 import hashlib
 
@@ -84,6 +88,92 @@ def cached(ttl: int = 300, key_prefix: str = ""):
     return decorator
 
 
+class ResponseCache:
+    """
+    回复缓存
+    key 为 人设 + 规范化后的消息 + 情绪，只差标点、空白、大小写或全半角的消息共用一条；
+    条目有TTL，超过 max_entries 时淘汰最久未使用的，可多线程共用
+    """
+    
+    def __init__(self, max_entries: int = 10000, ttl: float = 3600, enabled: bool = True):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.enabled = enabled and max_entries > 0
+        self._entries = OrderedDict()  # key -> (reply, expire_time)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+    
+    @staticmethod
+    def normalize(text: str) -> str:
+        """规范化：全角转半角、转小写、去掉标点和空白"""
+        text = unicodedata.normalize("NFKC", text or "").lower()
+        return "".join(re.findall(r"\w", text))
+    
+    def key(self, persona: str, text: str, emotion: str = "") -> Optional[Tuple[str, str, str]]:
+        """缓存key，消息规范化后为空时返回None（不缓存）"""
+        normalized = self.normalize(text)
+        return (persona, normalized, emotion) if normalized else None
+    
+    def get(self, persona: str, text: str, emotion: str = "") -> Optional[str]:
+        """读取缓存的回复"""
+        key = self.key(persona, text, emotion)
+        if not self.enabled or key is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                del self._entries[key]
+                self.expired += 1
+            self.misses += 1
+        return None
+    
+    def set(self, persona: str, text: str, emotion: str, reply: str):
+        """写入回复"""
+        key = self.key(persona, text, emotion)
+        if not self.enabled or key is None:
+            return
+        with self._lock:
+            self._entries[key] = (reply, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+    
+    def get_or_compute(self, persona: str, text: str, emotion: str, compute: Callable[[], Optional[str]]) -> Optional[str]:
+        """命中时返回缓存，否则调用 compute 并缓存结果（None不缓存）"""
+        reply = self.get(persona, text, emotion)
+        if reply is None:
+            reply = compute()
+            if reply is not None:
+                self.set(persona, text, emotion, reply)
+        return reply
+    
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._entries.clear()
+    
+    def get_stats(self) -> dict:
+        """缓存统计"""
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "expired": self.expired,
+            "evictions": self.evictions
+        }
+
+
 class RedisCache:
     """Redis缓存 (可选)"""
     
@@ -0,0 +1,11 @@
+"""
+pytest配置
+测试使用临时数据库，避免污染 memory.db，也保证多次运行结果一致
+"""
+import os
+import tempfile
+
+from app import storage
+
+_tmpdir = tempfile.mkdtemp(prefix="ai-companion-test-")
+storage.set_pool(storage.ConnectionPool(os.path.join(_tmpdir, "test.db")))
@@ -1,117 +1,537 @@
 """
 AI集成模块
 支持接入各种LLM
+
+HTTP类的Provider（OpenAI/Claude/DeepSeek）是异步实现：
+- 每个Provider持有一个长连接的 httpx.AsyncClient，连接复用，不再每次调用都新建客户端
+- 每个Provider有超时（timeout / connect_timeout）和自适应的并发上限：从 max_concurrency 开始，
+  Provider变慢或出错时按AIMD降低（不低于 min_concurrency），恢复后逐步回升；超出上限的请求排队，
+  队列满（max_queue）或排队超时时直接失败，不让线程堆积在慢Provider上
+- 所有异步调用都在同一个后台事件循环线程中执行，同步的 chat()/stream() 把调用提交到这个循环并等待结果，
+  线程池中的对话流程和异步接口共用同一组连接
+
+Provider的 chat()/stream() 在失败时返回错误信息字符串；complete()/complete_stream() 及其异步版本
+在失败时抛出 ProviderError，LLMManager 和 ProviderRouter 使用后者判断成败、切换Provider，
+只看是否抛出 ProviderError，不检查回复内容。
+ProviderError 带有状态码、是否可重试和 Retry-After；HTTP类Provider对可重试的错误按指数退避（全抖动）重试，
+重试次数受重试预算限制
 """
 import os
 import json
-from typing import Optional, List, Dict
+import time
+import random
+import asyncio
+import hashlib
+import email.utils
+import threading
+from collections import deque
+from concurrent.futures import Future
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Optional, List, Dict, Iterator, AsyncIterator, Sequence, Tuple, Union
+
+import httpx
+
+from batcher import MicroBatcher
+from monitor import AdaptiveConcurrencyLimiter, CircuitBreaker, RetryBudget
+
+
+class _LoopThread:
+    """后台事件循环线程，第一次使用时启动"""
+    
+    def __init__(self):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+    
+    def get_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="llm-loop", daemon=True).start()
+                self._loop = loop
+        return self._loop
+    
+    def run_sync(self, coro):
+        """在后台循环中执行协程并阻塞等待结果（不能在后台循环线程内调用）"""
+        return asyncio.run_coroutine_threadsafe(coro, self.get_loop()).result()
+    
+    async def run_async(self, coro):
+        """在后台循环中执行协程，在当前事件循环中等待结果"""
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self.get_loop()))
+    
+    def iter_sync(self, agen: AsyncIterator) -> Iterator:
+        """同步遍历后台循环中的异步生成器；调用方中途放弃时立即关闭它，释放连接和并发名额"""
+        try:
+            while True:
+                try:
+                    yield self.run_sync(_anext(agen))
+                except StopAsyncIteration:
+                    return
+        finally:
+            self.run_sync(_aclose(agen))
+    
+    async def iter_async(self, agen: AsyncIterator) -> AsyncIterator:
+        """在当前事件循环中遍历后台循环中的异步生成器；中途放弃时同样立即关闭"""
+        try:
+            while True:
+                try:
+                    yield await self.run_async(_anext(agen))
+                except StopAsyncIteration:
+                    return
+        finally:
+            await self.run_async(_aclose(agen))
+
+
+async def _anext(agen: AsyncIterator):
+    return await agen.__anext__()
+
+
+async def _aclose(agen: AsyncIterator):
+    await agen.aclose()
+
+
+@asynccontextmanager
+async def _aclosing(agen: AsyncIterator):
+    """退出时关闭异步生成器：外层生成器被中途关闭时，内层的不会自动关闭（contextlib.aclosing 需要Python 3.10）"""
+    try:
+        yield agen
+    finally:
+        await agen.aclose()
+
+
+_llm_loop = _LoopThread()
+
+
+# 暂时性错误的HTTP状态码：超时、限流、服务端错误
+RETRYABLE_STATUS = (408, 429, 500, 502, 503, 504)
+
+
+class ProviderError(Exception):
+    """
+    Provider调用失败
+    - provider: Provider名称
+    - status: HTTP状态码，不是HTTP错误时为None
+    - retryable: 是否为暂时性错误（限流、5xx、超时、连接错误），稍后重试或换Provider可能成功
+    - retry_after: 服务端要求等待的秒数（Retry-After），没有时为None
+    - attempts: 包括重试在内一共尝试的次数
+    """
+    
+    def __init__(self, message: str, provider: str = None, status: int = None,
+                 retryable: bool = False, retry_after: float = None):
+        super().__init__(message)
+        self.provider = provider
+        self.status = status
+        self.retryable = retryable
+        self.retry_after = retry_after
+        self.attempts = 1
+
 
 class LLMProvider:
     """LLM提供商基类"""
     
+    name = "LLM"
+    
     def __init__(self, api_key: str = None):
         self.api_key = api_key
     
     def chat(self, messages: List[Dict], **kwargs) -> str:
         """发送聊天请求"""
         raise NotImplementedError
+    
+    def stream(self, messages: List[Dict], **kwargs) -> Iterator[str]:
+        """流式聊天，边生成边产出文本片段；默认一次性返回完整回复"""
+        yield self.chat(messages, **kwargs)
+    
+    async def achat(self, messages: List[Dict], **kwargs) -> str:
+        """异步聊天；默认在线程池中执行同步的 chat()"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, lambda: self.chat(messages, **kwargs))
+    
+    async def astream(self, messages: List[Dict], **kwargs) -> AsyncIterator[str]:
+        """异步流式聊天；默认一次性返回完整回复"""
+        yield await self.achat(messages, **kwargs)
+    
+    def complete(self, messages: List[Dict], **kwargs) -> str:
+        """
+        聊天，失败时抛出 ProviderError；默认调用 chat()，chat() 抛出的其他异常转换为 ProviderError。
+        不检查回复内容：子类要报告失败应当抛出 ProviderError，而不是返回错误信息
+        """
+        try:
+            reply = self.chat(messages, **kwargs)
+        except ProviderError:
+            raise
+        except Exception as e:
+            raise self._error(e) from e
+        return self._check(reply)
+    
+    def complete_stream(self, messages: List[Dict], **kwargs) -> Iterator[str]:
+        """流式聊天，失败时抛出 ProviderError；空片段（如只有角色信息的增量、保活事件）跳过"""
+        try:
+            for part in self.stream(messages, **kwargs):
+                if part:
+                    yield part
+        except ProviderError:
+            raise
+        except Exception as e:
+            raise self._error(e) from e
+    
+    async def acomplete(self, messages: List[Dict], **kwargs) -> str:
+        """异步聊天，失败时抛出 ProviderError"""
+        try:
+            reply = await self.achat(messages, **kwargs)
+        except ProviderError:
+            raise
+        except Exception as e:
+            raise self._error(e) from e
+        return self._check(reply)
+    
+    async def acomplete_stream(self, messages: List[Dict], **kwargs) -> AsyncIterator[str]:
+        """异步流式聊天，失败时抛出 ProviderError"""
+        try:
+            async with _aclosing(self.astream(messages, **kwargs)) as parts:
+                async for part in parts:
+                    if part:
+                        yield part
+        except ProviderError:
+            raise
+        except Exception as e:
+            raise self._error(e) from e
+    
+    def complete_batch(self, batch: List[List[Dict]], **kwargs) -> List[Union[str, ProviderError]]:
+        """
+        批量聊天，返回与 batch 等长的列表，失败的一项是 ProviderError 实例
+        默认在后台事件循环中并发执行每一项；有批量接口的Provider可以覆盖，一次请求处理整批
+        """
+        return _llm_loop.run_sync(self.acomplete_batch(batch, **kwargs))
+    
+    async def acomplete_batch(self, batch: List[List[Dict]], **kwargs) -> List[Union[str, ProviderError]]:
+        results = await asyncio.gather(*[self.acomplete(messages, **kwargs) for messages in batch],
+                                       return_exceptions=True)
+        return [r if isinstance(r, (str, ProviderError)) else self._error(r) for r in results]
+    
+    def _check(self, reply: str) -> str:
+        if not reply:
+            raise ProviderError(f"{self.name}调用失败: 回复为空", self.name)
+        return reply
+    
+    def _error(self, e: Exception) -> ProviderError:
+        return ProviderError(f"{self.name}调用失败: {str(e)}", self.name,
+                             retryable=isinstance(e, (ConnectionError, TimeoutError, asyncio.TimeoutError)))
+    
+    def close(self):
+        """关闭连接，默认无需处理"""
 
 
-class OpenAIProvider(LLMProvider):
-    """OpenAI provider"""
+class AsyncHTTPProvider(LLMProvider):
+    """
+    基于HTTP接口的异步Provider
+    子类实现 _request() 构造请求、_parse() 解析回复、_parse_event() 解析流式事件
+    
+    可重试的错误（RETRYABLE_STATUS、超时、连接错误）最多尝试 max_attempts 次，
+    第n次重试前等待 [0, min(backoff_max, backoff_base × 2^n)] 内的随机时间，服务端给了 Retry-After 时至少等这么久；
+    Retry-After 超过 max_retry_after 秒时不重试，交给调用方（如 ProviderRouter 换Provider）；
+    重试还要向 retry_budget 申请，预算用完时直接失败。流式请求只在产出第一个片段之前重试
+    """
+    
+    name = "LLM"
+    base_url = ""
     
-    def __init__(self, api_key: str = None, model: str = "gpt-4"):
+    def __init__(self, api_key: str = None, model: str = None, base_url: str = None,
+                 max_concurrency: int = 8, timeout: float = 60.0, connect_timeout: float = 5.0,
+                 min_concurrency: int = 1, max_queue: int = 100, queue_timeout: float = None,
+                 max_attempts: int = 3, backoff_base: float = 0.5, backoff_max: float = 8.0,
+                 max_retry_after: float = 30.0, retry_budget: RetryBudget = None):
         super().__init__(api_key)
         self.model = model
+        self.base_url = (base_url or self.base_url).rstrip("/")
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self._client: Optional[httpx.AsyncClient] = None
+        # min_concurrency 等于 max_concurrency 时为固定并发上限
+        self.limiter = AdaptiveConcurrencyLimiter(
+            initial_limit=max_concurrency,
+            min_limit=min(min_concurrency, max_concurrency),
+            max_limit=max_concurrency,
+            max_queue=max_queue,
+            queue_timeout=timeout if queue_timeout is None else queue_timeout
+        )
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_retry_after = max_retry_after
+        self.retry_budget = retry_budget or RetryBudget()
+        self.retries = 0
+        self.gave_up = 0
     
-    def chat(self, messages: List[Dict], **kwargs) -> str:
-        """调用OpenAI API"""
-        try:
-            import openai
-            openai.api_key = self.api_key or os.getenv("OPENAI_API_KEY")
-            
-            response = openai.ChatCompletion.create(
-                model=self.model,
-                messages=messages,
-                **kwargs
+    def _get_client(self) -> httpx.AsyncClient:
+        """长连接客户端，在后台事件循环中第一次使用时创建"""
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(max_connections=self.max_concurrency,
+                                    max_keepalive_connections=self.max_concurrency)
             )
-            return response.choices[0].message.content
+        return self._client
+    
+    def _request(self, messages: List[Dict], stream: bool, **kwargs) -> dict:
+        """返回 httpx 请求参数 {"url": ..., "headers": ..., "json": ...}"""
+        raise NotImplementedError
+    
+    def _parse(self, result: dict) -> str:
+        raise NotImplementedError
+    
+    def _parse_event(self, event: dict) -> Optional[str]:
+        raise NotImplementedError
+    
+    def chat(self, messages: List[Dict], **kwargs) -> str:
+        """发送聊天请求（同步，在后台事件循环中执行）"""
+        return _llm_loop.run_sync(self.achat(messages, **kwargs))
+    
+    def stream(self, messages: List[Dict], **kwargs) -> Iterator[str]:
+        """流式聊天（同步，在后台事件循环中执行）"""
+        return _llm_loop.iter_sync(self.astream(messages, **kwargs))
+    
+    def complete(self, messages: List[Dict], **kwargs) -> str:
+        return _llm_loop.run_sync(self.acomplete(messages, **kwargs))
+    
+    def complete_stream(self, messages: List[Dict], **kwargs) -> Iterator[str]:
+        return _llm_loop.iter_sync(self.acomplete_stream(messages, **kwargs))
+    
+    async def achat(self, messages: List[Dict], **kwargs) -> str:
+        """异步聊天"""
+        try:
+            return await self.acomplete(messages, **kwargs)
+        except ProviderError as e:
+            return str(e)
+    
+    async def astream(self, messages: List[Dict], **kwargs) -> AsyncIterator[str]:
+        """异步流式聊天"""
+        try:
+            async with _aclosing(self.acomplete_stream(messages, **kwargs)) as parts:
+                async for text in parts:
+                    yield text
+        except ProviderError as e:
+            yield str(e)
+    
+    async def acomplete(self, messages: List[Dict], **kwargs) -> str:
+        self.retry_budget.record_request()
+        attempt = 0
+        while True:
+            try:
+                return await self._acomplete_once(messages, **kwargs)
+            except ProviderError as e:
+                delay = self._retry_delay(e, attempt)
+                if delay is None:
+                    e.attempts = attempt + 1
+                    raise
+            attempt += 1
+            await asyncio.sleep(delay)
+    
+    async def acomplete_stream(self, messages: List[Dict], **kwargs) -> AsyncIterator[str]:
+        self.retry_budget.record_request()
+        attempt = 0
+        while True:
+            produced = False
+            try:
+                async with _aclosing(self._astream_once(messages, **kwargs)) as parts:
+                    async for text in parts:
+                        produced = True
+                        yield text
+                return
+            except ProviderError as e:
+                # 已经产出了部分回复时不能重试
+                delay = None if produced else self._retry_delay(e, attempt)
+                if delay is None:
+                    e.attempts = attempt + 1
+                    raise
+            attempt += 1
+            await asyncio.sleep(delay)
+    
+    def _retry_delay(self, error: ProviderError, attempt: int) -> Optional[float]:
+        """第 attempt 次尝试失败后的等待秒数，不应重试时返回None"""
+        if not error.retryable or attempt + 1 >= self.max_attempts:
+            return None
+        if error.retry_after is not None and error.retry_after > self.max_retry_after:
+            self.gave_up += 1
+            return None
+        if not self.retry_budget.try_acquire():
+            self.gave_up += 1
+            return None
+        self.retries += 1
+        return backoff_delay(attempt, self.backoff_base, self.backoff_max, error.retry_after)
+    
+    async def _acomplete_once(self, messages: List[Dict], **kwargs) -> str:
+        client = self._get_client()
+        try:
+            async with self.limiter.slot(is_overload=_is_overload):
+                response = await client.post(**self._request(messages, stream=False, **kwargs))
+                response.raise_for_status()
+                return self._parse(response.json())
+        except ProviderError:
+            raise
+        except Exception as e:
+            raise self._error(e) from e
+    
+    async def _astream_once(self, messages: List[Dict], **kwargs) -> AsyncIterator[str]:
+        """解析SSE的 data: 行"""
+        client = self._get_client()
+        try:
+            async with self.limiter.slot(measure=False, is_overload=_is_overload):
+                async with client.stream("POST", **self._request(messages, stream=True, **kwargs)) as response:
+                    response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        payload = line[len("data:"):].strip()
+                        if payload == "[DONE]":
+                            break
+                        text = self._parse_event(json.loads(payload))
+                        if text:
+                            yield text
+        except ProviderError:
+            raise
         except Exception as e:
-            return f"OpenAI调用失败: {str(e)}"
+            raise self._error(e) from e
+    
+    def _error(self, e: Exception) -> ProviderError:
+        """按异常类型区分暂时性错误和永久错误"""
+        message = f"{self.name}调用失败: {str(e)}"
+        if isinstance(e, httpx.HTTPStatusError):
+            status = e.response.status_code
+            return ProviderError(message, self.name, status=status, retryable=status in RETRYABLE_STATUS,
+                                 retry_after=_retry_after(e.response))
+        return ProviderError(message, self.name, retryable=isinstance(e, httpx.TransportError))
+    
+    def get_stats(self) -> dict:
+        """并发限制和重试统计"""
+        return {
+            "concurrency": self.limiter.get_stats(),
+            "retries": {**self.retry_budget.get_stats(), "gave_up": self.gave_up}
+        }
+    
+    async def aclose(self):
+        """关闭连接"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+    
+    def close(self):
+        """关闭连接（同步）"""
+        if self._client is not None:
+            _llm_loop.run_sync(self.aclose())
 
 
-class ClaudeProvider(LLMProvider):
-    """Claude provider"""
+class OpenAIProvider(AsyncHTTPProvider):
+    """OpenAI provider，也适用于其他兼容OpenAI接口的服务"""
     
-    def __init__(self, api_key: str = None, model: str = "claude-3-opus"):
-        super().__init__(api_key)
-        self.model = model
+    name = "OpenAI"
+    base_url = "https://api.openai.com"
+    api_key_env = "OPENAI_API_KEY"
     
-    def chat(self, messages: List[Dict], **kwargs) -> str:
-        """调用Claude API"""
-        try:
-            import anthropic
-            client = anthropic.Anthropic(api_key=self.api_key or os.getenv("ANTHROPIC_API_KEY"))
-            
-            # 转换消息格式
-            system = ""
-            claude_messages = []
-            for msg in messages:
-                if msg["role"] == "system":
-                    system = msg["content"]
-                else:
-                    claude_messages.append(msg)
-            
-            response = client.messages.create(
-                model=self.model,
-                system=system,
-                messages=claude_messages,
-                **kwargs
-            )
-            return response.content[0].text
-        except Exception as e:
-            return f"Claude调用失败: {str(e)}"
+    def __init__(self, api_key: str = None, model: str = "gpt-4", **kwargs):
+        super().__init__(api_key, model, **kwargs)
+    
+    def _request(self, messages: List[Dict], stream: bool, **kwargs) -> dict:
+        return {
+            "url": "/v1/chat/completions",
+            "headers": {"Authorization": f"Bearer {self.api_key or os.getenv(self.api_key_env)}"},
+            "json": {"model": self.model, "messages": messages, "stream": stream, **kwargs}
+        }
+    
+    def _parse(self, result: dict) -> str:
+        return result["choices"][0]["message"]["content"]
+    
+    def _parse_event(self, event: dict) -> Optional[str]:
+        return event["choices"][0]["delta"].get("content")
 
 
-class DeepSeekProvider(LLMProvider):
-    """DeepSeek provider"""
+class ClaudeProvider(AsyncHTTPProvider):
+    """Claude provider"""
     
-    def __init__(self, api_key: str = None, model: str = "deepseek-chat"):
-        super().__init__(api_key)
-        self.model = model
-        self.base_url = "https://api.deepseek.com"
+    name = "Claude"
+    base_url = "https://api.anthropic.com"
     
-    def chat(self, messages: List[Dict], **kwargs) -> str:
-        """调用DeepSeek API"""
-        try:
-            import requests
-            
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {self.api_key or os.getenv('DEEPSEEK_API_KEY')}"
-            }
-            
-            data = {
+    def __init__(self, api_key: str = None, model: str = "claude-3-opus", max_tokens: int = 1024, **kwargs):
+        super().__init__(api_key, model, **kwargs)
+        self.max_tokens = max_tokens
+    
+    def _request(self, messages: List[Dict], stream: bool, **kwargs) -> dict:
+        # 转换消息格式
+        system = ""
+        claude_messages = []
+        for msg in messages:
+            if msg["role"] == "system":
+                system = msg["content"]
+            else:
+                claude_messages.append(msg)
+        
+        return {
+            "url": "/v1/messages",
+            "headers": {
+                "x-api-key": self.api_key or os.getenv("ANTHROPIC_API_KEY") or "",
+                "anthropic-version": "2023-06-01"
+            },
+            "json": {
                 "model": self.model,
-                "messages": messages,
+                "system": system,
+                "messages": claude_messages,
+                "max_tokens": kwargs.pop("max_tokens", self.max_tokens),
+                "stream": stream,
                 **kwargs
             }
-            
-            response = requests.post(
-                f"{self.base_url}/v1/chat/completions",
-                headers=headers,
-                json=data,
-                timeout=30
-            )
-            
-            result = response.json()
-            return result["choices"][0]["message"]["content"]
-        except Exception as e:
-            return f"DeepSeek调用失败: {str(e)}"
+        }
+    
+    def _parse(self, result: dict) -> str:
+        return result["content"][0]["text"]
+    
+    def _parse_event(self, event: dict) -> Optional[str]:
+        if event.get("type") == "content_block_delta":
+            return event["delta"].get("text")
+        return None
+
+
+class DeepSeekProvider(OpenAIProvider):
+    """DeepSeek provider（兼容OpenAI接口）"""
+    
+    name = "DeepSeek"
+    base_url = "https://api.deepseek.com"
+    api_key_env = "DEEPSEEK_API_KEY"
+    
+    def __init__(self, api_key: str = None, model: str = "deepseek-chat", **kwargs):
+        super().__init__(api_key, model, **kwargs)
 
 
 class MockProvider(LLMProvider):
-    """模拟Provider - 用于测试"""
+    """
+    模拟Provider - 用于测试
+    stream() 把回复按 chunk_size 个字切片产出，每片之间等待 stream_delay 秒，模拟逐字生成
+    """
+    
+    name = "Mock"
+    
+    def __init__(self, api_key: str = None, chunk_size: int = 2, stream_delay: float = 0.0):
+        super().__init__(api_key)
+        self.chunk_size = chunk_size
+        self.stream_delay = stream_delay
+    
+    def stream(self, messages: List[Dict], **kwargs) -> Iterator[str]:
+        """流式返回模拟回复"""
+        reply = self.chat(messages, **kwargs)
+        for i in range(0, len(reply), self.chunk_size):
+            if i and self.stream_delay:
+                time.sleep(self.stream_delay)
+            yield reply[i:i + self.chunk_size]
+    
+    async def achat(self, messages: List[Dict], **kwargs) -> str:
+        return self.chat(messages, **kwargs)
+    
+    async def astream(self, messages: List[Dict], **kwargs) -> AsyncIterator[str]:
+        reply = self.chat(messages, **kwargs)
+        for i in range(0, len(reply), self.chunk_size):
+            if i and self.stream_delay:
+                await asyncio.sleep(self.stream_delay)
+            yield reply[i:i + self.chunk_size]
     
     def chat(self, messages: List[Dict], **kwargs) -> str:
         """返回模拟回复"""
@@ -137,8 +557,303 @@ class MockProvider(LLMProvider):
             return random.choice(responses)
 
 
+class _Route:
+    """路由中的一个Provider：断路器和延迟统计"""
+    
+    def __init__(self, provider: LLMProvider, breaker: CircuitBreaker, window: int):
+        self.provider = provider
+        self.breaker = breaker
+        self.ewma: Optional[float] = None
+        self.latencies = deque(maxlen=window)
+        self.calls = 0
+        self.successes = 0
+        self.failures = 0
+        self.hedged = 0
+    
+    def observe(self, seconds: float, alpha: float, sample: bool = True):
+        """更新EWMA延迟；sample 为True时同时计入分位数窗口"""
+        self.ewma = seconds if self.ewma is None else alpha * seconds + (1 - alpha) * self.ewma
+        if sample:
+            self.latencies.append(seconds)
+    
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        values = sorted(self.latencies)
+        return values[min(len(values) - 1, int(len(values) * q))]
+    
+    def get_stats(self) -> dict:
+        p95 = self.quantile(0.95)
+        return {
+            "name": self.provider.name,
+            "state": self.breaker.get_state(),
+            "ewma_ms": round(self.ewma * 1000, 1) if self.ewma is not None else None,
+            "p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+            "calls": self.calls,
+            "successes": self.successes,
+            "failures": self.failures,
+            "hedged": self.hedged
+        }
+
+
+class ProviderRouter(LLMProvider):
+    """
+    多Provider路由
+    
+    - 按EWMA延迟从低到高选择Provider，还没有延迟数据的排在有数据的后面，相同时按传入的顺序；
+      新加入的Provider通过对冲和失败切换得到第一批延迟数据
+    - 每个Provider有一个断路器（monitor.CircuitBreaker），连续失败 failure_threshold 次后
+      跳过 recovery_timeout 秒，之后放行试探请求
+    - 对冲请求：第一个Provider超过它的p95延迟（样本不足 min_samples 时用 hedge_delay）还没有返回时，
+      再向下一个Provider发出同样的请求，先成功的回复胜出，其余的取消；最多同时对冲 max_hedges 个。
+      落败的Provider至少已经耗时这么久，按已耗时计入EWMA，慢的Provider下一次就排到后面
+    - 失败时依次换下一个Provider；全部失败时抛出 ProviderError
+    - 流式请求不对冲，只在产出第一个片段之前失败时换Provider；成功时按首个片段的耗时计入延迟
+    """
+    
+    name = "Router"
+    
+    def __init__(self, providers: Sequence[LLMProvider], hedge_delay: float = 2.0, hedge_quantile: float = 0.95,
+                 max_hedges: int = 1, min_samples: int = 20, ewma_alpha: float = 0.2,
+                 failure_threshold: int = 5, recovery_timeout: int = 30, window: int = 200):
+        super().__init__()
+        if not providers:
+            raise ValueError("至少需要一个Provider")
+        self.routes = [
+            _Route(provider, CircuitBreaker(failure_threshold, recovery_timeout), window)
+            for provider in providers
+        ]
+        self.hedge_delay = hedge_delay
+        self.hedge_quantile = hedge_quantile
+        self.max_hedges = max_hedges
+        self.min_samples = min_samples
+        self.ewma_alpha = ewma_alpha
+        self.hedges = 0
+        self.exhausted = 0
+    
+    @property
+    def providers(self) -> List[LLMProvider]:
+        return [route.provider for route in self.routes]
+    
+    def _candidates(self) -> List[_Route]:
+        """断路器放行的Provider，按EWMA延迟排序"""
+        routes = [route for route in self.routes if route.breaker.allow_request()]
+        return sorted(routes, key=lambda route: float("inf") if route.ewma is None else route.ewma)
+    
+    def _deadline(self, route: _Route) -> float:
+        """对冲前等待的秒数"""
+        if len(route.latencies) < self.min_samples:
+            return self.hedge_delay
+        return route.quantile(self.hedge_quantile)
+    
+    def _failed(self, route: _Route, started: float):
+        route.failures += 1
+        route.breaker.record_failure()
+        # 失败也计入EWMA（至少按 hedge_delay 计），一直失败的Provider排到后面
+        route.observe(max(time.perf_counter() - started, self.hedge_delay), self.ewma_alpha, sample=False)
+    
+    def _succeeded(self, route: _Route, started: float, finished: float = None):
+        route.successes += 1
+        route.breaker.record_success()
+        route.observe((finished or time.perf_counter()) - started, self.ewma_alpha)
+    
+    def _exhausted(self, errors: List[str]) -> ProviderError:
+        self.exhausted += 1
+        return ProviderError("；".join(errors) or "没有可用的Provider（断路器均已打开）", self.name)
+    
+    def chat(self, messages: List[Dict], **kwargs) -> str:
+        try:
+            return self.complete(messages, **kwargs)
+        except ProviderError as e:
+            return str(e)
+    
+    def stream(self, messages: List[Dict], **kwargs) -> Iterator[str]:
+        try:
+            yield from self.complete_stream(messages, **kwargs)
+        except ProviderError as e:
+            yield str(e)
+    
+    async def achat(self, messages: List[Dict], **kwargs) -> str:
+        try:
+            return await self.acomplete(messages, **kwargs)
+        except ProviderError as e:
+            return str(e)
+    
+    async def astream(self, messages: List[Dict], **kwargs) -> AsyncIterator[str]:
+        try:
+            async for text in self.acomplete_stream(messages, **kwargs):
+                yield text
+        except ProviderError as e:
+            yield str(e)
+    
+    def complete(self, messages: List[Dict], **kwargs) -> str:
+        return _llm_loop.run_sync(self.acomplete(messages, **kwargs))
+    
+    def complete_stream(self, messages: List[Dict], **kwargs) -> Iterator[str]:
+        return _llm_loop.iter_sync(self.acomplete_stream(messages, **kwargs))
+    
+    async def acomplete(self, messages: List[Dict], **kwargs) -> str:
+        candidates = self._candidates()
+        pending: Dict[asyncio.Future, Tuple[_Route, float]] = {}
+        errors: List[str] = []
+        hedges = 0
+        deadline = 0.0
+        won = False
+        
+        def launch():
+            nonlocal deadline
+            route = candidates.pop(0)
+            route.calls += 1
+            started = time.perf_counter()
+            task = asyncio.ensure_future(route.provider.acomplete(messages, **kwargs))
+            pending[task] = (route, started)
+            deadline = started + self._deadline(route)
+        
+        try:
+            while candidates or pending:
+                if not pending:
+                    launch()
+                timeout = None
+                if candidates and hedges < self.max_hedges:
+                    timeout = max(0.0, deadline - time.perf_counter())
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # 超过对冲时间还没有返回，向下一个Provider发出同样的请求
+                    hedges += 1
+                    self.hedges += 1
+                    candidates[0].hedged += 1
+                    launch()
+                    continue
+                for task in done:
+                    route, started = pending.pop(task)
+                    try:
+                        reply = task.result()
+                    except Exception as e:
+                        self._failed(route, started)
+                        errors.append(str(e))
+                        continue
+                    self._succeeded(route, started)
+                    won = True
+                    return reply
+            raise self._exhausted(errors)
+        finally:
+            # 对冲中落败的请求取消，不计入失败；已耗时只是延迟的下限，只计入EWMA，不进入分位数窗口
+            now = time.perf_counter()
+            for task, (route, started) in pending.items():
+                task.cancel()
+                if won:
+                    route.observe(now - started, self.ewma_alpha, sample=False)
+    
+    async def acomplete_stream(self, messages: List[Dict], **kwargs) -> AsyncIterator[str]:
+        errors: List[str] = []
+        for route in self._candidates():
+            route.calls += 1
+            started = time.perf_counter()
+            first = None
+            produced = False
+            try:
+                async with _aclosing(route.provider.acomplete_stream(messages, **kwargs)) as parts:
+                    async for text in parts:
+                        if first is None:
+                            first = time.perf_counter()
+                        produced = True
+                        yield text
+            except ProviderError as e:
+                self._failed(route, started)
+                if produced:
+                    # 已经产出了部分回复，不能再换Provider
+                    raise
+                errors.append(str(e))
+                continue
+            # 总耗时包含调用方消费片段的时间，按首个片段的耗时计入延迟
+            self._succeeded(route, started, first)
+            return
+        raise self._exhausted(errors)
+    
+    def close(self):
+        for route in self.routes:
+            route.provider.close()
+    
+    def get_stats(self) -> dict:
+        """路由统计：对冲次数、全部失败次数和各Provider的状态"""
+        return {
+            "hedges": self.hedges,
+            "exhausted": self.exhausted,
+            "providers": [route.get_stats() for route in self.routes]
+        }
+
+
+class SingleFlight:
+    """
+    合并相同的并发请求
+    同一个key同时只有一个请求在执行（leader），执行期间到达的相同请求不再发往上游，
+    等待并共享它的结果或异常；请求结束后key即释放，之后的调用重新执行
+    """
+    
+    def __init__(self):
+        self._flights: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+    
+    def _claim(self, key: str, start: Callable[[], Future] = None) -> Tuple[Future, bool]:
+        """返回key对应的 Future 以及当前调用是否为leader；start 用于在锁内发起异步的上游请求"""
+        with self._lock:
+            future = self._flights.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            future = start() if start else Future()
+            self._flights[key] = future
+            self.leaders += 1
+        future.add_done_callback(lambda f: self._release(key, f))
+        return future, True
+    
+    def _release(self, key: str, future: Future):
+        with self._lock:
+            if self._flights.get(key) is future:
+                del self._flights[key]
+    
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        """执行 fn()，相同key的并发调用只执行一次"""
+        future, leader = self._claim(key)
+        if leader:
+            try:
+                result = fn()
+            except BaseException as e:
+                future.set_exception(e)
+                raise
+            future.set_result(result)
+            return result
+        return future.result()
+    
+    async def ado(self, key: str, start: Callable[[], Future]) -> Any:
+        """
+        异步版本：start() 发起上游请求并返回 concurrent.futures.Future（如 run_coroutine_threadsafe 的返回值）
+        某个调用方被取消时不影响上游请求和其他等待者
+        """
+        future, _leader = self._claim(key, start)
+        return await asyncio.shield(asyncio.wrap_future(future))
+    
+    def get_stats(self) -> dict:
+        """合并统计：coalesced 为没有发往上游、共享了结果的调用次数"""
+        calls = self.leaders + self.coalesced
+        return {
+            "in_flight": len(self._flights),
+            "upstream_calls": self.leaders,
+            "coalesced": self.coalesced,
+            "coalesce_ratio": round(self.coalesced / calls, 4) if calls else 0.0
+        }
+
+
 class LLMManager:
-    """LLM管理器"""
+    """
+    LLM管理器
+    Provider调用失败时记录错误并返回 fallback_reply，错误信息不会发给用户，也不会进入缓存；
+    coalesce 为True时，消息列表（规范化空白后）和参数都相同的并发 chat()/achat() 只向Provider发一次请求；
+    batch_size 大于1时，没有额外参数的请求经微批处理器攒批（最多 batch_size 条或等待 batch_wait 秒），
+    用Provider的 complete_batch() 一次发出
+    """
     
     PROVIDERS = {
         "openai": OpenAIProvider,
@@ -147,18 +862,233 @@ class LLMManager:
         "mock": MockProvider
     }
     
-    def __init__(self, provider: str = "mock", **kwargs):
-        provider_class = self.PROVIDERS.get(provider, MockProvider)
-        self.provider = provider_class(**kwargs)
+    FALLBACK_REPLY = "抱歉，我刚刚走神了一下，能再说一遍吗？"
     
-    def chat(self, messages: List[Dict], **kwargs) -> str:
-        """发送聊天"""
-        return self.provider.chat(messages, **kwargs)
+    def __init__(self, provider: Union[str, LLMProvider] = "mock", semantic_cache=None,
+                 fallback_reply: str = FALLBACK_REPLY, coalesce: bool = True,
+                 batch_size: int = 0, batch_wait: float = 0.01, **kwargs):
+        # 语义缓存，需要 lookup(人设, 消息, 分区) 和 store(人设, 消息, 回复, 分区) 两个方法
+        self.semantic_cache = semantic_cache
+        self.fallback_reply = fallback_reply
+        self.coalesce = coalesce
+        self.single_flight = SingleFlight()
+        self.batcher: Optional[MicroBatcher] = None
+        if batch_size > 1:
+            self.batcher = MicroBatcher(lambda batch: self.provider.complete_batch(batch),
+                                        max_batch=batch_size, max_wait=batch_wait, name="llm-batcher")
+        self.errors = 0
+        self.last_error: Optional[str] = None
+        self.change_provider(provider, **kwargs)
+    
+    def chat(self, messages: List[Dict], cache_scope: Tuple[str, str] = None, **kwargs) -> str:
+        """
+        发送聊天
+        传入 cache_scope=(人设, 分区) 时先按最后一条用户消息查语义缓存，未命中再调用Provider；
+        调用失败时返回兜底回复，不缓存
+        """
+        reply = self._cached(messages, cache_scope)
+        if reply is not None:
+            return reply
+        try:
+            reply = self._complete(messages, **kwargs)
+        except ProviderError as e:
+            return self._fallback(e)
+        self._store(messages, cache_scope, reply)
+        return reply
+    
+    def _cached(self, messages: List[Dict], cache_scope: Optional[Tuple[str, str]]) -> Optional[str]:
+        if cache_scope is None or self.semantic_cache is None:
+            return None
+        return self.semantic_cache.lookup(cache_scope[0], _last_user_message(messages), cache_scope[1])
+    
+    def _store(self, messages: List[Dict], cache_scope: Optional[Tuple[str, str]], reply: str):
+        if cache_scope is not None and self.semantic_cache is not None:
+            self.semantic_cache.store(cache_scope[0], _last_user_message(messages), reply, cache_scope[1])
+    
+    async def _acached(self, messages: List[Dict], cache_scope: Optional[Tuple[str, str]]) -> Optional[str]:
+        # 编码消息是CPU密集的，放到线程池中，不阻塞调用方的事件循环
+        if cache_scope is None or self.semantic_cache is None:
+            return None
+        return await asyncio.get_running_loop().run_in_executor(None, self._cached, messages, cache_scope)
+    
+    async def _astore(self, messages: List[Dict], cache_scope: Optional[Tuple[str, str]], reply: str):
+        if cache_scope is not None and self.semantic_cache is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self._store, messages, cache_scope, reply)
+    
+    def complete(self, messages: List[Dict], **kwargs) -> str:
+        """发送聊天，失败时抛出 ProviderError（后台任务使用，不返回兜底回复）"""
+        return self._complete(messages, **kwargs)
+    
+    def _complete(self, messages: List[Dict], **kwargs) -> str:
+        provider = self.provider
+        if self.batcher is not None and not kwargs:
+            call = lambda: self.batcher.call(messages)
+        else:
+            call = lambda: provider.complete(messages, **kwargs)
+        if not self.coalesce:
+            return call()
+        return self.single_flight.do(_flight_key(provider, messages, kwargs), call)
     
-    def change_provider(self, provider: str, **kwargs):
-        """切换提供商"""
-        provider_class = self.PROVIDERS.get(provider, MockProvider)
-        self.provider = provider_class(**kwargs)
+    def _start(self, provider: LLMProvider, messages: List[Dict], kwargs: dict) -> Future:
+        """发起异步请求，返回 concurrent.futures.Future；取消它时尚未发出的请求不再发往Provider"""
+        if self.batcher is not None and not kwargs:
+            return self.batcher.submit(messages)
+        return asyncio.run_coroutine_threadsafe(provider.acomplete(messages, **kwargs), _llm_loop.get_loop())
+    
+    def stream(self, messages: List[Dict], cache_scope: Tuple[str, str] = None, **kwargs) -> Iterator[str]:
+        """流式聊天，cache_scope 同 chat()；命中语义缓存时整段产出，只产出了部分回复时不缓存"""
+        reply = self._cached(messages, cache_scope)
+        if reply is not None:
+            yield reply
+            return
+        parts = []
+        try:
+            for part in self.provider.complete_stream(messages, **kwargs):
+                parts.append(part)
+                yield part
+        except ProviderError as e:
+            fallback = self._fallback(e)
+            # 已经产出了部分回复时就此结束
+            if not parts:
+                yield fallback
+            return
+        self._store(messages, cache_scope, "".join(parts))
+    
+    async def achat(self, messages: List[Dict], cache_scope: Tuple[str, str] = None, **kwargs) -> str:
+        """异步聊天，在后台事件循环中执行，可以在任意事件循环中调用；cache_scope 同 chat()"""
+        reply = await self._acached(messages, cache_scope)
+        if reply is not None:
+            return reply
+        provider = self.provider
+        try:
+            if not self.coalesce:
+                reply = await asyncio.wrap_future(self._start(provider, messages, kwargs))
+            else:
+                reply = await self.single_flight.ado(_flight_key(provider, messages, kwargs),
+                                                     lambda: self._start(provider, messages, kwargs))
+        except ProviderError as e:
+            return self._fallback(e)
+        await self._astore(messages, cache_scope, reply)
+        return reply
+    
+    async def astream(self, messages: List[Dict], cache_scope: Tuple[str, str] = None, **kwargs) -> AsyncIterator[str]:
+        """异步流式聊天，cache_scope 同 stream()"""
+        reply = await self._acached(messages, cache_scope)
+        if reply is not None:
+            yield reply
+            return
+        parts = []
+        try:
+            async for part in _llm_loop.iter_async(self.provider.acomplete_stream(messages, **kwargs)):
+                parts.append(part)
+                yield part
+        except ProviderError as e:
+            fallback = self._fallback(e)
+            if not parts:
+                yield fallback
+            return
+        await self._astore(messages, cache_scope, "".join(parts))
+    
+    def _fallback(self, error: ProviderError) -> str:
+        self.errors += 1
+        self.last_error = str(error)
+        print(f"LLM调用失败，返回兜底回复: {error}")
+        return self.fallback_reply
+    
+    def is_fallback(self, reply: str) -> bool:
+        """是否为调用失败时的兜底回复"""
+        return reply == self.fallback_reply
+    
+    def close(self):
+        """关闭微批处理器和Provider的连接"""
+        if self.batcher is not None:
+            self.batcher.close()
+        self.provider.close()
+    
+    def change_provider(self, provider: Union[str, LLMProvider], **kwargs):
+        """
+        切换提供商，可以传名称或Provider实例
+        逗号分隔的多个名称（如 "deepseek,openai"）按顺序组成 ProviderRouter
+        """
+        old = getattr(self, "provider", None)
+        if isinstance(provider, LLMProvider):
+            self.provider = provider
+        elif "," in provider:
+            names = [name.strip() for name in provider.split(",") if name.strip()]
+            self.provider = ProviderRouter([self.PROVIDERS.get(name, MockProvider)() for name in names], **kwargs)
+        else:
+            provider_class = self.PROVIDERS.get(provider, MockProvider)
+            self.provider = provider_class(**kwargs)
+        if old is not None and old is not self.provider:
+            old.close()
+    
+    def get_stats(self) -> dict:
+        """调用统计；使用 ProviderRouter 时包含路由统计"""
+        stats = {
+            "provider": self.provider.name,
+            "errors": self.errors,
+            "last_error": self.last_error,
+            "coalescing": self.single_flight.get_stats()
+        }
+        if self.batcher is not None:
+            stats["batching"] = self.batcher.get_stats()
+        providers = self.provider.providers if isinstance(self.provider, ProviderRouter) else [self.provider]
+        http = {p.name: p.get_stats() for p in providers if isinstance(p, AsyncHTTPProvider)}
+        if http:
+            stats["concurrency"] = {name: s["concurrency"] for name, s in http.items()}
+            stats["retries"] = {name: s["retries"] for name, s in http.items()}
+        if isinstance(self.provider, ProviderRouter):
+            stats["router"] = self.provider.get_stats()
+        return stats
+
+
+def _last_user_message(messages: List[Dict]) -> str:
+    for message in reversed(messages):
+        if message.get("role") == "user":
+            return message.get("content") or ""
+    return ""
+
+
+def _flight_key(provider: LLMProvider, messages: List[Dict], kwargs: dict) -> str:
+    """合并请求的key：Provider实例 + 规范化空白后的消息列表 + 参数"""
+    payload = json.dumps(
+        [id(provider), [(m.get("role"), " ".join(str(m.get("content") or "").split())) for m in messages], kwargs],
+        ensure_ascii=False, sort_keys=True, default=str
+    )
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def backoff_delay(attempt: int, base: float, cap: float, retry_after: float = None) -> float:
+    """
+    第 attempt 次重试（从0开始）前的等待秒数：指数退避 + 全抖动，在 [0, min(cap, base × 2^attempt)] 内均匀随机，
+    大量请求同时失败时重试在时间上散开；服务端给了 Retry-After 时至少等待这么久
+    """
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    return delay if retry_after is None else max(delay, retry_after)
+
+
+def _retry_after(response: httpx.Response) -> Optional[float]:
+    """解析 Retry-After 头：秒数或HTTP日期"""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+def _is_overload(e: Exception) -> bool:
+    """超时、连接错误、429和5xx说明Provider过载，其余错误（鉴权、参数、解析）不调整并发上限"""
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code == 429 or e.response.status_code >= 500
+    return isinstance(e, httpx.TransportError)
+
 
 
 # 使用示例
@@ -167,6 +1097,7 @@ if __name__ == "__main__":
     llm = LLMManager("mock")
     messages = [{"role": "user", "content": "你好"}]
     print(llm.chat(messages))
+    print("".join(llm.stream(messages)))
     
     # 切换到DeepSeek
     llm.change_provider("deepseek", api_key="your-key", model="deepseek-chat")
@@ -3,9 +3,12 @@
 监控服务性能
 """
 import time
-import psutil
 import os
-from typing import Dict, Any
+import asyncio
+import threading
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Dict, Any, Optional
 from datetime import datetime
 
 class PerformanceMonitor:
@@ -46,6 +49,7 @@ class PerformanceMonitor:
     
     def get_system_stats(self) -> Dict[str, Any]:
         """获取系统统计"""
+        import psutil
         return {
             "cpu_percent": psutil.cpu_percent(),
             "memory_percent": psutil.virtual_memory().percent,
@@ -108,40 +112,257 @@ class CircuitBreaker:
         self.last_failure_time = None
         self.state = "closed"  # closed, open, half_open
     
-    def call(self, func, *args, **kwargs):
-        """执行函数"""
+    def allow_request(self) -> bool:
+        """是否放行请求；打开状态超过 timeout 秒后切换到half_open，放行试探请求"""
         if self.state == "open":
             # 检查是否应该切换到half_open
             if time.time() - self.last_failure_time > self.timeout:
                 self.state = "half_open"
             else:
-                raise Exception("断路器打开")
+                return False
+        return True
+    
+    def record_success(self):
+        """记录一次成功，连续失败计数清零"""
+        self.state = "closed"
+        self.failure_count = 0
+    
+    def record_failure(self):
+        """记录一次失败，连续失败达到阈值或试探失败时打开"""
+        self.failure_count += 1
+        self.last_failure_time = time.time()
+        if self.state == "half_open" or self.failure_count >= self.failure_threshold:
+            self.state = "open"
+    
+    def call(self, func, *args, **kwargs):
+        """执行函数"""
+        if not self.allow_request():
+            raise Exception("断路器打开")
         
         try:
             result = func(*args, **kwargs)
-            
-            # 成功
-            if self.state == "half_open":
-                self.state = "closed"
-                self.failure_count = 0
-            
-            return result
-        
         except Exception as e:
-            # 失败
-            self.failure_count += 1
-            self.last_failure_time = time.time()
-            
-            if self.failure_count >= self.failure_threshold:
-                self.state = "open"
-            
+            self.record_failure()
             raise e
+        
+        self.record_success()
+        return result
     
     def get_state(self) -> str:
         """获取状态"""
         return self.state
 
 
+class RetryBudget:
+    """
+    重试预算
+    最近 window 秒内的重试次数不超过 请求数 × ratio，另有每秒 min_per_second 次的保底（低流量时也能重试）；
+    下游整体故障时所有请求都想重试，预算限制了重试带来的额外流量，不会把故障放大成倍
+    """
+    
+    def __init__(self, ratio: float = 0.1, min_per_second: float = 1.0, window: int = 10):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.window = window
+        self._buckets = [[0, 0, 0] for _ in range(window)]  # 每秒一个桶: [秒, 请求数, 重试数]
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.exhausted = 0
+    
+    def _bucket(self, now: int) -> list:
+        bucket = self._buckets[now % self.window]
+        if bucket[0] != now:
+            bucket[:] = [now, 0, 0]
+        return bucket
+    
+    def _totals(self, now: int):
+        live = [b for b in self._buckets if now - b[0] < self.window]
+        return sum(b[1] for b in live), sum(b[2] for b in live)
+    
+    def record_request(self):
+        """记录一次请求（不含重试）"""
+        now = int(time.time())
+        with self._lock:
+            self._bucket(now)[1] += 1
+            self.requests += 1
+    
+    def try_acquire(self) -> bool:
+        """申请一次重试，预算用完时返回False"""
+        now = int(time.time())
+        with self._lock:
+            requests, retries = self._totals(now)
+            if retries >= max(self.min_per_second * self.window, requests * self.ratio):
+                self.exhausted += 1
+                return False
+            self._bucket(now)[2] += 1
+            self.retries += 1
+            return True
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """重试统计"""
+        with self._lock:
+            requests, retries = self._totals(int(time.time()))
+        return {
+            "ratio": self.ratio,
+            "window_requests": requests,
+            "window_retries": retries,
+            "requests": self.requests,
+            "retries": self.retries,
+            "exhausted": self.exhausted
+        }
+
+
+class ConcurrencyLimitExceeded(Exception):
+    """排队已满或排队超时，请求被拒绝"""
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    自适应并发限制（AIMD），在单个事件循环中使用
+    
+    - 在途请求达到 limit 时排队；队列已有 max_queue 个请求或排队超过 queue_timeout 秒时拒绝，
+      抛出 ConcurrencyLimitExceeded
+    - 请求成功且延迟不超过 基线延迟 × tolerance 时加性增：limit 每次 +1/limit，约每一轮 +1；
+      基线延迟为最近 baseline_window 次成功请求的最小延迟
+    - 请求失败（超时、连接错误等）或延迟超标时乘性减：limit × backoff，不低于 min_limit；
+      降低之前就已发出的请求再报告过载时不重复降低，避免一次拥塞把 limit 连降到底；
+      单独执行的请求延迟再高也与并发无关，不据此降低
+    - 只有在途请求接近 limit 时才增加，空闲时 limit 不会无限上涨
+    """
+    
+    def __init__(self, initial_limit: int = 8, min_limit: int = 1, max_limit: int = 64,
+                 backoff: float = 0.9, tolerance: float = 2.0, baseline_window: int = 500,
+                 max_queue: int = 100, queue_timeout: float = 30.0):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(max(min_limit, min(initial_limit, max_limit)))
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.epoch = 0  # 每次降低 limit 后加一
+        self._waiters = deque()
+        self._latencies = deque(maxlen=baseline_window)
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.increases = 0
+        self.decreases = 0
+        self.max_queue_depth = 0
+    
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+    
+    async def acquire(self):
+        """获取一个并发名额，必要时排队"""
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            self.admitted += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            raise ConcurrencyLimitExceeded(f"并发已满（上限 {int(self.limit)}，排队 {len(self._waiters)}）")
+        
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self.queued += 1
+        self.max_queue_depth = max(self.max_queue_depth, len(self._waiters))
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if waiter.done():
+                # 超时的同时拿到了名额
+                return
+            self.rejected += 1
+            raise ConcurrencyLimitExceeded(f"排队超过 {self.queue_timeout} 秒")
+        except asyncio.CancelledError:
+            if waiter.done():
+                # 已经分到的名额交给下一个排队的请求
+                self.release()
+            raise
+        finally:
+            if not waiter.done():
+                waiter.cancel()
+                self._waiters.remove(waiter)
+    
+    def release(self, latency: Optional[float] = None, ok: Optional[bool] = None, epoch: int = None):
+        """
+        归还名额并反馈结果：ok 为True时按 latency 判断是否过载，为False时视为过载；
+        为None（如请求被取消）时不调整 limit。epoch 为获取名额时的 self.epoch
+        """
+        saturated = self.in_flight >= int(self.limit) / 2
+        contended = self.in_flight > 1
+        self.in_flight -= 1
+        if ok is False:
+            self._decrease(epoch)
+        elif ok:
+            if latency is not None:
+                self._latencies.append(latency)
+                if contended and latency > min(self._latencies) * self.tolerance:
+                    self._decrease(epoch)
+                    self._wake()
+                    return
+            if saturated and self.limit < self.max_limit:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                self.increases += 1
+        self._wake()
+    
+    def _decrease(self, epoch: int = None):
+        if epoch is not None and epoch != self.epoch:
+            return
+        self.limit = max(self.min_limit, self.limit * self.backoff)
+        self.epoch += 1
+        self.decreases += 1
+    
+    def _wake(self):
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if waiter.done():
+                continue
+            self.in_flight += 1
+            self.admitted += 1
+            waiter.set_result(None)
+    
+    @asynccontextmanager
+    async def slot(self, measure: bool = True, is_overload=None):
+        """
+        async with limiter.slot(): 获取名额，结束时（包括取消和中途关闭）一定归还，并按耗时和是否抛出异常反馈
+        measure 为False时（如流式请求，耗时取决于回复长度）只按成败反馈；
+        is_overload(异常) 返回False的异常（如参数错误）不视为过载，不调整 limit
+        """
+        await self.acquire()
+        epoch = self.epoch
+        start = time.perf_counter()
+        latency, ok = None, None
+        try:
+            yield
+            latency, ok = (time.perf_counter() - start if measure else None), True
+        except Exception as e:
+            ok = False if is_overload is None or is_overload(e) else None
+            raise
+        finally:
+            # 取消、流式请求被中途关闭（GeneratorExit）等情况 ok 为None：归还名额，但不调整 limit
+            self.release(latency, ok=ok, epoch=epoch)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """当前并发上限、在途和排队请求数"""
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "queue_depth": len(self._waiters),
+            "max_queue_depth": self.max_queue_depth,
+            "baseline_ms": round(min(self._latencies) * 1000, 1) if self._latencies else None,
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "increases": self.increases,
+            "decreases": self.decreases
+        }
+
+
 # 使用示例
 if __name__ == "__main__":
     # 性能监控
@@ -5,6 +5,8 @@
 import re
 from typing import List, Dict, Optional
 
+from cache import ResponseCache
+
 class QAPair:
     """问答对"""
     
@@ -88,8 +90,10 @@ class KnowledgeBase:
 class QAEngine:
     """问答引擎"""
     
-    def __init__(self):
+    def __init__(self, response_cache: ResponseCache = None):
         self.knowledge_base = KnowledgeBase()
+        # 知识库的答案是确定的，按规范化后的问题缓存；兜底回复是随机的，不缓存
+        self.response_cache = response_cache or ResponseCache(max_entries=1000)
         self.fallback_responses = [
             "这个问题我不太确定呢...",
             "让我想想...",
@@ -101,7 +105,9 @@ class QAEngine:
     def ask(self, question: str) -> str:
         """提问"""
         # 搜索知识库
-        answer = self.knowledge_base.search(question)
+        answer = self.response_cache.get_or_compute(
+            "qa", question, "", lambda: self.knowledge_base.search(question)
+        )
         
         if answer:
             return answer
@@ -113,6 +119,8 @@ class QAEngine:
     def teach(self, question: str, answer: str):
         """教新知识"""
         self.knowledge_base.add_qa(question, answer)
+        # 新知识可能改变已缓存问题的最佳答案
+        self.response_cache.clear()
         return "我学会了！谢谢你的教导～"
 
 
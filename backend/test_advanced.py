@@ -19,6 +19,12 @@ class TestEmotionEngine:
         emotion = EmotionEngine.detect_emotion("明天天气怎么样？")
         assert emotion == "neutral"
     
+    def test_detect_many(self):
+        labels, scores = EmotionEngine.detect_many(["我今天好开心啊！", "我很难过，想哭", "明天天气怎么样？"])
+        assert list(labels) == [1, -1, 0]
+        assert scores.typecode == "f"
+        assert scores[1] < 0
+    
     def test_get_response(self):
         response = EmotionEngine.get_response("positive")
         assert response is not None
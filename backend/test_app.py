@@ -4,20 +4,57 @@
 运行方式: pytest test_app.py -v
 """
 
+import asyncio
+import httpx
+import json
 import pytest
 from fastapi.testclient import TestClient
 import sys
 import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from concurrent import futures
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 # 添加项目路径
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from app.main import app
-from app.chat import chat, detect_emotion, generate_reply
-from app.memory import get_user, create_user, add_memory, get_memories
+from monitor import AdaptiveConcurrencyLimiter, ConcurrencyLimitExceeded, RetryBudget
+from llm import (
+    ClaudeProvider, DeepSeekProvider, LLMManager, MockProvider, OpenAIProvider, ProviderError, ProviderRouter,
+    backoff_delay
+)
+from app.chat import chat, build_messages, build_prompt, conversation_summarizer, response_cache, detect_emotion, generate_reply, prompt_cache, SYSTEM_PROMPT
+from app.memory import (
+    get_user, create_user, add_memory, get_memories, search_memories, retrieve_memories,
+    update_emotion, emotion_buffer, get_version
+)
+from app import dedup, semantic, write_behind
+from app.storage import ConnectionPool, MIGRATIONS, get_pool, migrate
+from app.workers import BlockingExecutor, ServerBusy
+from app.write_behind import EmotionWriteBehind
+from app.prompt_cache import PromptCache
+from app.semantic import BatchingEncoder, HashingEncoder, SemanticCache, SemanticMemoryIndex, normalize_query
+from batcher import MicroBatcher
+from app.compaction import MemoryCompactor
+from app.lexicon import AhoCorasick, EmotionLexicon, load_terms
+from app.advanced import EmotionEngine
+from app.conversation import ConversationStore, conversation_store
+from app.summarizer import ConversationSummarizer
+from cache import ResponseCache
+from qa import QAEngine
+from app.tokens import CharTokenizer, TokenCounter, count_tokens, pack, prompt_budget
 
 client = TestClient(app)
 
+# 语义索引需要可选依赖 numpy，未安装时索引关闭，相关测试跳过
+requires_numpy = pytest.mark.skipif(semantic.np is None, reason="需要 numpy")
+
 # ==================== 对话接口测试 ====================
 
 class TestChat:
@@ -55,6 +92,322 @@ class TestChat:
         data = response.json()
         assert "天气" in data["reply"] or "weather" in data["reply"].lower()
 
+    def test_chat_new_user_concurrent(self):
+        """测试新用户的并发首条消息"""
+        def send():
+            return client.post("/api/chat", json={"user_id": "concurrent_new_user", "message": "你好"})
+
+        threads = [threading.Thread(target=send) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert get_user("concurrent_new_user") is not None
+
+    def test_chat_single_commit(self):
+        """测试一轮对话只提交一次事务"""
+        user_id = "single_commit_user"
+        create_user(user_id)
+        statements = []
+        with get_pool().connection() as conn:
+            conn.set_trace_callback(statements.append)
+            try:
+                chat(user_id, "我叫小明，我喜欢打篮球，不喜欢下雨")
+            finally:
+                conn.set_trace_callback(None)
+        commits = [s for s in statements if s.strip().upper() == "COMMIT"]
+        assert len(commits) == 1
+        assert len(get_memories(user_id)) == 3
+
+    def test_chat_rollback_on_error(self, monkeypatch):
+        """测试对话出错时整轮写入回滚"""
+        import app.chat as chat_module
+        user_id = "rollback_user"
+        create_user(user_id)
+
+        def fail(uid, message):
+            add_memory(uid, "不应保存的记忆", "event")
+            raise RuntimeError("boom")
+
+        monkeypatch.setattr(chat_module, "extract_and_save_memory", fail)
+        with pytest.raises(RuntimeError):
+            chat(user_id, "我好开心")
+        assert get_memories(user_id) == []
+
+    def test_chat_stream_sse(self):
+        """测试SSE流式对话"""
+        response = client.post("/api/chat/stream", json={"user_id": "test_stream_user", "message": "我喜欢打篮球"})
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/event-stream")
+        
+        events = []
+        for block in response.text.strip().split("\n\n"):
+            name, data = block.split("\n")
+            events.append((name[len("event: "):], json.loads(data[len("data: "):])))
+        
+        tokens = [data["text"] for name, data in events if name == "token"]
+        assert len(tokens) > 1
+        assert [name for name, _data in events[len(tokens):]] == ["emotion", "memory", "done"]
+        done = events[-1][1]
+        assert "".join(tokens) == done["reply"]
+        assert done["reply"] == chat("test_stream_user_2", "我喜欢打篮球")["reply"]
+        assert events[-3][1] == {"emotion": "positive"}
+        assert events[-2][1]["memories"][0]["content"] == "用户提到喜欢我喜欢打篮球"
+        assert get_memories("test_stream_user")
+    
+    def test_chat_stream_websocket(self):
+        """测试WebSocket流式对话，一个连接可以多轮对话"""
+        with client.websocket_connect("/ws/chat") as websocket:
+            for message in ["你好", "明天天气怎么样？"]:
+                websocket.send_json({"user_id": "test_ws_user", "message": message})
+                events = []
+                while not events or events[-1]["event"] != "done":
+                    events.append(websocket.receive_json())
+                reply = "".join(e["data"]["text"] for e in events if e["event"] == "token")
+                assert reply == events[-1]["data"]["reply"]
+        assert "天气" in reply
+    
+    def test_chat_websocket_invalid_payload(self):
+        """测试WebSocket收到格式错误的请求时回复error事件，连接仍可继续使用"""
+        with client.websocket_connect("/ws/chat") as websocket:
+            for payload in ["不是JSON", "[1, 2]", json.dumps({"user_id": "test_ws_user"})]:
+                websocket.send_text(payload)
+                assert websocket.receive_json() == {"event": "error", "data": {"detail": "请求格式错误"}}
+            websocket.send_json({"user_id": "test_ws_user", "message": "你好"})
+            events = [websocket.receive_json()]
+            while events[-1]["event"] != "done":
+                events.append(websocket.receive_json())
+    
+    def test_mock_provider_stream(self):
+        """测试模拟Provider流式输出"""
+        manager = LLMManager(MockProvider(chunk_size=1))
+        messages = [{"role": "user", "content": "你好"}]
+        tokens = list(manager.stream(messages))
+        assert len(tokens) > 1
+        assert "".join(tokens) == manager.chat(messages)
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    """模拟的LLM厂商接口（OpenAI兼容接口和Claude接口）"""
+    
+    protocol_version = "HTTP/1.1"
+    # 响应头和响应体分两次写出，关闭Nagle避免长连接上每个请求多等一个延迟ACK
+    disable_nagle_algorithm = True
+    
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with server.lock:
+            server.requests.append({"path": self.path, "headers": dict(self.headers), "body": body})
+            server.ports.add(self.client_address[1])
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            # load_delay 模拟过载：在途请求越多越慢
+            delay = server.delay + server.load_delay * server.in_flight
+            # schedule 中的 (状态码, 响应头) 按请求顺序依次返回，用完后正常回复
+            error = server.schedule.popleft() if server.schedule else None
+        try:
+            time.sleep(delay)
+            if error:
+                status, headers = error
+                payload = json.dumps({"error": {"message": f"模拟错误 {status}"}}).encode("utf-8")
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+                return
+            tokens = ["你好", "，我是", "模拟回复"]
+            if self.path == "/v1/messages":
+                events = [{"type": "content_block_delta", "delta": {"text": t}} for t in tokens]
+                result = {"content": [{"text": "".join(tokens)}]}
+            else:
+                events = [{"choices": [{"delta": {"content": t}}]} for t in tokens]
+                result = {"choices": [{"message": {"content": "".join(tokens)}}]}
+            if body.get("stream"):
+                lines = [f"data: {json.dumps(e, ensure_ascii=False)}\n\n" for e in events] + ["data: [DONE]\n\n"]
+                payload, content_type = "".join(lines).encode("utf-8"), "text/event-stream"
+            else:
+                payload, content_type = json.dumps(result).encode("utf-8"), "application/json"
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+    
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def llm_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockLLMHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.requests, server.ports = [], set()
+    server.in_flight = server.max_in_flight = 0
+    server.delay = server.load_delay = 0.0
+    server.schedule = deque()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class TestLLMProvider:
+    """LLM Provider测试，用本地HTTP服务模拟厂商接口"""
+    
+    messages = [{"role": "system", "content": "系统提示"}, {"role": "user", "content": "你好"}]
+    
+    def test_chat_reuses_connection(self, llm_server):
+        """测试连接复用"""
+        provider = DeepSeekProvider(api_key="test-key", base_url=llm_server.url)
+        for _ in range(5):
+            assert provider.chat(self.messages) == "你好，我是模拟回复"
+        provider.close()
+        assert len(llm_server.requests) == 5
+        assert len(llm_server.ports) == 1
+        request = llm_server.requests[0]
+        assert request["path"] == "/v1/chat/completions"
+        assert request["headers"]["Authorization"] == "Bearer test-key"
+        assert request["body"]["model"] == "deepseek-chat"
+    
+    def test_stream(self, llm_server):
+        """测试流式输出"""
+        provider = OpenAIProvider(api_key="test-key", base_url=llm_server.url)
+        assert list(provider.stream(self.messages)) == ["你好", "，我是", "模拟回复"]
+        provider.close()
+    
+    def test_claude(self, llm_server):
+        """测试Claude接口格式"""
+        provider = ClaudeProvider(api_key="test-key", base_url=llm_server.url)
+        assert provider.chat(self.messages) == "你好，我是模拟回复"
+        assert list(provider.stream(self.messages)) == ["你好", "，我是", "模拟回复"]
+        provider.close()
+        body = llm_server.requests[0]["body"]
+        assert body["system"] == "系统提示"
+        assert body["messages"] == [{"role": "user", "content": "你好"}]
+        assert llm_server.requests[0]["headers"]["x-api-key"] == "test-key"
+    
+    def test_concurrency_limit(self, llm_server):
+        """测试并发上限"""
+        llm_server.delay = 0.1
+        provider = DeepSeekProvider(api_key="test-key", base_url=llm_server.url, max_concurrency=2)
+        threads = [threading.Thread(target=provider.chat, args=(self.messages,)) for _ in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        provider.close()
+        assert len(llm_server.requests) == 6
+        assert llm_server.max_in_flight == 2
+    
+    def test_timeout(self, llm_server):
+        """测试超时"""
+        llm_server.delay = 0.5
+        provider = DeepSeekProvider(api_key="test-key", base_url=llm_server.url, timeout=0.1, max_attempts=1)
+        assert "调用失败" in provider.chat(self.messages)
+        provider.close()
+    
+    def test_async(self, llm_server):
+        """测试在其他事件循环中异步调用"""
+        manager = LLMManager(DeepSeekProvider(api_key="test-key", base_url=llm_server.url))
+        
+        async def run():
+            reply = await manager.achat(self.messages)
+            tokens = [t async for t in manager.astream(self.messages)]
+            return reply, tokens
+        
+        reply, tokens = asyncio.run(run())
+        manager.close()
+        assert reply == "".join(tokens) == "你好，我是模拟回复"
+    
+    def test_chat_uses_llm(self, llm_server, monkeypatch):
+        """测试chat()调用LLM，带上系统提示，且调用期间不持有事务"""
+        import app.chat as chat_module
+        provider = DeepSeekProvider(api_key="test-key", base_url=llm_server.url)
+        monkeypatch.setattr(chat_module, "llm_manager", LLMManager(provider))
+        user_id = "llm_chat_user"
+        create_user(user_id)
+        
+        in_transaction = []
+        original = provider.acomplete
+        
+        async def acomplete(messages, **kwargs):
+            with get_pool().connection() as conn:
+                in_transaction.append(conn.in_transaction)
+            return await original(messages, **kwargs)
+        
+        monkeypatch.setattr(provider, "acomplete", acomplete)
+        result = chat(user_id, "我喜欢打篮球")
+        provider.close()
+        assert result["reply"] == "你好，我是模拟回复"
+        body = llm_server.requests[0]["body"]
+        assert body["messages"][0]["role"] == "system"
+        assert "小白" in body["messages"][0]["content"]
+        assert body["messages"][-1] == {"role": "user", "content": "我喜欢打篮球"}
+        assert in_transaction == [False]
+        assert len(get_memories(user_id)) == 1
+
+class TestBlockingExecutor:
+    """对话线程池测试"""
+
+    def test_run(self):
+        """测试在线程池中执行"""
+        executor = BlockingExecutor(max_workers=2)
+        caller = threading.get_ident()
+        worker = asyncio.run(executor.run(threading.get_ident))
+        executor.shutdown()
+        assert worker != caller
+
+    def test_backpressure(self):
+        """测试排队已满时拒绝请求"""
+        executor = BlockingExecutor(max_workers=1, max_pending=1)
+        release = threading.Event()
+
+        async def scenario():
+            first = asyncio.ensure_future(executor.run(release.wait))
+            await asyncio.sleep(0.01)
+            with pytest.raises(ServerBusy):
+                await executor.run(lambda: None)
+            # 已接受请求的后续步骤不被拒绝
+            finishing = asyncio.ensure_future(executor.finish(lambda: "saved"))
+            release.set()
+            await first
+            assert await finishing == "saved"
+
+        asyncio.run(scenario())
+        executor.shutdown()
+        assert executor.get_stats()["rejected"] == 1
+
+    def test_llm_wait_does_not_hold_worker(self, monkeypatch):
+        """测试等待LLM回复时不占用对话线程：1个线程也能同时进行多轮对话"""
+        import app.main as main_module
+        executor = BlockingExecutor(max_workers=1, name="chat-test")
+        monkeypatch.setattr(main_module, "chat_executor", executor)
+        monkeypatch.setattr(main_module.llm_manager, "provider", FakeProvider("慢", latency=0.3))
+
+        async def scenario():
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+                return await asyncio.gather(*[
+                    http.post("/api/chat", json={"user_id": f"executor_llm_user_{i}", "message": f"第{i}个问题是什么"})
+                    for i in range(4)
+                ])
+
+        start = time.perf_counter()
+        responses = asyncio.run(scenario())
+        elapsed = time.perf_counter() - start
+        executor.shutdown()
+        assert [r.json()["reply"] for r in responses] == ["慢的回复"] * 4
+        assert elapsed < 0.9
+        assert len(conversation_store.recent("executor_llm_user_3")) == 2
+
 # ==================== 情绪检测测试 ====================
 
 class TestEmotion:
@@ -74,6 +427,79 @@ class TestEmotion:
         """测试中性情绪检测"""
         emotion = detect_emotion("明天天气怎么样？")
         assert emotion == "neutral"
+    
+    def test_negation(self):
+        """测试否定词"""
+        assert detect_emotion("我不开心") == "negative"
+        assert detect_emotion("一点也不难过") == "positive"
+        assert detect_emotion("今天还不错") == "positive"
+    
+    def test_weighted(self):
+        """测试权重和最长匹配"""
+        assert detect_emotion("好累") == "negative"
+        assert EmotionLexicon().score("烦死了") == -2.0
+    
+    def test_shared_with_engine(self):
+        """测试和 EmotionEngine 结果一致"""
+        for message in ["我今天好开心啊！", "我不开心", "好累", "明天天气怎么样？"]:
+            assert EmotionEngine.detect_emotion(message) == detect_emotion(message)
+    
+    def test_user_lexicon(self, tmp_path):
+        """测试加入用户词典"""
+        path = tmp_path / "lexicon.tsv"
+        path.write_text("# 用户词典\n绝绝子\t2\nemo\t-1\n", encoding="utf-8")
+        lexicon = EmotionLexicon()
+        lexicon.extend(load_terms(str(path)))
+        assert lexicon.detect("今天的饭绝绝子") == "positive"
+        assert lexicon.detect("有点EMO") == "negative"
+        assert lexicon.detect("没有emo") == "positive"
+    
+    def test_batch_endpoint(self):
+        """测试批量检测接口"""
+        response = client.post("/api/emotion/detect/batch", json={"messages": ["我很开心", "我不开心", "天气"]})
+        assert response.status_code == 200
+        assert response.json() == {"emotions": ["positive", "negative", "neutral"], "scores": [1.0, -1.0, 0.0]}
+    
+    def test_batch_stream_endpoint(self):
+        """测试流式批量检测接口"""
+        body = "\n".join(json.dumps(m, ensure_ascii=False) for m in ["我很开心", {"message": "好累"}, "天气"] * 700)
+        response = client.post(
+            "/api/emotion/detect/batch/stream", content=body.encode("utf-8"),
+            headers={"Content-Type": "application/x-ndjson"}
+        )
+        assert response.status_code == 200
+        results = [json.loads(line) for line in response.text.splitlines()]
+        assert len(results) == 2100
+        assert [r["emotion"] for r in results[:3]] == ["positive", "negative", "neutral"]
+
+    def test_batch_stream_bad_lines(self):
+        """测试流式批量检测中无法解析或缺少 message 的行输出错误记录，其余行照常返回"""
+        body = "\n".join([
+            json.dumps("我很开心", ensure_ascii=False),
+            "{不是JSON",
+            "",
+            json.dumps({"text": "好累"}, ensure_ascii=False),
+            json.dumps({"message": "好累"}, ensure_ascii=False),
+        ])
+        response = client.post(
+            "/api/emotion/detect/batch/stream", content=body.encode("utf-8"),
+            headers={"Content-Type": "application/x-ndjson"}
+        )
+        assert response.status_code == 200
+        results = [json.loads(line) for line in response.text.splitlines()]
+        assert len(results) == 4
+        assert results[0]["emotion"] == "positive" and results[3]["emotion"] == "negative"
+        assert results[1]["line"] == 2 and "error" in results[1]
+        assert results[2]["line"] == 4 and "error" in results[2]
+    
+    def test_aho_corasick(self):
+        """测试自动机找出所有重叠匹配"""
+        automaton = AhoCorasick()
+        for pattern in ["he", "she", "his", "hers"]:
+            automaton.add(pattern)
+        automaton.build()
+        matches = [(start, end, pattern) for start, end, pattern, _value in automaton.iter_matches("ushers")]
+        assert sorted(matches) == [(1, 4, "she"), (2, 4, "he"), (2, 6, "hers")]
 
 # ==================== 记忆模块测试 ====================
 
@@ -109,6 +535,1485 @@ class TestMemory:
         
         preference_memories = get_memories(user_id, "preference")
         assert all(m["memory_type"] == "preference" for m in preference_memories)
+    
+    def test_add_memory_dedupe(self):
+        """测试重复记忆合并到已有记忆"""
+        user_id = "test_dedupe_user"
+        first = add_memory(user_id, "用户提到喜欢我喜欢打篮球！", "preference", 3)
+        
+        # 只差标点和空白
+        same = add_memory(user_id, "用户提到喜欢 我喜欢打篮球", "preference", 3)
+        assert same["memory_id"] == first["memory_id"]
+        assert same["importance"] == 4
+        
+        # 近似重复
+        near = add_memory(user_id, "用户提到喜欢我喜欢打篮球啊", "preference", 3)
+        assert near["memory_id"] == first["memory_id"]
+        assert near["importance"] == 5
+        
+        # 内容不同、类型不同、用户不同都不算重复
+        add_memory(user_id, "用户提到喜欢我喜欢看电影", "preference", 3)
+        add_memory(user_id, "用户提到喜欢我喜欢打篮球", "habit", 3)
+        add_memory("test_dedupe_other", "用户提到喜欢我喜欢打篮球", "preference", 3)
+        assert len(get_memories(user_id)) == 3
+        
+        add_memory(user_id, "用户提到喜欢我喜欢打篮球", "preference", 3, dedupe=False)
+        assert len(get_memories(user_id)) == 4
+    
+    def test_search_memories(self):
+        """测试全文搜索记忆"""
+        user_id = "test_search_user"
+        create_user(user_id)
+        add_memory(user_id, "用户喜欢打篮球", "preference")
+        add_memory(user_id, "用户喜欢看电影", "preference")
+        add_memory("test_search_other", "用户喜欢打篮球", "preference")
+        
+        results = search_memories(user_id, "周末一起打篮球吧")
+        assert [m["content"] for m in results] == ["用户喜欢打篮球"]
+        assert all(m["user_id"] == user_id for m in results)
+        
+        # 两个字的查询走 LIKE
+        results = search_memories(user_id, "电影")
+        assert [m["content"] for m in results] == ["用户喜欢看电影"]
+        
+        assert search_memories(user_id, "游泳健身") == []
+    
+    def test_retrieve_memories(self):
+        """测试按相关度挑选记忆"""
+        user_id = "test_retrieve_user"
+        for i in range(20):
+            add_memory(user_id, f"重要但无关的记忆{i}", "fact", 5)
+        add_memory(user_id, "用户喜欢打篮球", "preference", 2)
+        
+        memories = retrieve_memories(user_id, "今天下午去打篮球了", limit=5)
+        assert len(memories) == 5
+        assert memories[0]["content"] == "用户喜欢打篮球"
+        
+        prompt = build_prompt(user_id, "今天下午去打篮球了")
+        assert "用户喜欢打篮球" in prompt
+        assert prompt.count("重要但无关的记忆") == 9
+    
+    def test_search_memories_endpoint(self):
+        """测试记忆搜索接口"""
+        user_id = "test_search_user2"
+        add_memory(user_id, "用户的猫叫咪咪", "fact")
+        response = client.get(f"/api/memory/{user_id}/search", params={"q": "猫叫咪咪"})
+        assert response.status_code == 200
+        assert response.json()["memories"][0]["content"] == "用户的猫叫咪咪"
+
+
+class TestEmotionWriteBehind:
+    """情绪状态写缓冲测试"""
+
+    def test_skip_and_coalesce(self):
+        """测试跳过无变化的更新并合并同一用户的多次更新"""
+        user_id = "write_behind_user"
+        create_user(user_id)
+        buffer = EmotionWriteBehind(flush_interval=60)
+        buffer.observe(user_id, "neutral")
+
+        buffer.update(user_id, "neutral")
+        buffer.update(user_id, "positive")
+        buffer.update(user_id, "negative")
+        buffer.update(user_id, "negative")
+        assert buffer.flush() == 1
+        buffer.stop()
+
+        stats = buffer.get_stats()
+        assert stats["received"] == 4
+        assert stats["skipped"] == 2
+        assert stats["coalesced"] == 1
+        assert stats["coalescing_ratio"] == 4
+        with get_pool().connection() as conn:
+            row = conn.execute("SELECT emotion_state FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        assert row[0] == "negative"
+
+    def test_get_user_sees_pending(self):
+        """测试未落库的情绪状态对读取可见"""
+        user_id = "write_behind_user2"
+        create_user(user_id)
+        update_emotion(user_id, "negative")
+        assert get_user(user_id)["emotion_state"] == "negative"
+        emotion_buffer.flush()
+        assert get_user(user_id)["emotion_state"] == "negative"
+
+    def test_pending_visible_during_flush(self, monkeypatch):
+        """测试刷新提交之前更新仍然可见，刷新期间的新更新不会丢失"""
+        user_id = "write_behind_user3"
+        create_user(user_id)
+        started, release = threading.Event(), threading.Event()
+        pool = get_pool()
+
+        class SlowPool:
+            @contextmanager
+            def transaction(self):
+                started.set()
+                release.wait(5)
+                with pool.transaction() as conn:
+                    yield conn
+
+        monkeypatch.setattr(write_behind, "get_pool", lambda: SlowPool())
+        buffer = EmotionWriteBehind(flush_interval=60)
+        buffer.update(user_id, "negative")
+        flusher = threading.Thread(target=buffer.flush)
+        flusher.start()
+        assert started.wait(5)
+        assert buffer.get_pending(user_id)[0] == "negative"
+        assert buffer.update(user_id, "negative") is False
+        buffer.update(user_id, "positive")
+        release.set()
+        flusher.join(5)
+
+        assert buffer.get_pending(user_id)[0] == "positive"
+        assert buffer.flush() == 1
+        assert buffer.get_pending(user_id) is None
+        buffer.stop()
+        with pool.connection() as conn:
+            row = conn.execute("SELECT emotion_state FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        assert row[0] == "positive"
+
+    def test_metrics_endpoint(self):
+        """测试指标接口"""
+        response = client.get("/api/metrics")
+        assert response.status_code == 200
+        assert "coalescing_ratio" in response.json()["emotion_write_behind"]
+
+class TestPromptCache:
+    """Prompt缓存测试"""
+
+    def test_hit_and_invalidate(self):
+        """测试命中，以及记忆和情绪变化后失效"""
+        user_id = "prompt_cache_user"
+        create_user(user_id, "小红")
+        add_memory(user_id, "用户喜欢打篮球", "preference", 4)
+        stats = prompt_cache.get_stats()
+
+        first = build_prompt(user_id, "周末去打篮球吗")
+        second = build_prompt(user_id, "周末去打篮球吗")
+        assert first == second
+        assert "小红" in first and "用户喜欢打篮球" in first
+        assert prompt_cache.get_stats()["hits"] == stats["hits"] + 1
+
+        add_memory(user_id, "用户养了一只猫", "preference", 5)
+        assert "用户养了一只猫" in build_prompt(user_id, "你好")
+
+        update_emotion(user_id, "negative")
+        assert "当前情绪：negative" in build_prompt(user_id, "你好")
+        emotion_buffer.flush()
+        build_prompt(user_id, "你好")
+        update_emotion(user_id, "negative")
+        hits = prompt_cache.get_stats()["hits"]
+        build_prompt(user_id, "你好")
+        assert prompt_cache.get_stats()["hits"] == hits + 1
+
+    def test_same_as_uncached(self):
+        """测试缓存的prompt和直接格式化的结果一致"""
+        user_id = "prompt_cache_same_user"
+        create_user(user_id, "小蓝")
+        add_memory(user_id, "用户喜欢喝咖啡", "preference", 3)
+        build_prompt(user_id, "来杯咖啡")
+        memories = retrieve_memories(user_id, "来杯咖啡", limit=10)
+        expected = SYSTEM_PROMPT.format(
+            user_name="小蓝", emotion_state="neutral",
+            memories="\n".join(f"- {m['content']}" for m in memories)
+        )
+        assert build_prompt(user_id, "来杯咖啡") == expected
+
+    def test_version_bumped_after_commit(self):
+        """测试事务提交后才递增版本"""
+        user_id = "prompt_cache_commit_user"
+        create_user(user_id)
+        version = get_version(user_id)
+        with get_pool().transaction():
+            add_memory(user_id, "事务中的记忆", "event")
+            assert get_version(user_id) == version
+        assert get_version(user_id) != version
+
+    def test_flush_during_build(self):
+        """测试构建期间情绪刷新提交，用旧情绪构建的缓存随后失效"""
+        user_id = "prompt_cache_flush_user"
+        create_user(user_id)
+        cache = PromptCache(get_version)
+        update_emotion(user_id, "negative")
+
+        def build():
+            # 先读到刷新前的情绪，刷新在读取之后、get_pending 之前提交
+            with get_pool().connection() as conn:
+                stale = conn.execute("SELECT emotion_state FROM users WHERE user_id = ?", (user_id,)).fetchone()[0]
+            emotion_buffer.flush()
+            return stale
+
+        assert cache.get(user_id, build) == "neutral"
+        assert cache.get(user_id, lambda: get_user(user_id)["emotion_state"]) == "negative"
+
+    def test_metrics(self):
+        """测试指标接口输出命中率"""
+        stats = client.get("/api/metrics").json()["prompt_cache"]
+        assert {"hit_ratio", "saved_ms", "hits", "misses"} <= set(stats)
+
+class TestConversation:
+    """对话历史测试"""
+
+    def test_append_and_recent(self):
+        """测试追加后从缓冲读取最近消息，超出窗口的旧消息被丢弃"""
+        store = ConversationStore(window=4)
+        user_id = "conversation_user"
+        for i in range(3):
+            store.append_turn(user_id, f"消息{i}", f"回复{i}")
+        recent = store.recent(user_id)
+        assert [m["content"] for m in recent] == ["消息1", "回复1", "消息2", "回复2"]
+        assert store.get_stats()["loads"] == 1
+
+        store.append(user_id, "user", "消息3")
+        assert [m["content"] for m in store.recent(user_id, 2)] == ["回复2", "消息3"]
+        assert store.get_stats()["hits"] == 1
+
+        # 另一个实例从数据库加载，结果一致
+        assert ConversationStore(window=4).recent(user_id) == store.recent(user_id)
+        assert len(store.recent(user_id, 7)) == 7
+
+    def test_rollback_not_buffered(self):
+        """测试回滚的消息不进入缓冲"""
+        store = ConversationStore(window=4)
+        user_id = "conversation_rollback_user"
+        store.append(user_id, "user", "保留")
+        store.recent(user_id)
+        with pytest.raises(RuntimeError):
+            with get_pool().transaction():
+                store.append(user_id, "user", "回滚")
+                raise RuntimeError()
+        assert [m["content"] for m in store.recent(user_id)] == ["保留"]
+
+    def test_history_paging(self):
+        """测试按消息id向前翻页"""
+        store = ConversationStore(window=4)
+        user_id = "conversation_paging_user"
+        for i in range(5):
+            store.append(user_id, "user", f"消息{i}")
+        page = store.history(user_id, limit=2)
+        assert [m["content"] for m in page] == ["消息3", "消息4"]
+        older = store.history(user_id, limit=2, before=page[0]["message_id"])
+        assert [m["content"] for m in older] == ["消息1", "消息2"]
+
+    def test_context_budget(self):
+        """测试上下文只保留预算内最新的完整消息"""
+        store = ConversationStore(window=10)
+        user_id = "conversation_budget_user"
+        store.append_turn(user_id, "很早以前的一条很长很长的消息" * 5, "好的")
+        store.append_turn(user_id, "今天天气怎么样", "今天天气不错")
+        context = store.context(user_id, 25)
+        assert context == [
+            {"role": "user", "content": "今天天气怎么样"},
+            {"role": "assistant", "content": "今天天气不错"}
+        ]
+        assert store.context(user_id, 0) == []
+
+    def test_chat_uses_history(self):
+        """测试对话保存历史，下一轮发给LLM的消息包含上一轮"""
+        user_id = "conversation_chat_user"
+        create_user(user_id)
+        chat(user_id, "今天天气怎么样")
+        messages = build_messages(user_id, "那明天呢")
+        assert [m["role"] for m in messages] == ["system", "user", "assistant", "user"]
+        assert messages[1]["content"] == "今天天气怎么样"
+        assert messages[-1]["content"] == "那明天呢"
+
+        response = client.get(f"/api/conversation/{user_id}")
+        assert response.status_code == 200
+        assert [m["role"] for m in response.json()["messages"]] == ["user", "assistant"]
+        assert "conversation" in client.get("/api/metrics").json()
+
+class CountingProvider(MockProvider):
+    """记录调用次数的Provider"""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def chat(self, messages, **kwargs):
+        self.calls += 1
+        return f"第{self.calls}次回复"
+
+class TestResponseCache:
+    """回复缓存测试"""
+
+    def test_normalized_key_ttl_and_lru(self):
+        """测试规范化key、TTL过期和LRU淘汰"""
+        cache = ResponseCache(max_entries=2, ttl=0.05)
+        cache.set("小白", "你好！", "neutral", "你好呀")
+        assert cache.get("小白", " 你好 ", "neutral") == "你好呀"
+        assert cache.get("小白", "你好", "positive") is None
+        assert cache.get("温暖型", "你好", "neutral") is None
+        cache.set("小白", "？？", "neutral", "不缓存")
+        assert cache.get_stats()["entries"] == 1
+
+        cache.set("小白", "在吗", "neutral", "在的")
+        cache.set("小白", "名字", "neutral", "小白")
+        assert cache.get("小白", "你好", "neutral") is None
+        assert cache.get_stats()["evictions"] == 1
+        time.sleep(0.06)
+        assert cache.get("小白", "在吗", "neutral") is None
+        assert cache.get_stats()["expired"] == 1
+
+    def test_chat_template_reply_shared(self):
+        """测试模板回复在用户之间共享缓存"""
+        for user_id in ("response_cache_a", "response_cache_b"):
+            create_user(user_id)
+        stats = response_cache.get_stats()
+        first = chat("response_cache_a", "Response Cache 天气测试？")["reply"]
+        second = chat("response_cache_b", "response cache天气测试")["reply"]
+        assert first == second
+        assert response_cache.get_stats()["hits"] == stats["hits"] + 1
+        assert "response_cache" in client.get("/api/metrics").json()
+
+    def test_llm_reply_per_user_and_opt_out(self):
+        """测试LLM回复只在同一用户内复用，长消息和关闭缓存的用户不使用缓存"""
+        import app.chat as chat_module
+        provider = CountingProvider()
+        old = chat_module.llm_manager.provider
+        chat_module.llm_manager.provider = provider
+        try:
+            for user_id in ("response_llm_a", "response_llm_b"):
+                create_user(user_id)
+            assert chat("response_llm_a", "在吗")["reply"] == chat("response_llm_a", "在吗？")["reply"]
+            assert provider.calls == 1
+            chat("response_llm_b", "在吗")
+            assert provider.calls == 2
+            long_message = "我今天去了一趟很远很远的地方看了很多风景"
+            chat("response_llm_a", long_message)
+            chat("response_llm_a", long_message)
+            assert provider.calls == 4
+
+            response = client.patch("/api/user/response_llm_a/preference", json={"response_cache": False})
+            assert response.json()["preference"] == {"response_cache": False}
+            chat("response_llm_a", "在吗")
+            assert provider.calls == 5
+            assert client.patch("/api/user/no_such_user/preference", json={}).status_code == 404
+        finally:
+            chat_module.llm_manager.provider = old
+
+    def test_qa_engine(self):
+        """测试知识库答案缓存，教新知识后失效"""
+        engine = QAEngine()
+        assert engine.ask("你叫什么？") == engine.ask("你叫什么")
+        assert engine.response_cache.get_stats()["hits"] == 1
+        engine.teach("你叫什么", "我是新名字")
+        assert engine.response_cache.get_stats()["entries"] == 0
+
+@requires_numpy
+class TestSemanticCache:
+    """语义回复缓存测试"""
+
+    def test_normalize_query(self):
+        """测试正反问句和句末语气词归一"""
+        assert normalize_query("在不在呀？") == normalize_query("在吗") == "在"
+        assert normalize_query("有没有空") == normalize_query("有空吗") == "有空"
+        assert normalize_query("啊") == "啊"
+
+    def test_paraphrase_hit_and_negation(self):
+        """测试相近的消息命中，否定词不同或相似度不够时不命中"""
+        cache = SemanticCache()
+        cache.store("小白", "在吗", "在的～")
+        cache.store("小白", "我喜欢猫", "猫很可爱")
+        cache.store("小白", "今天天气怎么样", "晴天")
+        assert cache.lookup("小白", "在不在呀？") == "在的～"
+        assert cache.lookup("小白", "我不喜欢猫") is None
+        assert cache.lookup("小白", "明天天气怎么样") is None
+        assert cache.lookup("温暖型", "在吗") is None
+        assert cache.get_stats()["hits"] == 1
+
+    def test_partition_disable_and_eviction(self):
+        """测试分区隔离、按人设关闭、条目上限和过期"""
+        cache = SemanticCache(max_entries=3, max_per_scope=2, ttl=0.05)
+        cache.store("小白", "你好", "你好呀", "user_a")
+        assert cache.lookup("小白", "你好", "user_b") is None
+        assert cache.lookup("小白", "你好呀", "user_a") == "你好呀"
+
+        cache.store("小白", "晚安", "晚安", "user_a")
+        cache.store("小白", "早安", "早安", "user_a")
+        assert cache.get_stats()["entries"] == 2
+        cache.store("小白", "在吗", "在的", "user_b")
+        cache.store("小白", "吃了吗", "吃了", "user_b")
+        assert cache.get_stats()["evictions"] == 2
+        assert cache.lookup("小白", "早安", "user_a") is None
+
+        cache.disable("小白")
+        assert cache.lookup("小白", "在吗", "user_b") is None
+        assert cache.get_stats()["entries"] == 0
+        cache.enable("小白")
+        cache.store("小白", "在吗", "在的", "user_b")
+        time.sleep(0.06)
+        assert cache.lookup("小白", "在吗", "user_b") is None
+
+    def test_scope_grows_on_demand(self):
+        """测试分区按需扩容到 max_per_scope，满后环形覆盖"""
+        cache = SemanticCache(max_per_scope=6)
+        cache.store("小白", "你好", "你好呀", "user_a")
+        entries = cache._scopes[("小白", "user_a")]
+        assert len(entries.matrix) == 4
+        assert cache.get_stats()["allocated_bytes"] == entries.nbytes
+
+        for i in range(7):
+            cache.store("小白", "第%d个问题" % i, "回复%d" % i, "user_a")
+        assert len(entries.matrix) == 6
+        assert entries.size == 6
+        assert cache.get_stats()["entries"] == 6
+        assert cache.lookup("小白", "你好", "user_a") is None
+        assert cache.lookup("小白", "第6个问题", "user_a") == "回复6"
+
+    def test_llm_manager(self):
+        """测试LLMManager按 cache_scope 使用语义缓存，错误不缓存"""
+        provider = CountingProvider()
+        manager = LLMManager(provider, semantic_cache=SemanticCache())
+        messages = [{"role": "system", "content": "人设"}, {"role": "user", "content": "在吗"}]
+        paraphrase = [{"role": "user", "content": "在不在呀"}]
+        assert manager.chat(messages, cache_scope=("小白", "")) == "第1次回复"
+        assert manager.chat(paraphrase, cache_scope=("小白", "")) == "第1次回复"
+        assert "".join(manager.stream(paraphrase, cache_scope=("小白", ""))) == "第1次回复"
+        assert manager.chat(paraphrase) == "第2次回复"
+        assert provider.calls == 2
+
+        async def run():
+            reply = await manager.achat(paraphrase, cache_scope=("小白", ""))
+            parts = [part async for part in manager.astream(paraphrase, cache_scope=("小白", ""))]
+            return reply, "".join(parts)
+        assert asyncio.run(run()) == ("第1次回复", "第1次回复")
+        weather = [{"role": "user", "content": "今天天气怎么样"}]
+        assert asyncio.run(manager.achat(weather, cache_scope=("小白", ""))) == "第3次回复"
+        assert manager.chat(weather, cache_scope=("小白", "")) == "第3次回复"
+        assert provider.calls == 3
+
+        failing = LLMManager(FailingProvider(), semantic_cache=SemanticCache())
+        failing.chat(messages, cache_scope=("小白", ""))
+        assert failing.semantic_cache.get_stats()["entries"] == 0
+
+class TestTokens:
+    """token计数和上下文预算测试"""
+
+    def test_char_tokenizer(self):
+        """测试中文按字、其余字符按4个一组估算"""
+        tokenizer = CharTokenizer()
+        assert tokenizer.count("你好") == 2
+        assert tokenizer.count("hello world!") == 3
+        assert tokenizer.count("我爱NBA") == 3
+
+    def test_counter_cache(self):
+        """测试计数结果按文本缓存"""
+        counter = TokenCounter(max_entries=2)
+        assert counter.count("今天天气不错") == 6
+        assert counter.count("今天天气不错") == 6
+        assert counter.get_stats()["hits"] == 1
+        counter.count("a")
+        counter.count("b")
+        assert counter.get_stats()["cached"] == 2
+        assert counter.count_messages([{"role": "user", "content": "你好"}]) == 6
+
+    def test_prompt_budget(self):
+        """测试按模型上下文长度和上限计算预算"""
+        assert prompt_budget("gpt-4", 100000) == 8192 - 1024
+        assert prompt_budget("claude-3-opus-20240229", 300000) == 200000 - 1024
+        assert prompt_budget(None, 500) == 500
+
+    def test_pack(self):
+        """测试贪心背包按 价值/token 选择，保持原顺序"""
+        items = [("长而重要", 10, 1.0), ("短", 2, 0.5), ("中", 5, 0.6), ("无关", 3, 0.0)]
+        chosen = pack(items, 8, cost=lambda i: i[1], value=lambda i: i[2])
+        assert [i[0] for i in chosen] == ["短", "中"]
+        assert [i[0] for i in pack(items, 100, lambda i: i[1], lambda i: i[2], max_items=1)] == ["短"]
+
+    def test_build_messages_within_budget(self):
+        """测试记忆和历史消息按预算截断，重要的短记忆优先"""
+        user_id = "token_budget_user"
+        create_user(user_id)
+        add_memory(user_id, "用户喜欢打篮球", "preference", 5)
+        for i in range(30):
+            add_memory(user_id, f"一条很长的不太重要的记忆，内容是第{i}件琐事" * 3, "event", 1, dedupe=False)
+        for i in range(10):
+            conversation_store.append_turn(user_id, f"第{i}轮聊了很多很多内容" * 5, "好的")
+
+        budget = 400
+        messages = build_messages(user_id, "周末打篮球吗", max_tokens=budget)
+        assert TokenCounter().count_messages(messages) <= budget
+        assert "用户喜欢打篮球" in messages[0]["content"]
+        assert len(messages) > 2
+        # 预算充足时放进更多历史
+        assert len(build_messages(user_id, "周末打篮球吗", max_tokens=4000)) > len(messages)
+
+class FailingProvider(MockProvider):
+    """调用失败的Provider"""
+
+    def chat(self, messages, **kwargs):
+        raise ProviderError("Mock调用失败: timeout", self.name, retryable=True)
+
+class TestSummarizer:
+    """对话滚动摘要测试"""
+
+    def test_summarize_with_mock_provider(self):
+        """测试用MockProvider把较早的消息折叠进摘要，保留最近的消息"""
+        summarizer = ConversationSummarizer(LLMManager(MockProvider()), keep_messages=2)
+        user_id = "summary_mock_user"
+        for i in range(3):
+            conversation_store.append_turn(user_id, f"今天第{i}次去跑步了", f"真棒{i}")
+        summary = summarizer.summarize(user_id)
+        messages = conversation_store.recent(user_id)
+        assert summary["last_message_id"] == messages[3]["message_id"]
+        assert summary["folded_messages"] == 4
+        assert summary["summary"] in ["我明白了！", "这是一个很有趣的话题～", "让我想想...", "好的，我会记住的！", "有什么我可以帮你的吗？"]
+        assert summary["tokens_saved"] == summary["folded_tokens"] - count_tokens(summary["summary"]) > 0
+        assert summarizer.get(user_id) == summary
+        # 没有新的可折叠消息时不重新摘要
+        assert summarizer.summarize(user_id) is None
+        assert ConversationSummarizer().get(user_id)["last_message_id"] == summary["last_message_id"]
+
+    def test_background_every_turns(self):
+        """测试每 every_turns 轮在后台摘要一次"""
+        summarizer = ConversationSummarizer(every_turns=2, keep_messages=0)
+        user_id = "summary_background_user"
+        conversation_store.append_turn(user_id, "我养了一只猫", "好可爱")
+        summarizer.notify(user_id)
+        summarizer.join()
+        assert summarizer.get(user_id) is None
+        conversation_store.append_turn(user_id, "猫叫咪咪", "名字真好听")
+        summarizer.notify(user_id)
+        summarizer.join()
+        assert summarizer.get(user_id)["summary"] == "我养了一只猫；猫叫咪咪"
+        assert summarizer.get_stats()["runs"] == 1
+        summarizer.stop()
+
+    def test_provider_failure_not_saved(self):
+        """测试Provider返回错误时不保存摘要"""
+        summarizer = ConversationSummarizer(LLMManager(FailingProvider()), every_turns=1, keep_messages=0)
+        user_id = "summary_failure_user"
+        conversation_store.append_turn(user_id, "你好", "你好呀")
+        summarizer.notify(user_id)
+        summarizer.join()
+        assert summarizer.get_stats()["failures"] == 1
+        assert summarizer.get(user_id) is None
+        summarizer.stop()
+
+    def test_prompt_uses_summary(self):
+        """测试prompt使用 摘要 + 摘要之后的最近对话"""
+        user_id = "summary_chat_user"
+        create_user(user_id)
+        for i in range(conversation_summarizer.every_turns):
+            chat(user_id, f"第{i}轮消息")
+        conversation_summarizer.join()
+        chat(user_id, f"第{conversation_summarizer.every_turns}轮消息")
+        summary = conversation_summarizer.get(user_id)
+        assert "第0轮消息" in summary["summary"]
+
+        messages = build_messages(user_id, "新消息")
+        assert "之前对话的摘要" in messages[0]["content"]
+        history = [m["content"] for m in messages[1:-1]]
+        assert "第0轮消息" not in history and history[-2] == f"第{conversation_summarizer.every_turns}轮消息"
+        assert len(history) == 2 + conversation_summarizer.keep_messages
+        assert client.get(f"/api/conversation/{user_id}").json()["summary"]["tokens_saved"] > 0
+
+class FakeProvider(MockProvider):
+    """注入延迟和错误的Provider：fail="exception" 时抛出普通异常，fail="error" 时抛出 ProviderError"""
+
+    def __init__(self, name, latency=0.0, fail=None):
+        super().__init__()
+        self.name = name
+        self.latency = latency
+        self.fail = fail
+        self.calls = 0
+        self.cancelled = 0
+
+    async def achat(self, messages, **kwargs):
+        self.calls += 1
+        try:
+            await asyncio.sleep(self.latency)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        if self.fail == "exception":
+            raise ConnectionError("连接被重置")
+        if self.fail == "error":
+            raise ProviderError(f"{self.name}调用失败: 503", self.name, status=503, retryable=True)
+        return f"{self.name}的回复"
+
+    async def astream(self, messages, **kwargs):
+        reply = await self.achat(messages, **kwargs)
+        for i in range(0, len(reply), 2):
+            yield reply[i:i + 2]
+
+class TestProviderRouter:
+    """多Provider路由测试"""
+
+    messages = [{"role": "user", "content": "你好"}]
+
+    def test_failover(self):
+        """测试抛出普通异常和 ProviderError 的Provider都会切换到下一个"""
+        for fail in ("exception", "error"):
+            primary, backup = FakeProvider("主", fail=fail), FakeProvider("备")
+            router = ProviderRouter([primary, backup])
+            assert router.complete(self.messages) == "备的回复"
+            stats = router.get_stats()["providers"]
+            assert stats[0]["failures"] == 1 and stats[1]["successes"] == 1
+
+    def test_circuit_breaker(self):
+        """测试连续失败后断路器打开、跳过该Provider，恢复时间后试探成功再关闭"""
+        primary, backup = FakeProvider("主", fail="exception"), FakeProvider("备", latency=0.02)
+        # 主Provider失败得很快，EWMA仍然比备用的低，一直排在前面直到断路器打开
+        router = ProviderRouter([primary, backup], hedge_delay=0, max_hedges=0,
+                                failure_threshold=2, recovery_timeout=0.2)
+        for _ in range(4):
+            assert router.complete(self.messages) == "备的回复"
+        assert primary.calls == 2
+        assert router.get_stats()["providers"][0]["state"] == "open"
+
+        primary.fail = None
+        time.sleep(0.25)
+        assert router.complete(self.messages) == "主的回复"
+        assert router.get_stats()["providers"][0]["state"] == "closed"
+
+    def test_hedge(self):
+        """测试第一个Provider超过对冲时间时发出第二个请求，先返回的胜出，慢的被取消"""
+        slow, fast = FakeProvider("慢", latency=1.0), FakeProvider("快", latency=0.01)
+        router = ProviderRouter([slow, fast], hedge_delay=0.05)
+        start = time.perf_counter()
+        assert router.complete(self.messages) == "快的回复"
+        assert time.perf_counter() - start < 0.5
+        time.sleep(0.05)
+        assert slow.cancelled == 1
+        stats = router.get_stats()
+        assert stats["hedges"] == 1
+        assert stats["providers"][0]["failures"] == 0
+        assert stats["providers"][1]["hedged"] == 1
+
+    def test_ewma_and_p95_deadline(self):
+        """测试按EWMA延迟选择Provider，样本足够后用p95作为对冲时间"""
+        slow, fast = FakeProvider("慢", latency=0.05), FakeProvider("快", latency=0.01)
+        router = ProviderRouter([slow, fast], hedge_delay=0.02, min_samples=10)
+        for _ in range(5):
+            router.complete(self.messages)
+        # 第一次两个都没有延迟数据，按顺序用慢的，对冲后快的胜出；之后快的EWMA更低
+        assert slow.calls == 1 and fast.calls == 5
+        assert router.hedges == 1
+        router.min_samples = 3
+        assert router._deadline(router.routes[1]) < 0.05
+        # 落败的请求不进入分位数窗口
+        assert router._deadline(router.routes[0]) == 0.02
+
+    def test_hedge_loser_demoted(self):
+        """测试对冲中落败的慢Provider记录已耗时，下一次排到后面，不再每次都等满对冲时间"""
+        slow, fast = FakeProvider("慢", latency=1.0), FakeProvider("快", latency=0.01)
+        router = ProviderRouter([slow, fast], hedge_delay=0.1)
+        start = time.perf_counter()
+        for _ in range(5):
+            assert router.complete(self.messages) == "快的回复"
+        assert time.perf_counter() - start < 0.5
+        assert slow.calls == 1 and fast.calls == 5
+        assert router.hedges == 1
+        stats = router.get_stats()["providers"]
+        assert stats[0]["ewma_ms"] >= 100 and stats[0]["p95_ms"] is None
+        assert router._candidates()[0].provider is fast
+
+    def test_stream_failover(self):
+        """测试流式请求在产出第一个片段之前失败时切换Provider"""
+        router = ProviderRouter([FakeProvider("主", fail="exception"), FakeProvider("备")])
+        assert "".join(router.complete_stream(self.messages)) == "备的回复"
+
+    def test_stream_records_latency(self):
+        """测试只走流式请求的Provider也有延迟统计，断路器按成功记录"""
+        router = ProviderRouter([FakeProvider("主", latency=0.02), FakeProvider("备")], min_samples=2)
+        for _ in range(3):
+            assert "".join(router.complete_stream(self.messages)) == "主的回复"
+        stats = router.get_stats()["providers"][0]
+        assert stats["successes"] == 3 and stats["ewma_ms"] >= 20 and stats["p95_ms"] >= 20
+        assert router._deadline(router.routes[0]) < router.hedge_delay
+
+    def test_all_failed_returns_fallback(self):
+        """测试全部失败时抛出ProviderError，LLMManager返回兜底回复而不是错误信息"""
+        router = ProviderRouter([FakeProvider("主", fail="exception"), FakeProvider("备", fail="error")])
+        with pytest.raises(ProviderError):
+            router.complete(self.messages)
+        assert "调用失败" in router.chat(self.messages)
+
+        manager = LLMManager(router, semantic_cache=SemanticCache())
+        assert manager.chat(self.messages, cache_scope=("小白", "")) == manager.fallback_reply
+        assert "".join(manager.stream(self.messages)) == manager.fallback_reply
+        assert asyncio.run(manager.achat(self.messages)) == manager.fallback_reply
+        assert manager.get_stats()["errors"] == 3
+        assert manager.semantic_cache.get_stats()["entries"] == 0
+        assert manager.get_stats()["router"]["exhausted"] == 5
+
+    def test_reply_content_not_sniffed(self):
+        """测试成败只看是否抛出 ProviderError：回复中含有"调用失败"照常返回，流式的空片段跳过"""
+
+        class ChattyProvider(MockProvider):
+            def chat(self, messages, **kwargs):
+                return "上次接口调用失败了？别着急，我们一起看看"
+
+            async def astream(self, messages, **kwargs):
+                for part in ["", "别着急", "", "，慢慢来"]:
+                    yield part
+
+        router = ProviderRouter([ChattyProvider(), FakeProvider("备")])
+        assert router.complete(self.messages) == "上次接口调用失败了？别着急，我们一起看看"
+        assert list(router.complete_stream(self.messages)) == ["别着急", "，慢慢来"]
+        assert router.get_stats()["providers"][0]["failures"] == 0
+
+    def test_change_provider_list(self):
+        """测试逗号分隔的Provider名称组成路由"""
+        manager = LLMManager("mock, mock")
+        assert isinstance(manager.provider, ProviderRouter)
+        assert len(manager.provider.providers) == 2
+        assert manager.chat(self.messages) == "你好呀！有什么想聊的吗？"
+
+class SlowCountingProvider(CountingProvider):
+    """每次调用耗时 latency 秒的计数Provider"""
+
+    def __init__(self, latency=0.1):
+        super().__init__()
+        self.latency = latency
+
+    def chat(self, messages, **kwargs):
+        time.sleep(self.latency)
+        return super().chat(messages, **kwargs)
+
+class TestCoalescing:
+    """相同请求合并测试"""
+
+    messages = [{"role": "system", "content": "人设"}, {"role": "user", "content": "早上好"}]
+
+    def run_threads(self, manager, messages_list):
+        barrier = threading.Barrier(len(messages_list))
+        replies = [None] * len(messages_list)
+
+        def worker(i):
+            barrier.wait()
+            replies[i] = manager.chat(messages_list[i])
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(len(messages_list))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return replies
+
+    def test_identical_requests_share_one_call(self):
+        """测试相同（空白规范化后）的并发请求只调用一次Provider，结束后再次调用会重新执行"""
+        provider = SlowCountingProvider()
+        manager = LLMManager(provider)
+        variant = [{"role": "system", "content": " 人设 "}, {"role": "user", "content": "早上好"}]
+        replies = self.run_threads(manager, [self.messages] * 7 + [variant])
+        assert provider.calls == 1
+        assert set(replies) == {"第1次回复"}
+        stats = manager.get_stats()["coalescing"]
+        assert stats["upstream_calls"] == 1 and stats["coalesced"] == 7 and stats["in_flight"] == 0
+
+        assert manager.chat(self.messages) == "第2次回复"
+
+    def test_different_requests_not_coalesced(self):
+        """测试消息或参数不同的请求、关闭合并时各自调用"""
+        provider = SlowCountingProvider(latency=0.05)
+        manager = LLMManager(provider)
+        other = [{"role": "system", "content": "人设"}, {"role": "user", "content": "晚安"}]
+        self.run_threads(manager, [self.messages, other])
+        assert provider.calls == 2
+
+        provider = SlowCountingProvider(latency=0.05)
+        self.run_threads(LLMManager(provider, coalesce=False), [self.messages] * 4)
+        assert provider.calls == 4
+
+    def test_error_shared(self):
+        """测试上游失败时所有等待者都得到兜底回复"""
+        provider = FakeProvider("主", latency=0.1, fail="exception")
+        manager = LLMManager(provider)
+
+        async def run():
+            return await asyncio.gather(*[manager.achat(self.messages) for _ in range(5)])
+
+        assert asyncio.run(run()) == [manager.fallback_reply] * 5
+        assert provider.calls == 1
+        assert manager.get_stats()["errors"] == 5
+
+    def test_async_cancel_one_waiter(self):
+        """测试异步调用合并，其中一个调用方取消不影响上游请求和其他等待者"""
+        provider = FakeProvider("主", latency=0.1)
+        manager = LLMManager(provider)
+
+        async def run():
+            tasks = [asyncio.ensure_future(manager.achat(self.messages)) for _ in range(4)]
+            await asyncio.sleep(0.02)
+            tasks[0].cancel()
+            return await asyncio.gather(*tasks, return_exceptions=True)
+
+        results = asyncio.run(run())
+        assert isinstance(results[0], asyncio.CancelledError)
+        assert results[1:] == ["主的回复"] * 3
+        assert provider.calls == 1 and provider.cancelled == 0
+
+class BatchProvider(MockProvider):
+    """批量接口的Provider：每批固定耗时 overhead 秒，记录每批大小"""
+
+    def __init__(self, overhead=0.05):
+        super().__init__()
+        self.overhead = overhead
+        self.batches = []
+
+    def complete_batch(self, batch, **kwargs):
+        time.sleep(self.overhead)
+        self.batches.append(len(batch))
+        return [f"回复:{messages[-1]['content']}" for messages in batch]
+
+class TestMicroBatcher:
+    """微批处理测试"""
+
+    def test_batch_size_and_fan_out(self):
+        """测试按 max_batch 出批，结果按顺序分发给各个调用方"""
+        sizes = []
+
+        def handler(items):
+            sizes.append(len(items))
+            return [x * 2 for x in items]
+
+        batcher = MicroBatcher(handler, max_batch=4, max_wait=0.05)
+        pending = [batcher.submit(i) for i in range(10)]
+        assert [f.result(timeout=2) for f in pending] == [i * 2 for i in range(10)]
+        assert sum(sizes) == 10 and max(sizes) <= 4 and len(sizes) <= 4
+        batcher.close()
+
+    def test_max_wait(self):
+        """测试不满一批时等待 max_wait 后出批"""
+        batcher = MicroBatcher(lambda items: items, max_batch=100, max_wait=0.05)
+        start = time.perf_counter()
+        assert batcher.call("a") == "a"
+        assert 0.04 <= time.perf_counter() - start < 0.5
+        assert batcher.get_stats()["batches"] == 1
+        batcher.close()
+
+    def test_errors(self):
+        """测试单项失败只影响该项，handler抛异常时整批失败"""
+        def handler(items):
+            if "boom" in items:
+                raise RuntimeError("整批失败")
+            return [ValueError(x) if x == "bad" else x for x in items]
+
+        batcher = MicroBatcher(handler, max_batch=2, max_wait=0.05)
+        good, bad = batcher.submit("good"), batcher.submit("bad")
+        assert good.result(timeout=2) == "good"
+        with pytest.raises(ValueError):
+            bad.result(timeout=2)
+        with pytest.raises(RuntimeError):
+            batcher.call("boom")
+        assert batcher.get_stats()["failures"] == 1
+        batcher.close()
+
+    def test_cancellation(self):
+        """测试出批前取消的请求（包括超时和异步调用方被取消）不会发往后端"""
+        seen = []
+
+        def handler(items):
+            seen.extend(items)
+            return items
+
+        batcher = MicroBatcher(handler, max_batch=10, max_wait=0.2)
+        kept, dropped = batcher.submit("kept"), batcher.submit("dropped")
+        assert dropped.cancel()
+        with pytest.raises(futures.TimeoutError):
+            batcher.call("timeout", timeout=0.01)
+
+        async def run():
+            task = asyncio.ensure_future(batcher.acall("async"))
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(run())
+        assert kept.result(timeout=2) == "kept"
+        assert seen == ["kept"]
+        assert batcher.get_stats()["cancelled"] == 3
+        batcher.close()
+
+    def test_llm_manager_batching(self):
+        """测试LLMManager攒批调用Provider的 complete_batch()"""
+        provider = BatchProvider()
+        manager = LLMManager(provider, coalesce=False, batch_size=8, batch_wait=0.05)
+        replies = [None] * 8
+
+        def worker(i):
+            replies[i] = manager.chat([{"role": "user", "content": f"消息{i}"}])
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert replies == [f"回复:消息{i}" for i in range(8)]
+        assert sum(provider.batches) == 8 and len(provider.batches) < 8
+        assert asyncio.run(manager.achat([{"role": "user", "content": "异步"}])) == "回复:异步"
+        assert manager.get_stats()["batching"]["submitted"] == 9
+        manager.close()
+
+    def test_batching_encoder(self):
+        """测试微批编码的结果和直接编码一致"""
+        np = pytest.importorskip("numpy")
+        inner = HashingEncoder()
+        encoder = BatchingEncoder(inner, max_batch=16, max_wait=0.02)
+        texts = [f"我喜欢第{i}只猫" for i in range(6)]
+        results = [None] * len(texts)
+
+        def worker(i):
+            results[i] = encoder.encode([texts[i]])[0]
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(len(texts))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert np.allclose(np.stack(results), inner.encode(texts))
+        assert encoder.get_stats()["batches"] < len(texts)
+
+class TestConcurrencyLimiter:
+    """自适应并发限制测试"""
+
+    def test_queue_and_reject(self):
+        """测试超出上限时排队，队列满或排队超时时拒绝，取消的排队请求移出队列"""
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=2, max_limit=4, max_queue=1, queue_timeout=0.05)
+
+        async def run():
+            await limiter.acquire()
+            await limiter.acquire()
+            queued = asyncio.ensure_future(limiter.acquire())
+            await asyncio.sleep(0)
+            assert limiter.get_stats()["queue_depth"] == 1
+            with pytest.raises(ConcurrencyLimitExceeded):
+                await limiter.acquire()
+            limiter.release(0.01, ok=True)
+            await queued
+            assert limiter.in_flight == 2 and limiter.queue_depth == 0
+
+            with pytest.raises(ConcurrencyLimitExceeded):
+                await limiter.acquire()
+            cancelled = asyncio.ensure_future(limiter.acquire())
+            await asyncio.sleep(0)
+            cancelled.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await cancelled
+            assert limiter.queue_depth == 0
+
+        asyncio.run(run())
+        stats = limiter.get_stats()
+        assert stats["rejected"] == 2 and stats["queued"] == 3
+
+    def test_aimd(self):
+        """测试满载且延迟正常时加性增，失败或延迟超过基线的 tolerance 倍时乘性减"""
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=4, min_limit=2, max_limit=8, backoff=0.5)
+
+        async def run():
+            for _ in range(20):
+                for _ in range(int(limiter.limit)):
+                    await limiter.acquire()
+                for _ in range(int(limiter.in_flight)):
+                    limiter.release(0.01, ok=True)
+            grown = limiter.limit
+            # 单独执行的慢请求与并发无关，不降低
+            await limiter.acquire()
+            limiter.release(0.05, ok=True)
+            assert limiter.limit == grown
+            await limiter.acquire()
+            await limiter.acquire()
+            limiter.release(0.05, ok=True)
+            slowed = limiter.limit
+            limiter.release(ok=None)
+            await limiter.acquire()
+            limiter.release(ok=False)
+            await limiter.acquire()
+            limiter.release(ok=False)
+            return grown, slowed
+
+        grown, slowed = asyncio.run(run())
+        assert grown > 6
+        assert slowed == pytest.approx(grown * 0.5)
+        assert limiter.limit == 2
+
+        # 空闲时（在途请求远低于上限）不增加
+        idle = AdaptiveConcurrencyLimiter(initial_limit=8, max_limit=16)
+        asyncio.run(idle.acquire())
+        idle.release(0.01, ok=True)
+        assert idle.limit == 8
+
+    def test_slow_provider_under_load(self, llm_server):
+        """测试Provider随负载变慢时并发上限自动降低，请求排队而不是全部压到Provider上"""
+        llm_server.delay = 0.01
+        llm_server.load_delay = 0.005
+        provider = DeepSeekProvider(api_key="test-key", base_url=llm_server.url, max_concurrency=32)
+        messages = [{"role": "user", "content": "你好"}]
+        replies = []
+
+        def client():
+            for _ in range(2):
+                replies.append(provider.chat(messages))
+
+        for load in (4, 8, 16, 32):
+            llm_server.max_in_flight = 0
+            threads = [threading.Thread(target=client) for _ in range(load)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        provider.close()
+
+        assert replies == ["你好，我是模拟回复"] * 2 * (4 + 8 + 16 + 32)
+        stats = provider.limiter.get_stats()
+        assert stats["limit"] < 16 and stats["decreases"] > 0
+        assert stats["max_queue_depth"] > 0 and stats["queue_depth"] == 0
+        assert llm_server.max_in_flight < 32
+        assert LLMManager(provider).get_stats()["concurrency"]["DeepSeek"]["limit"] == stats["limit"]
+
+    def test_abandoned_stream_releases_slot(self, llm_server):
+        """测试流式请求在第一个片段后被放弃（客户端断开）时归还并发名额，且不调整上限"""
+        provider = OpenAIProvider(api_key="test-key", base_url=llm_server.url, max_concurrency=2, queue_timeout=1)
+        manager = LLMManager(provider)
+        messages = [{"role": "user", "content": "你好"}]
+        for _ in range(3):
+            parts = provider.complete_stream(messages)
+            assert next(parts) == "你好"
+            parts.close()
+            assert provider.limiter.in_flight == 0
+
+        async def abandon():
+            parts = manager.astream(messages)
+            assert await parts.__anext__() == "你好"
+            await parts.aclose()
+
+        for _ in range(3):
+            asyncio.run(abandon())
+        stats = provider.limiter.get_stats()
+        assert stats["in_flight"] == 0 and stats["limit"] == 2 and stats["decreases"] == 0
+        assert manager.chat(messages) == "你好，我是模拟回复"
+        manager.close()
+
+class TestRetry:
+    """暂时性错误的退避重试测试，本地HTTP服务按 schedule 返回429/5xx"""
+
+    messages = [{"role": "user", "content": "你好"}]
+
+    def provider(self, llm_server, **kwargs):
+        kwargs.setdefault("backoff_base", 0.01)
+        return DeepSeekProvider(api_key="test-key", base_url=llm_server.url, **kwargs)
+
+    def test_retry_after_then_success(self, llm_server):
+        """测试429带 Retry-After 时至少等待指定时间后重试成功"""
+        llm_server.schedule.extend([(429, {"Retry-After": "0.2"})])
+        provider = self.provider(llm_server)
+        t0 = time.perf_counter()
+        assert provider.complete(self.messages) == "你好，我是模拟回复"
+        assert time.perf_counter() - t0 >= 0.2
+        assert len(llm_server.requests) == 2
+        provider.close()
+
+    def test_server_errors_then_success(self, llm_server):
+        """测试连续5xx后重试成功，重试次数计入统计"""
+        llm_server.schedule.extend([(503, {}), (502, {})])
+        provider = self.provider(llm_server)
+        manager = LLMManager(provider)
+        assert manager.chat(self.messages) == "你好，我是模拟回复"
+        stats = manager.get_stats()["retries"]["DeepSeek"]
+        assert stats["retries"] == 2 and stats["requests"] == 1
+        manager.close()
+
+    def test_permanent_error_not_retried(self, llm_server):
+        """测试4xx不重试，错误带状态码"""
+        llm_server.schedule.extend([(400, {})])
+        provider = self.provider(llm_server)
+        with pytest.raises(ProviderError) as exc:
+            provider.complete(self.messages)
+        assert exc.value.status == 400 and not exc.value.retryable and exc.value.attempts == 1
+        assert len(llm_server.requests) == 1
+        provider.close()
+
+    def test_attempts_exhausted(self, llm_server):
+        """测试一直失败时最多尝试 max_attempts 次"""
+        llm_server.schedule.extend([(500, {})] * 5)
+        provider = self.provider(llm_server, max_attempts=3)
+        with pytest.raises(ProviderError) as exc:
+            provider.complete(self.messages)
+        assert exc.value.status == 500 and exc.value.retryable and exc.value.attempts == 3
+        assert len(llm_server.requests) == 3
+        provider.close()
+
+    def test_long_retry_after_not_retried(self, llm_server):
+        """测试 Retry-After 超过 max_retry_after 时不重试，交给调用方换Provider"""
+        llm_server.schedule.extend([(429, {"Retry-After": "120"})])
+        provider = self.provider(llm_server, max_retry_after=5)
+        with pytest.raises(ProviderError) as exc:
+            provider.complete(self.messages)
+        assert exc.value.retry_after == pytest.approx(120) and exc.value.attempts == 1
+        assert len(llm_server.requests) == 1
+        provider.close()
+
+    def test_budget_caps_retries(self, llm_server):
+        """测试Provider一直出错时，重试次数不超过请求数的 ratio"""
+        llm_server.schedule.extend([(503, {})] * 1000)
+        budget = RetryBudget(ratio=0.1, min_per_second=0)
+        provider = self.provider(llm_server, retry_budget=budget, backoff_base=0.001)
+        for _ in range(50):
+            with pytest.raises(ProviderError):
+                provider.complete(self.messages)
+        provider.close()
+        stats = budget.get_stats()
+        assert stats["requests"] == 50
+        assert stats["retries"] <= 5 and stats["exhausted"] > 0
+        assert len(llm_server.requests) == 50 + stats["retries"]
+
+    def test_stream_retry_before_first_chunk(self, llm_server):
+        """测试流式请求在产出内容之前失败时重试"""
+        llm_server.schedule.extend([(503, {})])
+        provider = self.provider(llm_server)
+        assert "".join(provider.complete_stream(self.messages)) == "你好，我是模拟回复"
+        assert len(llm_server.requests) == 2
+        provider.close()
+
+    def test_backoff_delay(self):
+        """测试全抖动退避在 [0, min(cap, base × 2^n)] 内，且不短于 Retry-After"""
+        delays = [backoff_delay(3, 0.5, 8.0) for _ in range(200)]
+        assert all(0 <= d <= 4.0 for d in delays)
+        assert max(delays) - min(delays) > 1.0
+        assert all(0 <= backoff_delay(10, 0.5, 8.0) <= 8.0 for _ in range(50))
+        assert backoff_delay(0, 0.5, 8.0, retry_after=3.0) >= 3.0
+
+    def test_retry_budget(self):
+        """测试重试预算：最低保底 + 按请求量的比例"""
+        budget = RetryBudget(ratio=0.2, min_per_second=0.1, window=10)
+        assert budget.try_acquire()
+        assert not budget.try_acquire()
+        for _ in range(20):
+            budget.record_request()
+        assert budget.try_acquire() and budget.try_acquire() and budget.try_acquire()
+        assert not budget.try_acquire()
+        assert budget.get_stats()["exhausted"] == 2
+
+
+@requires_numpy
+class TestSemanticIndex:
+    """语义记忆索引测试"""
+
+    def test_encoder_paraphrase(self):
+        """测试同义表达的相似度高于无关内容"""
+        vectors = HashingEncoder().encode(["我爱打篮球", "喜欢篮球运动", "明天要交报告"])
+        assert vectors.dtype.name == "float32"
+        assert float(vectors[0] @ vectors[1]) > float(vectors[0] @ vectors[2])
+
+    def test_search_and_add(self):
+        """测试懒加载检索和追加"""
+        user_id = "semantic_user"
+        add_memory(user_id, "喜欢篮球运动", "preference")
+        add_memory(user_id, "明天要交报告", "event")
+        index = SemanticMemoryIndex()
+
+        top = index.search(user_id, "我爱打篮球", k=1)
+        assert len(top) == 1
+        assert index.get_stats()["loads"] == 1
+
+        index.add(user_id, "new-id", "周末打篮球")
+        ids = [memory_id for memory_id, _score in index.search(user_id, "打篮球", k=3)]
+        assert "new-id" in ids
+        assert index.get_stats()["loads"] == 1
+
+    def test_add_after_commit(self, monkeypatch):
+        """测试外层事务回滚时不留下向量，加载期间的新增让这次加载不被缓存"""
+        user_id = "semantic_rollback_user"
+        monkeypatch.setattr(semantic, "semantic_index", SemanticMemoryIndex())
+        add_memory(user_id, "喜欢篮球运动", "preference")
+        semantic.semantic_index.search(user_id, "篮球运动")
+        with pytest.raises(RuntimeError):
+            with get_pool().transaction():
+                add_memory(user_id, "周末去打篮球", "event")
+                raise RuntimeError("回滚")
+        assert semantic.semantic_index._users[user_id].size == 1
+        add_memory(user_id, "周末去打篮球", "event")
+        assert semantic.semantic_index._users[user_id].size == 2
+
+        index = SemanticMemoryIndex()
+        encode = index.encoder.encode
+
+        def add_during_load(texts):
+            index.encoder.encode = encode
+            index.add(user_id, "late-id", "周末去打篮球")
+            return encode(texts)
+        index.encoder.encode = add_during_load
+        assert "late-id" not in dict(index.search(user_id, "篮球运动"))
+        assert index.get_stats()["loads"] == 0
+        index.search(user_id, "篮球运动")
+        assert index.get_stats()["loads"] == 1
+
+    def test_memory_budget(self):
+        """测试超出内存预算时淘汰最久未使用的用户"""
+        for user_id in ("budget_a", "budget_b"):
+            add_memory(user_id, "用户喜欢看电影", "preference")
+        index = SemanticMemoryIndex(memory_budget=1)
+        index.search("budget_a", "电影")
+        index.search("budget_b", "电影")
+        stats = index.get_stats()
+        assert stats["users_loaded"] == 1
+        assert stats["evictions"] == 1
+
+    def test_retrieve_with_semantic_index(self, monkeypatch):
+        """测试检索时合并语义候选"""
+        import app.semantic as semantic_module
+        user_id = "semantic_retrieve_user"
+        add_memory(user_id, "喜欢篮球运动", "preference")
+        for i in range(20):
+            add_memory(user_id, f"无关的记忆{i}", "fact")
+        
+        memories = retrieve_memories(user_id, "我爱打篮球", limit=3, candidates=5)
+        assert "喜欢篮球运动" not in [m["content"] for m in memories]
+        
+        monkeypatch.setattr(semantic_module, "semantic_index", SemanticMemoryIndex())
+        memories = retrieve_memories(user_id, "我爱打篮球", limit=3, candidates=5)
+        assert memories[0]["content"] == "喜欢篮球运动"
+
+class TestCompaction:
+    """记忆压缩测试"""
+
+    @staticmethod
+    def seed(user_id: str, rows: list):
+        """写入指定时间的记忆 [(content, memory_type, importance, created_at)]"""
+        with get_pool().transaction() as conn:
+            conn.executemany(
+                "INSERT INTO memories (memory_id, user_id, content, memory_type, importance, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(f"{user_id}-{i}", user_id, content, memory_type, importance, created, created)
+                 for i, (content, memory_type, importance, created) in enumerate(rows)]
+            )
+
+    def test_decay_merge_archive(self):
+        """测试衰减、合并和归档"""
+        user_id = "test_compaction_user"
+        now = datetime(2025, 1, 1)
+        self.seed(user_id, [
+            ("最近的重要记忆", "preference", 5, "2024-12-25T00:00:00"),
+            ("两个月前的记忆", "preference", 4, "2024-11-01T00:00:00"),
+            ("旧的小事1", "habit", 1, "2024-09-01T00:00:00"),
+            ("旧的小事2", "habit", 1, "2024-09-02T00:00:00"),
+            ("很久以前的小事", "event", 1, "2024-01-01T00:00:00"),
+            ("不太久的小事", "plan", 1, "2024-10-01T00:00:00"),
+        ])
+        MemoryCompactor().run(now)
+
+        memories = {m["content"]: m for m in get_memories(user_id)}
+        assert memories["最近的重要记忆"]["importance"] == 5
+        assert memories["两个月前的记忆"]["importance"] == 3
+        assert memories["旧的小事1；旧的小事2"]["importance"] == 2
+        assert "不太久的小事" in memories
+        assert "很久以前的小事" not in memories
+
+        with get_pool().connection() as conn:
+            archived = dict(conn.execute(
+                "SELECT content, summary_id FROM memories_archive WHERE user_id = ?", (user_id,)
+            ).fetchall())
+        summary_id = memories["旧的小事1；旧的小事2"]["memory_id"]
+        assert archived == {"旧的小事1": summary_id, "旧的小事2": summary_id, "很久以前的小事": None}
+
+        # 同一时间再执行一次不会重复衰减
+        MemoryCompactor().run(now)
+        assert {m["content"]: m["importance"] for m in get_memories(user_id)}["两个月前的记忆"] == 3
+
+    def test_resumable(self):
+        """测试分批执行，游标保存在数据库中，每次新建实例也能接着处理"""
+        user_id = "test_compaction_resume"
+        self.seed(user_id, [(f"旧记忆{i}", "habit", 1, "2024-01-01T00:00:00") for i in range(30)])
+        runs = 0
+        while runs < 100 and any("；" not in m["content"] for m in get_memories(user_id)):
+            MemoryCompactor(merge_batch_size=10, max_batches=1, pause=0).run(datetime(2025, 1, 1))
+            runs += 1
+        assert runs > 1
+        assert len(get_memories(user_id)) == 3
+        assert all(m["importance"] == 2 for m in get_memories(user_id))
+
+    def test_semantic_index_invalidated_after_commit(self, monkeypatch):
+        """测试合并后语义索引在事务提交之后才失效，并发检索不会从未提交的旧数据重新加载"""
+        user_id = "test_compaction_invalidate"
+        self.seed(user_id, [(f"旧习惯{i}", "habit", 1, "2024-01-01T00:00:00") for i in range(3)])
+        in_transaction = []
+
+        def invalidate(uid=None):
+            with get_pool().connection() as conn:
+                in_transaction.append((uid, conn.in_transaction))
+
+        monkeypatch.setattr(semantic.semantic_index, "invalidate", invalidate)
+        MemoryCompactor().run(datetime(2025, 1, 1))
+        assert (user_id, False) in in_transaction
+        assert all(not pending for _uid, pending in in_transaction)
+
+
+# ==================== 存储层测试 ====================
+
+class TestStorage:
+    """连接池测试"""
+
+    def test_wal_enabled(self, tmp_path):
+        """测试连接开启WAL"""
+        pool = ConnectionPool(str(tmp_path / "wal.db"))
+        with pool.connection() as conn:
+            mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+        pool.close()
+        assert mode == "wal"
+
+    def test_connection_reused(self, tmp_path):
+        """测试连接被复用，同一线程嵌套调用拿到同一条连接"""
+        pool = ConnectionPool(str(tmp_path / "reuse.db"))
+        with pool.connection() as outer:
+            with pool.connection() as inner:
+                assert inner is outer
+        with pool.connection() as again:
+            assert again is outer
+        assert pool.get_stats()["open_connections"] == 1
+        pool.close()
+
+    def test_pool_bounded(self, tmp_path):
+        """测试连接数上限"""
+        pool = ConnectionPool(str(tmp_path / "bounded.db"), max_connections=1, timeout=0.1)
+        acquired = threading.Event()
+        release = threading.Event()
+
+        def hold():
+            with pool.connection():
+                acquired.set()
+                release.wait()
+
+        worker = threading.Thread(target=hold)
+        worker.start()
+        acquired.wait()
+        try:
+            with pytest.raises(sqlite3.OperationalError):
+                with pool.connection():
+                    pass
+        finally:
+            release.set()
+            worker.join()
+        pool.close()
+
+    def test_transaction_rollback(self, tmp_path):
+        """测试事务出错回滚"""
+        pool = ConnectionPool(str(tmp_path / "rollback.db"))
+        with pool.transaction() as conn:
+            conn.execute("CREATE TABLE t (x INTEGER)")
+        with pytest.raises(ValueError):
+            with pool.transaction() as conn:
+                conn.execute("INSERT INTO t VALUES (1)")
+                raise ValueError("boom")
+        with pool.connection() as conn:
+            assert conn.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 0
+        pool.close()
+
+    def test_after_commit(self, tmp_path):
+        """测试提交后回调：嵌套事务在最外层提交后执行，回滚时丢弃"""
+        pool = ConnectionPool(str(tmp_path / "after_commit.db"))
+        calls = []
+        with pool.transaction():
+            with pool.transaction():
+                pool.after_commit(lambda: calls.append("inner"))
+            assert calls == []
+        assert calls == ["inner"]
+        with pytest.raises(ValueError):
+            with pool.transaction():
+                pool.after_commit(lambda: calls.append("rolled back"))
+                raise ValueError("boom")
+        pool.after_commit(lambda: calls.append("no transaction"))
+        assert calls == ["inner", "no transaction"]
+        pool.close()
+
+    def test_migrate(self, tmp_path):
+        """测试schema迁移按版本执行且可重复执行"""
+        pool = ConnectionPool(str(tmp_path / "migrate.db"))
+        assert migrate(pool, target=1) == 1
+        latest = MIGRATIONS[-1][0]
+        assert migrate(pool) == latest
+        assert migrate(pool) == latest
+        pool.close()
+
+    def test_migrate_backfills_dedup_columns(self, tmp_path):
+        """测试升级时为已有记忆补全去重哈希"""
+        pool = ConnectionPool(str(tmp_path / "backfill.db"))
+        migrate(pool, target=3)
+        with pool.transaction() as conn:
+            conn.execute(
+                "INSERT INTO memories (memory_id, user_id, content, memory_type, importance, created_at, updated_at) "
+                "VALUES ('m1', 'u', '我喜欢打篮球', 'preference', 3, '2024-01-01', '2024-01-01')"
+            )
+        migrate(pool)
+        with pool.connection() as conn:
+            row = conn.execute("SELECT content_hash, simhash FROM memories WHERE memory_id = 'm1'").fetchone()
+        assert row[0] == dedup.content_hash("我喜欢打篮球")
+        assert row[1] == dedup.simhash("我喜欢打篮球")
+        pool.close()
+
+    def test_fts_survives_vacuum(self, tmp_path):
+        """测试升级为显式整数主键后全文索引仍然对应原来的行，删除记忆并 VACUUM 后搜索结果正确"""
+        pool = ConnectionPool(str(tmp_path / "vacuum.db"))
+        migrate(pool, target=7)
+        with pool.transaction() as conn:
+            for i, content in enumerate(["我喜欢打篮球", "周末去爬山", "最爱吃火锅", "养了一只橘猫"]):
+                conn.execute(
+                    "INSERT INTO memories (memory_id, user_id, content, memory_type) VALUES (?, 'u', ?, 'preference')",
+                    (f"m{i}", content)
+                )
+        migrate(pool)
+
+        def search(conn, query):
+            return [row[0] for row in conn.execute(
+                "SELECT m.memory_id FROM memories_fts f JOIN memories m ON m.rowid = f.rowid "
+                "WHERE memories_fts MATCH ?", (query,)
+            )]
+
+        with pool.connection() as conn:
+            columns = {row[1]: row for row in conn.execute("PRAGMA table_info(memories)")}
+            assert columns["id"][2] == "INTEGER" and columns["id"][5] == 1
+            assert search(conn, "去爬山") == ["m1"]
+        with pool.transaction() as conn:
+            conn.execute("DELETE FROM memories WHERE memory_id IN ('m0', 'm1')")
+        with pool.connection() as conn:
+            conn.execute("VACUUM")
+            assert search(conn, "吃火锅") == ["m2"]
+            assert search(conn, "只橘猫") == ["m3"]
+            assert search(conn, "打篮球") == []
+        pool.close()
+
+
+class TestQueryPlan:
+    """查询计划测试，确保热点查询走索引"""
+
+    @staticmethod
+    def plan(sql: str, params: tuple) -> str:
+        with get_pool().connection() as conn:
+            rows = conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+        return " | ".join(row[3] for row in rows)
+
+    def test_get_memories_uses_index(self):
+        plan = self.plan("SELECT * FROM memories WHERE user_id = ? ORDER BY importance DESC", ("u",))
+        assert "USING INDEX idx_memories_user_importance" in plan
+        assert "TEMP B-TREE" not in plan
+
+    def test_get_memories_by_type_uses_index(self):
+        plan = self.plan(
+            "SELECT * FROM memories WHERE user_id = ? AND memory_type = ? ORDER BY importance DESC",
+            ("u", "preference")
+        )
+        assert "USING INDEX idx_memories_user_type_importance" in plan
+        assert "TEMP B-TREE" not in plan
+
+    def test_get_reminders_uses_index(self):
+        plan = self.plan("SELECT * FROM reminders WHERE user_id = ? ORDER BY created_at DESC", ("u",))
+        assert "USING INDEX idx_reminders_user_created" in plan
+        assert "TEMP B-TREE" not in plan
+
+    def test_memory_timeline_uses_covering_index(self):
+        plan = self.plan("""
+            SELECT date(created_at) as date, COUNT(*) as count
+            FROM memories
+            WHERE user_id = ?
+            GROUP BY date(created_at)
+            ORDER BY date DESC
+            LIMIT 30
+        """, ("u",))
+        assert "USING COVERING INDEX idx_memories_user_day" in plan
+        assert "TEMP B-TREE" not in plan
 
 # ==================== 用户接口测试 ====================
 